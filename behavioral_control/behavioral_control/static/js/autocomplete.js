@@ -0,0 +1,27 @@
+/*global jQuery*/
+// Turns <select class="vAutocomplete" data-autocomplete-url="..."> into a
+// select2 widget whose options are searched page by page from that url.
+'use strict';
+{
+    const $ = jQuery;
+
+    $(function() {
+        $('select.vAutocomplete').each(function() {
+            const $select = $(this);
+            $select.select2({
+                width: '100%',
+                ajax: {
+                    url: $select.data('autocomplete-url'),
+                    dataType: 'json',
+                    delay: 250,
+                    data: function(params) {
+                        return {
+                            term: params.term || '',
+                            page: params.page || 1
+                        };
+                    }
+                }
+            });
+        });
+    });
+}
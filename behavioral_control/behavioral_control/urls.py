@@ -4,7 +4,7 @@ from django.urls import path
 from django.utils.translation import gettext_lazy as _
 from django.views.i18n import JavaScriptCatalog
 
-from my_router import auth, views
+from my_router import api, auth, views
 
 urlpatterns = [
     path(r'jsi18n/',
@@ -22,25 +22,50 @@ urlpatterns = [
          name='logout'),
     path('profile/', auth.user_profile, name='profile'),
     path('', views.home, name='home'),
+    path('metrics', views.metrics_view, name='metrics'),
+
+    path('api/v1/routers/', api.RouterListAPIView.as_view(),
+         name="api-router-list"),
+
+    path('api/v1/routers/<router_id>/', api.RouterDetailAPIView.as_view(),
+         name="api-router-detail"),
+
+    path('api/v1/routers/<router_id>/<name>/',
+         api.RouterInfoListAPIView.as_view(), name="api-router-info-list"),
 
     path('router/<router_id>/devices/', views.list_devices,
          name="device-list"),
 
+    path('router/<router_id>/devices/bulk/', views.bulk_update_device_list,
+         name="device-bulk-update"),
+
     path('router/<router_id>/device/<pk>/update',
          views.DeviceUpdateView.as_view(), name="device-edit"),
 
     path('router/<router_id>/<info_name>/ajax/', views.fetch_cached_info,
          name="fetch-cached-info"),
 
+    path('router/<router_id>/<info_name>/events/', views.stream_cached_info,
+         name="stream-cached-info"),
+
+    path('router/<router_id>/autocomplete/<kind>/', views.autocomplete,
+         name="autocomplete"),
+
     path('router/<router_id>/domain_blacklist/<domain_blacklist_id>/edit/',
          views.DomainBlacklistEditView.as_view(), name="domain_blacklist-edit"),
 
+    path('router/<router_id>/domain_blacklist/delete/', views.bulk_delete_rule_list,
+         {"kind": "domain_blacklist"}, name="domain_blacklist-bulk-delete"),
+
     path('router/<router_id>/domain_blacklist/list/', views.list_domain_blacklist,
          name="domain_blacklist-list"),
 
     path('router/<router_id>/domain_blacklist/<domain_blacklist_id>/delete/',
          views.delete_domain_blacklist, name="domain_blacklist-delete"),
 
+    path('router/<router_id>/protocol_control/delete/', views.bulk_delete_rule_list,
+         {"kind": "acl_l7"}, name="acl_l7-bulk-delete"),
+
     path('router/<router_id>/protocol_control/list/', views.list_acl_l7,
          name="acl_l7-list"),
 
@@ -50,6 +75,9 @@ urlpatterns = [
     path('router/<router_id>/protocol_control/<acl_l7_id>/delete/',
          views.delete_acl_l7, name="acl_l7-delete"),
 
+    path('router/<router_id>/mac_group/delete/', views.bulk_delete_rule_list,
+         {"kind": "mac_group"}, name="mac_group-bulk-delete"),
+
     path('router/<router_id>/mac_group/list/', views.list_mac_group,
          name="mac_group-list"),
 
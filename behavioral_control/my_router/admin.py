@@ -1,7 +1,14 @@
-from django.contrib import admin
+from itertools import groupby
+
+from django import forms
+from django.contrib import admin, messages
+from django.contrib.admin.helpers import ActionForm
 from django.forms import ModelForm, PasswordInput
+from django.utils.translation import gettext_lazy as _
 
-from my_router.models import Device, Router
+from my_router.bulk import (BULK_DEVICE_ACTIONS, BULK_DEVICE_MAC_GROUP_ACTIONS,
+                            bulk_update_devices, get_bulk_device_action_kwargs)
+from my_router.models import Device, Router, get_default_device_retention_days
 
 
 class RouterForm(ModelForm):
@@ -12,6 +19,12 @@ class RouterForm(ModelForm):
         }
         exclude = ("task", )
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        if self.instance.pk is None and "device_retention_days" in self.fields:
+            self.fields["device_retention_days"].initial = (
+                get_default_device_retention_days())
+
 
 class RouterAdmin(admin.ModelAdmin):
     list_display = (
@@ -20,7 +33,8 @@ class RouterAdmin(admin.ModelAdmin):
         "description",
         "url",
         "status",
-        "fetch_interval"
+        "fetch_interval",
+        "device_retention_days",
     )
     list_editable = (
         "name",
@@ -43,10 +57,57 @@ class DeviceAdminForm(ModelForm):
         exclude = ()
 
 
+class DeviceActionForm(ActionForm):
+    mac_group = forms.CharField(
+        label=_("Mac groups"), required=False,
+        help_text=_("Comma separated names of mac groups"))
+
+
+def make_bulk_device_action(name, description):
+    def action(modeladmin, request, queryset):
+        mac_groups = [
+            v.strip() for v in request.POST.get("mac_group", "").split(",")
+            if v.strip()]
+        kwargs = get_bulk_device_action_kwargs(name, mac_groups)
+
+        # One bulk update, one batch of router mutations and one refresh
+        # per router
+        devices = queryset.select_related("router").order_by("router_id")
+        for _router_id, router_devices in groupby(
+                devices, key=lambda d: d.router_id):
+            router_devices = list(router_devices)
+            router = router_devices[0].router
+            try:
+                skipped_groups = bulk_update_devices(
+                    router, router_devices, **kwargs)
+            except Exception as e:
+                modeladmin.message_user(
+                    request, f"{router}: {type(e).__name__}: {str(e)}",
+                    level=messages.ERROR)
+                continue
+
+            for group_name in skipped_groups:
+                modeladmin.message_user(
+                    request,
+                    _("{router}: the devices can't all be removed from "
+                      "group '{group}'.").format(router=router, group=group_name),
+                    level=messages.WARNING)
+
+    action.__name__ = name
+    action.short_description = description
+    return action
+
+
 class DeviceAdmin(admin.ModelAdmin):
 
     readonly_fields = ("mac", "name")
     form = DeviceAdminForm
+    action_form = DeviceActionForm
+    actions = [
+        make_bulk_device_action(name, description)
+        for name, (description, _kwargs) in BULK_DEVICE_ACTIONS.items()] + [
+        make_bulk_device_action(name, description)
+        for name, description in BULK_DEVICE_MAC_GROUP_ACTIONS.items()]
 
     list_display = (
         "id",
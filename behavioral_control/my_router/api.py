@@ -0,0 +1,222 @@
+"""
+A read-only REST API of the routers at ``/api/v1/``, served from the cached
+snapshots so that the routers themselves are never called:
+
+- ``routers/`` and ``routers/<router_id>/``: the routers,
+- ``routers/<router_id>/<name>/``: the devices, rules or mac groups of a
+  router (*name* is one of :data:`API_INFO_NAMES`), as in the list pages.
+
+Clients authenticate with their token (``Authorization: Token <key>``).
+Lists are paginated with opaque cursors (see :class:`RowCursorPagination`),
+``?fields=a,b`` only returns those fields of each row, and responses carry
+an ETag, so that unchanged results are answered with 304 Not Modified.
+"""
+
+import base64
+import hashlib
+import json
+from bisect import bisect_left, bisect_right
+
+from django.conf import settings
+from django.shortcuts import get_object_or_404
+from django.utils.cache import get_conditional_response
+from django.utils.http import quote_etag
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination
+from rest_framework.permissions import IsAuthenticated
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+from rest_framework.views import APIView
+
+from my_router.data_manager import RouterDataManager
+from my_router.models import Router
+from my_router.responses import dumps_json
+from my_router.serializers import RouterSerializer
+from my_router.views import (VIEW_DATA_ROW_KEYS, get_view_data_row_list,
+                             set_snapshot_staleness_headers)
+
+# name in the url: info_name of RouterDataManager.get_view_data
+API_INFO_NAMES = {
+    "devices": "device",
+    "acl_l7": "acl_l7",
+    "domain_blacklist": "domain_blacklist",
+    "url_black": "url_black",
+    "mac_groups": "mac_group",
+}
+
+# Query parameters of the API, the others are passed to get_view_data
+API_QUERY_PARAMS = ("cursor", "page_size", "fields", "format")
+
+
+class RowCursorPagination(BasePagination):
+    """
+    Paginate rows (dicts) by the value of their unique *row_key*. The cursor
+    holds the key of the row a page starts after (or, for the previous
+    page, ends before), so that pages stay consistent when rows are added
+    or removed between requests, unlike offsets.
+    """
+
+    cursor_query_param = "cursor"
+    page_size_query_param = "page_size"
+    invalid_cursor_message = "Invalid cursor"
+
+    def __init__(self, row_key):
+        self.row_key = row_key
+        self.request = None
+        self.next_cursor = None
+        self.previous_cursor = None
+
+    @staticmethod
+    def encode_cursor(key, reverse):
+        return base64.urlsafe_b64encode(
+            json.dumps([key, reverse]).encode()).decode()
+
+    def decode_cursor(self, request):
+        encoded = request.query_params.get(self.cursor_query_param)
+        if not encoded:
+            return None
+        try:
+            key, reverse = json.loads(base64.urlsafe_b64decode(encoded))
+        except (TypeError, ValueError):
+            raise NotFound(self.invalid_cursor_message)
+        return key, bool(reverse)
+
+    def get_page_size(self, request):
+        page_size = getattr(settings, "BEHAVIORAL_CONTROL_API_PAGE_SIZE", 100)
+        max_page_size = getattr(
+            settings, "BEHAVIORAL_CONTROL_API_MAX_PAGE_SIZE", 1000)
+        try:
+            page_size = int(
+                request.query_params.get(self.page_size_query_param, page_size))
+        except ValueError:
+            pass
+        return min(max(page_size, 1), max_page_size)
+
+    def paginate_rows(self, rows, request):
+        self.request = request
+        page_size = self.get_page_size(request)
+
+        rows = sorted(rows, key=lambda row: row[self.row_key])
+        keys = [row[self.row_key] for row in rows]
+
+        cursor = self.decode_cursor(request)
+        try:
+            if cursor is None:
+                start = 0
+                end = min(page_size, len(rows))
+            elif not cursor[1]:
+                start = bisect_right(keys, cursor[0])
+                end = min(start + page_size, len(rows))
+            else:
+                end = bisect_left(keys, cursor[0])
+                start = max(end - page_size, 0)
+        except TypeError:
+            # A key of another type, i.e., of another list
+            raise NotFound(self.invalid_cursor_message)
+
+        page = rows[start:end]
+        if end < len(rows) and page:
+            self.next_cursor = self.encode_cursor(keys[end - 1], False)
+        if start > 0 and page:
+            self.previous_cursor = self.encode_cursor(keys[start], True)
+        return page
+
+    def get_link(self, cursor):
+        if cursor is None:
+            return None
+        url = self.request.build_absolute_uri()
+        return replace_query_param(url, self.cursor_query_param, cursor)
+
+    def get_paginated_response(self, data):
+        return Response({
+            "next": self.get_link(self.next_cursor),
+            "previous": self.get_link(self.previous_cursor),
+            "results": data,
+        })
+
+
+def get_requested_fields(request):
+    fields = request.query_params.get("fields")
+    if not fields:
+        return None
+    return [field.strip() for field in fields.split(",") if field.strip()]
+
+
+def select_fields(rows, fields):
+    """
+    Return *rows* with only *fields* (unknown fields are ignored), or as is
+    if *fields* is None.
+    """
+    if fields is None:
+        return rows
+    return [{field: row[field] for field in fields if field in row}
+            for row in rows]
+
+
+def get_etag(data):
+    return quote_etag(
+        hashlib.blake2b(dumps_json(data), digest_size=16).hexdigest())
+
+
+class SnapshotAPIView(APIView):
+    """
+    Read-only views answering conditional requests with the ETag of the
+    data.
+    """
+
+    permission_classes = [IsAuthenticated]
+    http_method_names = ["get", "head", "options"]
+
+    # The key identifying the rows of the listed data
+    row_key = "id"
+
+    def list_rows(self, request, rows):
+        paginator = RowCursorPagination(self.row_key)
+        page = paginator.paginate_rows(rows, request)
+        return paginator.get_paginated_response(
+            select_fields(page, get_requested_fields(request)))
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        response = super().finalize_response(request, response, *args, **kwargs)
+        if request.method in ("GET", "HEAD") and response.status_code == 200:
+            etag = get_etag(response.data)
+            response["ETag"] = etag
+            # 304 Not Modified (with the ETag) if the client has the data
+            response = get_conditional_response(
+                request, etag=etag, response=response)
+        return response
+
+
+class RouterListAPIView(SnapshotAPIView):
+    def get(self, request):
+        rows = RouterSerializer(Router.objects.all(), many=True).data
+        return self.list_rows(request, rows)
+
+
+class RouterDetailAPIView(SnapshotAPIView):
+    def get(self, request, router_id):
+        router = get_object_or_404(Router, id=router_id)
+        data = RouterSerializer(router).data
+        return Response(
+            select_fields([data], get_requested_fields(request))[0])
+
+
+class RouterInfoListAPIView(SnapshotAPIView):
+    def get(self, request, router_id, name):
+        router = get_object_or_404(Router, id=router_id)
+        if name not in API_INFO_NAMES:
+            raise NotFound()
+        info_name = API_INFO_NAMES[name]
+        self.row_key = VIEW_DATA_ROW_KEYS[info_name]
+
+        query_params = {
+            key: value for key, value in request.query_params.items()
+            if key not in API_QUERY_PARAMS}
+
+        rd_manager = RouterDataManager(router_instance=router)
+        rd_manager.init_data_from_cache()
+        rows = get_view_data_row_list(rd_manager, info_name, query_params)
+
+        response = self.list_rows(request, rows)
+        set_snapshot_staleness_headers(response, rd_manager)
+        return response
@@ -0,0 +1,154 @@
+"""
+Server-side search for the device, mac group, protocol and domain group
+pickers of the edit forms, so that pages only render the selected values
+and the options are fetched page by page while typing.
+
+Each router has a prefix index per snapshot version: the lowercased names,
+MAC addresses and IP addresses of its devices (and the names of its mac
+groups, protocols and domain groups), sorted, so that a search is a binary
+search plus a scan of the matching range. The device index is also built
+again when the devices are changed in the database, see
+:func:`touch_device_table`, and the protocol and domain group indexes when
+the catalogs are fetched again.
+"""
+
+import uuid
+from bisect import bisect_left
+
+from django.conf import settings
+
+from my_router.constants import DEFAULT_CACHE
+from my_router.snapshot import SnapshotLRUCache
+from my_router.utils import get_device_table_version_cache_key
+
+AUTOCOMPLETE_KINDS = ("device", "mac_group", "protocol", "domain_group")
+
+# (router_id, kind) -> (snapshot version, PrefixIndex)
+index_cache = SnapshotLRUCache(
+    maxsize=getattr(settings, "BEHAVIORAL_CONTROL_SNAPSHOT_LRU_SIZE", 16) * 2)
+
+
+class PrefixIndex:
+    """
+    Find items by the prefix of any of their search keys. *entries* are
+    ``(value, text, keys)``, the items ``(value, text)`` are returned in the
+    order of *entries*.
+    """
+
+    def __init__(self, entries):
+        self.items = []
+        keys = set()
+        for position, (value, text, entry_keys) in enumerate(entries):
+            self.items.append((value, text))
+            keys.update((key.lower(), position) for key in entry_keys if key)
+        self._keys = sorted(keys)
+
+    def search(self, query):
+        query = (query or "").strip().lower()
+        if not query:
+            return list(self.items)
+
+        positions = set()
+        for i in range(bisect_left(self._keys, (query, -1)), len(self._keys)):
+            key, position = self._keys[i]
+            if not key.startswith(query):
+                break
+            positions.add(position)
+        return [self.items[position] for position in sorted(positions)]
+
+
+def touch_device_table(router_id):
+    """
+    Mark the devices of *router_id* as changed in the database, e.g., renamed,
+    so that the device indexes of all the processes are built again.
+    """
+    # Not expiring, an expired marker could match the version of an index
+    DEFAULT_CACHE.set(
+        get_device_table_version_cache_key(router_id), uuid.uuid4().hex,
+        timeout=None)
+
+
+def build_device_index(rd_manager):
+    from my_router.models import Device
+
+    # IP addresses of the online devices, from the cached snapshot only
+    ip_addrs = {}
+    if rd_manager.is_initialized_from_cached_data:
+        ip_addrs = {
+            device["mac"]: device.get("ip_addr") for device in rd_manager.devices}
+
+    devices = Device.objects.filter(
+        router_id=rd_manager.router_id).order_by("name", "mac")
+    return PrefixIndex(
+        (mac, f"{name} ({mac})" if name else mac, (mac, name, ip_addrs.get(mac)))
+        for mac, name in devices.values_list("mac", "name"))
+
+
+def build_name_index(names):
+    return PrefixIndex((name, name, (name,)) for name in names)
+
+
+def build_mac_group_index(rd_manager):
+    return build_name_index(sorted(rd_manager.mac_groups))
+
+
+def get_prefix_index(rd_manager, kind):
+    """
+    The :class:`PrefixIndex` of *kind* (one of :data:`AUTOCOMPLETE_KINDS`)
+    for the router of *rd_manager*, built once per snapshot version (and
+    version of the devices in the database, or of the catalogs).
+    """
+    catalog = None
+    if kind in ("protocol", "domain_group"):
+        # Got (or fetched) first, so that the catalog version below is that
+        # of this catalog
+        catalog = getattr(rd_manager, f"{kind}_catalog")
+
+    version = DEFAULT_CACHE.get(rd_manager.snapshot_version_cache_key)
+    if version is not None:
+        if kind == "device":
+            # The names of the devices come from the database
+            version = (version, DEFAULT_CACHE.get(
+                get_device_table_version_cache_key(rd_manager.router_id)))
+        elif catalog is not None:
+            # The catalogs are fetched apart from the snapshot
+            version = (version, DEFAULT_CACHE.get(
+                rd_manager.catalog_version_cache_key))
+    cache_key = (rd_manager.router_id, kind)
+
+    index = index_cache.get(cache_key, version)
+    if index is None:
+        if kind == "device":
+            index = build_device_index(rd_manager)
+        elif kind == "mac_group":
+            index = build_mac_group_index(rd_manager)
+        elif catalog is not None:
+            index = build_name_index(catalog)
+        else:
+            raise ValueError(f"Unknown kind: {kind}")
+        index_cache.set(cache_key, version, index)
+    return index
+
+
+def get_page_size():
+    return getattr(settings, "BEHAVIORAL_CONTROL_AUTOCOMPLETE_PAGE_SIZE", 20)
+
+
+def search_items(rd_manager, kind, query, page=1):
+    """
+    Return a page of the items of *kind* matching *query*, in the format
+    expected by select2::
+
+        {"results": [{"id": ..., "text": ...}], "pagination": {"more": bool}}
+    """
+    page_size = get_page_size()
+    page = max(int(page or 1), 1)
+
+    matched = get_prefix_index(rd_manager, kind).search(query)
+    start = (page - 1) * page_size
+    return {
+        "results": [
+            {"id": value, "text": text}
+            for value, text in matched[start:start + page_size]],
+        "pagination": {"more": len(matched) > start + page_size},
+    }
@@ -0,0 +1,189 @@
+"""
+Changes applied to many devices or rules of a router at once.
+
+Instead of saving devices one by one (each with its queries and signal
+work) and fetching the router after each change, the database is updated
+with a single ``bulk_update``, the router mutations are batched, and the
+router is refreshed once.
+"""
+
+from django.utils.translation import gettext_lazy as _
+
+from my_router.utils import join_row_ids
+
+# action name: (description, keyword arguments of bulk_update_devices)
+BULK_DEVICE_ACTIONS = {
+    "mark_known": (_("Mark as known"), {"known": True}),
+    "mark_unknown": (_("Mark as unknown"), {"known": False}),
+    "ignore": (_("Ignore"), {"ignore": True}),
+    "unignore": (_("Stop ignoring"), {"ignore": False}),
+    "block_mac_by_proto_ctrl": (
+        _("Control MAC via Proto Ctrl"), {"block_mac_by_proto_ctrl": True}),
+    "unblock_mac_by_proto_ctrl": (
+        _("Stop controlling MAC via Proto Ctrl"),
+        {"block_mac_by_proto_ctrl": False}),
+    "reject": (_("Block"), {"reject": True}),
+    "unreject": (_("Unblock"), {"reject": False}),
+}
+
+# Actions which need the names of mac groups
+BULK_DEVICE_MAC_GROUP_ACTIONS = {
+    "join_mac_groups": _("Join mac groups"),
+    "leave_mac_groups": _("Leave mac groups"),
+}
+
+
+class BulkUpdateError(Exception):
+    """
+    A router mutation of :func:`bulk_update_devices` failed with *error*.
+    The database changes and the mutations in *applied* were done, those in
+    *not_applied* were not.
+    """
+
+    def __init__(self, error, applied, not_applied):
+        self.error = error
+        self.applied = applied
+        self.not_applied = not_applied
+        super().__init__(
+            _("{error}. Applied: {applied}. Not applied: {not_applied}.").format(
+                error=f"{type(error).__name__}: {error}",
+                applied=", ".join(str(d) for d in applied) or "-",
+                not_applied=", ".join(str(d) for d in not_applied)))
+
+
+def get_bulk_device_action_kwargs(action, mac_groups=()):
+    """
+    Return the keyword arguments of :func:`bulk_update_devices` for
+    *action*, or raise ValueError if it is unknown.
+    """
+    if action in BULK_DEVICE_ACTIONS:
+        return dict(BULK_DEVICE_ACTIONS[action][1])
+    if action in BULK_DEVICE_MAC_GROUP_ACTIONS:
+        return {action: list(mac_groups)}
+    raise ValueError(f"Unknown action: {action}")
+
+
+def bulk_update_devices(router, devices, known=None, ignore=None,
+                        block_mac_by_proto_ctrl=None, reject=None,
+                        join_mac_groups=(), leave_mac_groups=()):
+    """
+    Apply the same changes to *devices* (instances or a queryset of Device)
+    of *router*. Values which are None are left unchanged.
+
+    Return the names of the mac groups which were not left because they
+    would become empty. Raise :exc:`BulkUpdateError` if the router failed.
+    """
+    from my_router.data_manager import get_rd_manager_from_snapshot
+    from my_router.models import Device
+    from my_router.receivers import schedule_router_refresh
+
+    devices = list(devices)
+    if not devices:
+        return []
+
+    macs = [device.mac for device in devices]
+
+    db_changes = {
+        name: value for name, value in (
+            ("known", known),
+            ("ignore", ignore),
+            ("block_mac_by_proto_ctrl", block_mac_by_proto_ctrl))
+        if value is not None}
+
+    # Like the post_save receiver of Device, which bulk_update bypasses
+    released_macs = []
+    if block_mac_by_proto_ctrl is False:
+        released_macs = [
+            device.mac for device in devices if device.block_mac_by_proto_ctrl]
+
+    for device in devices:
+        for name, value in db_changes.items():
+            setattr(device, name, value)
+
+    # The database changes are committed first, then the router mutations
+    # are applied one by one: those applied before a router failure can't
+    # be rolled back, they are reported by BulkUpdateError instead.
+    applied = []
+    if db_changes:
+        Device.objects.bulk_update(devices, list(db_changes))
+        applied.append(_("Saving the devices"))
+
+    skipped_groups = []
+    rd_manager = None
+
+    def release_acl_macs():
+        rd_manager.remove_acl_macs_of_devices(released_macs, active_only=True)
+
+    def set_reject():
+        if reject:
+            rd_manager.add_acl_mac_rules(macs)
+        else:
+            rd_manager.remove_acl_macs_of_devices(macs)
+        # The devices might be offline
+        rd_manager.update_devices_cache_info_attrs(macs, reject=int(reject))
+
+    def edit_mac_groups():
+        skipped_groups.extend(rd_manager.edit_mac_group_members(
+            macs, join_groups=set(join_mac_groups),
+            leave_groups=set(leave_mac_groups)))
+
+    mutations = []
+    if released_macs:
+        mutations.append(
+            (_("Removing the acl_mac entries of the devices"), release_acl_macs))
+    if reject is not None:
+        mutations.append((_("Block") if reject else _("Unblock"), set_reject))
+    if join_mac_groups or leave_mac_groups:
+        mutations.append((_("Editing the mac groups"), edit_mac_groups))
+
+    if mutations:
+        # The mac groups and the acl_mac entries are edited from their
+        # current state on the router, not from the snapshot
+        rd_manager = get_rd_manager_from_snapshot(router)
+        rd_manager.reload_edit_data()
+
+    try:
+        for i, (description, mutate) in enumerate(mutations):
+            try:
+                mutate()
+            except Exception as e:
+                raise BulkUpdateError(
+                    e, applied, [d for d, _mutate in mutations[i:]]) from e
+            applied.append(description)
+    finally:
+        # Also after a failure, the router might be partly changed
+        if mutations or "block_mac_by_proto_ctrl" in db_changes:
+            schedule_router_refresh(router.id)
+
+    return skipped_groups
+
+
+# kind: the method of the router client deleting the rules of that kind
+RULE_DELETE_METHODS = {
+    "acl_l7": "del_acl_l7",
+    "domain_blacklist": "del_domain_blacklist",
+    "mac_group": "del_mac_group",
+}
+
+
+def bulk_delete_rules(router, kind, rule_ids):
+    """
+    Delete the rules of *kind* with ids *rule_ids* from *router* in a single
+    call, then fetch again only the rules of that kind (or the whole router
+    if nothing is cached yet).
+    """
+    from my_router.data_manager import RouterDataManager
+    from my_router.receivers import schedule_router_refresh
+
+    rule_ids = [int(rule_id) for rule_id in rule_ids]
+    if not rule_ids:
+        return
+
+    rd_manager = RouterDataManager(router_instance=router)
+    delete = getattr(rd_manager.ikuai_client, RULE_DELETE_METHODS[kind])
+    delete(join_row_ids(rule_ids))
+
+    if rd_manager.get_snapshot_age() is None:
+        schedule_router_refresh(router.id)
+    else:
+        rd_manager.refresh_rules(kind)
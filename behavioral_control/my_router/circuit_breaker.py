@@ -0,0 +1,124 @@
+import requests
+from django.conf import settings
+from pyikuai.exceptions import RequestError
+
+from my_router import logger
+from my_router.client_pool import ClientCallProxy
+from my_router.constants import DEFAULT_CACHE
+from my_router.utils import (get_circuit_cool_down_cache_key,
+                             get_circuit_failures_cache_key,
+                             get_circuit_probe_cache_key)
+
+# Errors meaning that the router can not be reached, API errors such as
+# invalid parameters do not trip the circuit.
+ROUTER_UNREACHABLE_ERRORS = (requests.RequestException, RequestError)
+
+
+class RouterUnavailable(Exception):
+    pass
+
+
+class RouterCircuitBreaker:
+    """
+    A circuit breaker for the API calls to one router.
+
+    After ``failure_threshold`` consecutive failures the circuit opens and
+    calls fail fast with :exc:`RouterUnavailable` instead of blocking until
+    a network timeout. Once ``cool_down`` seconds have passed, a single
+    probe (see :meth:`acquire_probe`) is allowed, and the circuit is closed
+    when it succeeds.
+
+    The state is kept in the default cache, thus shared by all the workers.
+    """
+
+    def __init__(self, router_id, failure_threshold=None, cool_down=None):
+        self.router_id = router_id
+
+        if failure_threshold is None:
+            failure_threshold = getattr(
+                settings, "BEHAVIORAL_CONTROL_ROUTER_CIRCUIT_FAILURE_THRESHOLD",
+                3)
+        if cool_down is None:
+            cool_down = getattr(
+                settings, "BEHAVIORAL_CONTROL_ROUTER_CIRCUIT_COOL_DOWN", 60)
+
+        self.failure_threshold = failure_threshold
+        self.cool_down = cool_down
+
+        self.failures_cache_key = get_circuit_failures_cache_key(router_id)
+        self.cool_down_cache_key = get_circuit_cool_down_cache_key(router_id)
+        self.probe_cache_key = get_circuit_probe_cache_key(router_id)
+
+    def get_failures(self):
+        return DEFAULT_CACHE.get(self.failures_cache_key, 0)
+
+    def is_open(self, failures=None):
+        if failures is None:
+            failures = self.get_failures()
+        return failures >= self.failure_threshold
+
+    def is_cooling_down(self):
+        return DEFAULT_CACHE.get(self.cool_down_cache_key) is not None
+
+    def acquire_probe(self):
+        """
+        Return True if the caller is allowed to probe the open circuit, that
+        is, the cool-down has passed and no one else is probing.
+        """
+        if self.is_cooling_down():
+            return False
+        return DEFAULT_CACHE.add(
+            self.probe_cache_key, True, timeout=self.cool_down)
+
+    def record_success(self):
+        DEFAULT_CACHE.delete_many([
+            self.failures_cache_key, self.cool_down_cache_key,
+            self.probe_cache_key])
+
+    def record_failure(self):
+        DEFAULT_CACHE.add(self.failures_cache_key, 0, timeout=None)
+        failures = DEFAULT_CACHE.incr(self.failures_cache_key)
+
+        if self.is_open(failures):
+            if failures == self.failure_threshold:
+                logger.warning(
+                    f"Router {self.router_id} is unreachable, circuit opened "
+                    f"after {failures} failures")
+            DEFAULT_CACHE.set(
+                self.cool_down_cache_key, True, timeout=self.cool_down)
+            DEFAULT_CACHE.delete(self.probe_cache_key)
+
+    def call(self, func, *args, probe=False, **kwargs):
+        failures = self.get_failures()
+        if not probe and self.is_open(failures):
+            raise RouterUnavailable(
+                f"Router {self.router_id} is unreachable, "
+                "remote calls are suspended")
+
+        try:
+            result = func(*args, **kwargs)
+        except ROUTER_UNREACHABLE_ERRORS:
+            self.record_failure()
+            raise
+
+        if failures or probe:
+            self.record_success()
+        return result
+
+
+class CircuitBreakerClient(ClientCallProxy):
+    """
+    Wraps an IKuaiClient so that each of its API calls goes through the
+    circuit breaker of the router.
+    """
+
+    def __init__(self, client, breaker):
+        super().__init__(client)
+        self._breaker = breaker
+
+    def call(self, name, func, *args, **kwargs):
+        return self._breaker.call(func, *args, **kwargs)
+
+    def probe(self):
+        # A cheap call which closes the circuit if the router answers again.
+        return self._breaker.call(self._client.get_sysstat, probe=True)
@@ -0,0 +1,86 @@
+import functools
+import threading
+from threading import Lock
+
+
+class RouterClientPool:
+    """
+    A pool of iKuai clients, one per router in each thread of the process.
+
+    An :class:`pyikuai.IKuaiClient` logs in lazily, keeps its requests session
+    (and thus keep-alive connections) and logs in again by itself when the
+    router drops the login. Reusing an instance across the tasks and
+    requests served by a thread saves a login and a TCP/TLS handshake per
+    poll. The instances are not shared between threads, since their
+    session and login are not locked: threads logging in again at the same
+    time would replace each other's session. The pooled clients are
+    replaced when the connection settings of the router change.
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+        self._lock = Lock()
+
+        # Bumped by discard() and clear(), so that the clients of all the
+        # threads are replaced, not only those of the calling thread.
+        self._generations = {}
+        self._epoch = 0
+
+    def _get_clients(self):
+        if getattr(self._local, "epoch", None) != self._epoch:
+            self._local.clients = {}
+            self._local.epoch = self._epoch
+        return self._local.clients
+
+    def get(self, router_id, credentials, create_client):
+        with self._lock:
+            clients = self._get_clients()
+            generation = self._generations.get(router_id, 0)
+
+        key = (credentials, generation)
+        entry = clients.get(router_id)
+        if entry is not None and entry[0] == key:
+            return entry[1]
+
+        client = create_client()
+        clients[router_id] = (key, client)
+        return client
+
+    def discard(self, router_id):
+        with self._lock:
+            self._generations[router_id] = (
+                self._generations.get(router_id, 0) + 1)
+
+    def clear(self):
+        with self._lock:
+            self._epoch += 1
+            self._generations.clear()
+
+
+client_pool = RouterClientPool()
+
+
+class ClientCallProxy:
+    """
+    Base class of the wrappers around an IKuaiClient, :meth:`call` is
+    invoked with the method name for each API call (public methods except
+    the validators), other attributes are passed through.
+    """
+
+    def __init__(self, client):
+        self._client = client
+
+    def call(self, name, func, *args, **kwargs):
+        raise NotImplementedError
+
+    def __getattr__(self, name):
+        attr = getattr(self._client, name)
+        if (not callable(attr)
+                or name.startswith("_") or name.startswith("validate_")):
+            return attr
+
+        @functools.wraps(attr)
+        def proxied_call(*args, **kwargs):
+            return self.call(name, attr, *args, **kwargs)
+
+        return proxied_call
@@ -0,0 +1,190 @@
+"""
+A compact encoding of the router data stored in the cache.
+
+Lists of dicts sharing the same keys, like the rows returned by the router,
+are stored as a table (the keys once, then the values of each row), packed
+with msgpack (or pickle for values msgpack can't decode as they were), and
+compressed with zstd above a size threshold::
+
+    [{"id": 1, "mac": "..."}, {"id": 2, "mac": "..."}]
+    -> {ROWS_KEY: [["id", "mac"], [[1, "..."], [2, "..."]]]}
+
+Encoded values start with :data:`MAGIC`, values which are not (e.g. written
+by an older version, or by another writer) are returned as is.
+"""
+
+import pickle
+import zlib
+
+from django.conf import settings
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+MAGIC = b"BC\x01"
+
+ROWS_KEY = "\x00rows"
+
+# Second byte of the header: how the payload is packed
+PACKER_MSGPACK = b"m"
+PACKER_PICKLE = b"p"
+
+# Third byte of the header: how the packed payload is compressed
+COMPRESSION_NONE = b"-"
+COMPRESSION_ZLIB = b"z"
+COMPRESSION_ZSTD = b"s"
+
+
+def pack_rows(value):
+    """
+    Return *value* with the lists of dicts having the same keys turned into
+    tables, recursively.
+    """
+    if isinstance(value, dict):
+        return {k: pack_rows(v) for k, v in value.items()}
+
+    if isinstance(value, list):
+        if (len(value) > 1
+                and all(isinstance(row, dict) for row in value)):
+            keys = list(value[0])
+            if all(list(row) == keys for row in value[1:]):
+                return {ROWS_KEY: [
+                    keys,
+                    [[pack_rows(v) for v in row.values()] for row in value]]}
+        return [pack_rows(v) for v in value]
+
+    return value
+
+
+def unpack_rows(value):
+    if isinstance(value, dict):
+        if len(value) == 1 and ROWS_KEY in value:
+            keys, rows = value[ROWS_KEY]
+            return [
+                dict(zip(keys, [unpack_rows(v) for v in row])) for row in rows]
+        return {k: unpack_rows(v) for k, v in value.items()}
+
+    if isinstance(value, list):
+        return [unpack_rows(v) for v in value]
+
+    return value
+
+
+# The types which msgpack decodes as they were encoded. Others, e.g.,
+# datetimes, sets or tuples, are pickled.
+MSGPACK_SCALAR_TYPES = (str, int, float, bool, bytes, type(None))
+
+
+def is_msgpack_native(value):
+    if isinstance(value, MSGPACK_SCALAR_TYPES):
+        return True
+    if isinstance(value, list):
+        return all(is_msgpack_native(v) for v in value)
+    if isinstance(value, dict):
+        return all(
+            isinstance(k, MSGPACK_SCALAR_TYPES) and is_msgpack_native(v)
+            for k, v in value.items())
+    return False
+
+
+def _pack(value):
+    if msgpack is not None and is_msgpack_native(value):
+        try:
+            return PACKER_MSGPACK, msgpack.packb(value, use_bin_type=True)
+        except OverflowError:
+            # Integers over 64 bits
+            pass
+    return PACKER_PICKLE, pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def _compress(data):
+    if zstandard is not None:
+        return COMPRESSION_ZSTD, zstandard.ZstdCompressor().compress(data)
+    return COMPRESSION_ZLIB, zlib.compress(data, 6)
+
+
+def encode_value(value):
+    min_bytes = getattr(
+        settings, "BEHAVIORAL_CONTROL_CACHE_COMPRESS_MIN_BYTES", 1024)
+
+    packer, data = _pack(pack_rows(value))
+    compression = COMPRESSION_NONE
+    if min_bytes is not None and len(data) >= min_bytes:
+        compression, data = _compress(data)
+    return MAGIC + packer + compression + data
+
+
+def decode_value(data):
+    if not isinstance(data, bytes) or not data.startswith(MAGIC):
+        return data
+
+    header_length = len(MAGIC) + 2
+    packer = data[len(MAGIC):len(MAGIC) + 1]
+    compression = data[len(MAGIC) + 1:header_length]
+    data = data[header_length:]
+
+    if compression == COMPRESSION_ZLIB:
+        data = zlib.decompress(data)
+    elif compression == COMPRESSION_ZSTD:
+        data = zstandard.ZstdDecompressor().decompress(data)
+
+    if packer == PACKER_MSGPACK:
+        value = msgpack.unpackb(data, raw=False, strict_map_key=False)
+    else:
+        value = pickle.loads(data)
+    return unpack_rows(value)
+
+
+class EncodedCache:
+    """
+    Wraps a cache so that the values are stored with :func:`encode_value`,
+    unless BEHAVIORAL_CONTROL_CACHE_CODEC is False. Other operations are
+    passed to the wrapped cache.
+    """
+
+    def __init__(self, cache_instance):
+        self._cache = cache_instance
+
+    def __getattr__(self, name):
+        return getattr(self._cache, name)
+
+    @staticmethod
+    def is_enabled():
+        return getattr(settings, "BEHAVIORAL_CONTROL_CACHE_CODEC", True)
+
+    def get(self, key, default=None):
+        value = self._cache.get(key)
+        if value is None:
+            return default
+        return decode_value(value)
+
+    def get_many(self, keys):
+        return {
+            key: decode_value(value)
+            for key, value in self._cache.get_many(keys).items()}
+
+    def set(self, key, value, *args, **kwargs):
+        if self.is_enabled():
+            value = encode_value(value)
+        return self._cache.set(key, value, *args, **kwargs)
+
+    def encode_many(self, data):
+        """
+        The values of *data* as they are stored, for :meth:`set_many_encoded`.
+        """
+        if self.is_enabled():
+            return {key: encode_value(value) for key, value in data.items()}
+        return dict(data)
+
+    def set_many(self, data, *args, **kwargs):
+        return self.set_many_encoded(self.encode_many(data), *args, **kwargs)
+
+    def set_many_encoded(self, data, *args, **kwargs):
+        return self._cache.set_many(data, *args, **kwargs)
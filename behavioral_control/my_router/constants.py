@@ -1,17 +1,27 @@
 import django.core.cache as cache
 from django.utils.translation import gettext_lazy as _
 
+from my_router.codec import EncodedCache
+from my_router.metrics import InstrumentedCache
+
 CACHE_VERSION = 1
-DEFAULT_CACHE = cache.caches["default"]
+
+# Cache operations are counted within fetch cycles, see metrics.
+DEFAULT_CACHE = InstrumentedCache(cache.caches["default"])
+
+# The router data (snapshot lists) is stored compactly, see codec.
+ROUTER_DATA_CACHE = EncodedCache(DEFAULT_CACHE)
 
 ROUTER_DEVICES_CACHE_KEY_PATTERN = "router-instance:{router_id}{cache_version}"
 
 ROUTER_DEVICES_BLOCK_MAC_BY_ACL_L7_CACHE_KEY_PATTERN = (
     "{router_id}:block_mac_by_acl_l7:{cache_version}")
 
-ROUTER_DEVICE_MAC_ADDRESSES_CACHE_KEY_PATTERN = (
-    "{router_id}:mac_addresses:{cache_version}")
-ROUTER_DEVICE_CACHE_KEY_PATTERN = "{router_id}:device:{mac}{cache_version}"
+# A set of the MAC addresses and a hash of MAC address to device record,
+# see device_store.
+ROUTER_KNOWN_MACS_CACHE_KEY_PATTERN = "{router_id}:known_macs:{cache_version}"
+ROUTER_DEVICE_RECORDS_CACHE_KEY_PATTERN = (
+    "{router_id}:device_records:{cache_version}")
 
 DEVICE_DB_CACHE_KEY_PATTERN = "db-cache:{mac}:{cache_version}"
 
@@ -25,6 +35,48 @@ ROUTER_URL_BLACK_LIST_CACHE_KEY_PATTERN = "{router_id}:url_black:{cache_version}
 ROUTER_DOMAIN_BLACKLIST_CACHE_KEY_PATTERN = (
     "{router_id}:domain_black:{cache_version}")
 
+# MAC address to the mac comments / acl_mac entries of the router
+ROUTER_MAC_COMMENT_INDEX_CACHE_KEY_PATTERN = (
+    "{router_id}:mac_comment_index:{cache_version}")
+ROUTER_ACL_MAC_INDEX_CACHE_KEY_PATTERN = (
+    "{router_id}:acl_mac_index:{cache_version}")
+
+# The protocols / domain groups which rules can use, fetched rarely
+ROUTER_PROTOCOL_CATALOG_CACHE_KEY_PATTERN = (
+    "{router_id}:protocol_catalog:{cache_version}")
+ROUTER_DOMAIN_GROUP_CATALOG_CACHE_KEY_PATTERN = (
+    "{router_id}:domain_group_catalog:{cache_version}")
+# Changed with the cached catalogs, for the indexes built from them
+ROUTER_CATALOG_VERSION_CACHE_KEY_PATTERN = (
+    "{router_id}:catalog_version:{cache_version}")
+
+# Changed with the devices of the router in the database, see autocomplete
+ROUTER_DEVICE_TABLE_VERSION_CACHE_KEY_PATTERN = (
+    "{router_id}:device_table_version:{cache_version}")
+
+ROUTER_SNAPSHOT_VERSION_CACHE_KEY_PATTERN = (
+    "{router_id}:snapshot_version:{cache_version}")
+
+ROUTER_SNAPSHOT_FETCHED_AT_CACHE_KEY_PATTERN = (
+    "{router_id}:snapshot_fetched_at:{cache_version}")
+
+# A Redis stream, see events
+ROUTER_EVENTS_CACHE_KEY_PATTERN = "{router_id}:events:{cache_version}"
+
+ROUTER_DEVICE_COMPACTION_LOCK_CACHE_KEY_PATTERN = (
+    "{router_id}:device_compaction_lock:{cache_version}")
+
+ROUTER_CIRCUIT_FAILURES_CACHE_KEY_PATTERN = (
+    "{router_id}:circuit_failures:{cache_version}")
+ROUTER_CIRCUIT_COOL_DOWN_CACHE_KEY_PATTERN = (
+    "{router_id}:circuit_cool_down:{cache_version}")
+ROUTER_CIRCUIT_PROBE_CACHE_KEY_PATTERN = (
+    "{router_id}:circuit_probe:{cache_version}")
+
+# The prefix of the Redis keys of the router call limiter, see rate_limit
+ROUTER_API_LIMITER_CACHE_KEY_PATTERN = (
+    "{router_id}:api_limiter:{cache_version}")
+
 
 class ReadonlyDict(dict):
     # This is a read only dict, but key can be visit via attribute
@@ -54,6 +106,12 @@ class router_status:  # noqa
     disabled = "disabled"
 
 
+class router_call_priority:  # noqa
+    # Lower value is admitted first by the router call limiter
+    interactive = 0
+    background = 10
+
+
 ROUTER_STATUS_CHOICES = (
     (router_status.active, _("Active")),
     (router_status.disabled, _("Disabled")),
@@ -1,12 +1,24 @@
+import hashlib
+import json
+import pickle
+import uuid
 from collections import defaultdict
 from copy import deepcopy
 from datetime import datetime, time, timedelta
+from itertools import chain
 from urllib.parse import urljoin
 
+from django.conf import settings
 from django.utils import timezone
-
-from my_router import logger
-from my_router.constants import DEFAULT_CACHE
+from django.utils.dateparse import parse_datetime
+from pyikuai.exceptions import RouterAPIError
+
+from my_router import logger, metrics
+from my_router.circuit_breaker import (ROUTER_UNREACHABLE_ERRORS,
+                                       RouterCircuitBreaker)
+from my_router.constants import DEFAULT_CACHE, ROUTER_DATA_CACHE
+from my_router.device_store import DEVICE_FINGERPRINT_FIELDS, get_device_store
+from my_router.events import diff_snapshots, publish_events
 from my_router.models import Device
 from my_router.serializers import (AclL7RuleSerializer, DeviceModelSerializer,
                                    DeviceParseSerializer,
@@ -18,15 +30,21 @@ from my_router.serializers import (AclL7RuleSerializer, DeviceModelSerializer,
                                    ResultListMonitorLANIPSerializer,
                                    ResultProtocolRulesSerializer,
                                    ResultURLBlackRulesSerializer)
+from my_router.snapshot import snapshot_cache
 from my_router.utils import (get_acl_l7_list_cache_key,
+                             get_acl_mac_index_cache_key,
                              get_block_mac_by_acl_l7_cache_key,
+                             get_catalog_version_cache_key,
                              get_device_db_cache_key,
                              get_device_list_cache_key,
                              get_domain_blacklist_cache_key,
+                             get_domain_group_catalog_cache_key,
+                             get_mac_comment_index_cache_key,
                              get_mac_groups_cache_key,
-                             get_router_all_devices_mac_cache_key,
-                             get_router_device_cache_key,
-                             get_url_black_list_cache_key)
+                             get_protocol_catalog_cache_key,
+                             get_snapshot_fetched_at_cache_key,
+                             get_snapshot_version_cache_key,
+                             get_url_black_list_cache_key, join_row_ids)
 
 
 class RuleDataFilter:
@@ -282,14 +300,27 @@ class RouterDataManager:
         self.router_id = router_id
 
         self.router_instance = router_instance
-        self.ikuai_client = router_instance.get_client()
+        self._ikuai_client = None
+        self.device_store = get_device_store(router_id)
 
         self._devices = None
         self._device_dict = None
+        self._changed_device_fingerprints = {}
+        self._outdated_device_fingerprints = {}
+        self._departed_macs = set()
+        self._previous_devices = None
+        self._previous_snapshot = None
         self._online_mac_list = None
         self._mac_groups_list = None
         self._mac_groups_map = None
         self._mac_groups_map_reverse = None
+        self._rules_by_group = None
+        self._rule_id_maps = None
+        self._mac_comment_index = None
+        self._acl_mac_index = None
+        self._mac_indexes_from_cache = True
+        self._protocol_catalog = None
+        self._domain_group_catalog = None
         self._acl_l7_list = None
         self._url_black_list = None
         self._domain_black_list = None
@@ -297,61 +328,205 @@ class RouterDataManager:
 
         # {{{ cache_keys
         self.device_list_cache_key = get_device_list_cache_key(router_id)
-        self.all_mac_cache_key = get_router_all_devices_mac_cache_key(router_id)
         self.url_black_list_cache_key = get_url_black_list_cache_key(router_id)
         self.mac_groups_cache_key = get_mac_groups_cache_key(router_id)
         self.acl_l7_list_cache_key = get_acl_l7_list_cache_key(router_id)
         self.domain_blacklist_cache_key = get_domain_blacklist_cache_key(router_id)
         self.macs_block_mac_by_acl_l7_cache_key = (
             get_block_mac_by_acl_l7_cache_key(router_id))
+        self.snapshot_version_cache_key = get_snapshot_version_cache_key(router_id)
+        self.snapshot_fetched_at_cache_key = (
+            get_snapshot_fetched_at_cache_key(router_id))
+        self.mac_comment_index_cache_key = (
+            get_mac_comment_index_cache_key(router_id))
+        self.acl_mac_index_cache_key = get_acl_mac_index_cache_key(router_id)
+        self.protocol_catalog_cache_key = (
+            get_protocol_catalog_cache_key(router_id))
+        self.domain_group_catalog_cache_key = (
+            get_domain_group_catalog_cache_key(router_id))
+        self.catalog_version_cache_key = (
+            get_catalog_version_cache_key(router_id))
         # }}}
 
         self.is_initialized_from_cached_data = False
 
+        # The version of the snapshot loaded by init_data_from_cache
+        self.loaded_snapshot_version = None
+
+    @property
+    def ikuai_client(self):
+        # Only created when the router is actually called, read-only paths
+        # which are initialized from cache never need it.
+        if self._ikuai_client is None:
+            self._ikuai_client = self.router_instance.get_client()
+        return self._ikuai_client
+
     def reset_property_cache(self):
         self._devices = None
         self._device_dict = None
+        self._changed_device_fingerprints = {}
+        self._outdated_device_fingerprints = {}
+        self._departed_macs = set()
+        self._previous_devices = None
+        self._previous_snapshot = None
         self._online_mac_list = None
         self._mac_groups_list = None
         self._mac_groups_map = None
         self._mac_groups_map_reverse = None
+        self._rules_by_group = None
+        self._rule_id_maps = None
+        self._mac_comment_index = None
+        self._acl_mac_index = None
         self._acl_l7_list = None
         self._url_black_list = None
         self._domain_black_list = None
         self._macs_block_mac_by_acl_l7 = None
 
+    @property
+    def snapshot_cache_keys(self):
+        # Maps the cache key of each list in the snapshot to the instance
+        # attribute holding it.
+        return {
+            self.device_list_cache_key: "_devices",
+            self.url_black_list_cache_key: "_url_black_list",
+            self.mac_groups_cache_key: "_mac_groups_list",
+            self.acl_l7_list_cache_key: "_acl_l7_list",
+            self.domain_blacklist_cache_key: "_domain_black_list",
+            self.macs_block_mac_by_acl_l7_cache_key: "_macs_block_mac_by_acl_l7",
+        }
+
+    def load_snapshot_from_cache(self):
+        cached = ROUTER_DATA_CACHE.get_many(list(self.snapshot_cache_keys))
+        return {
+            attr: cached.get(key, [])
+            for key, attr in self.snapshot_cache_keys.items()}
+
+    def remember_previous_snapshot(self):
+        # The cached snapshot, before any of its lists is replaced by this
+        # instance, to publish the changes (see cache_all_data).
+        if self._previous_snapshot is None:
+            self._previous_snapshot = self.load_snapshot_from_cache()
+        return self._previous_snapshot
+
+    def cache_snapshot_list(self, cache_key, value):
+        self.remember_previous_snapshot()
+        ROUTER_DATA_CACHE.set(cache_key, value)
+
     def init_data_from_cache(self):
-        self._devices = DEFAULT_CACHE.get(self.device_list_cache_key, [])
-        self._url_black_list = DEFAULT_CACHE.get(self.url_black_list_cache_key, [])
-        self._mac_groups_list = DEFAULT_CACHE.get(self.mac_groups_cache_key, [])
-        self._acl_l7_list = DEFAULT_CACHE.get(self.acl_l7_list_cache_key, [])
-        self._domain_black_list = DEFAULT_CACHE.get(
-            self.domain_blacklist_cache_key, [])
-        self._macs_block_mac_by_acl_l7 = DEFAULT_CACHE.get(
-            self.macs_block_mac_by_acl_l7_cache_key, []
-        )
+        # The version is a digest of the snapshot content, so decoded
+        # snapshots in the process-local LRU stay valid until the router
+        # data actually changes.
+        version = DEFAULT_CACHE.get(self.snapshot_version_cache_key)
+        snapshot = snapshot_cache.get(self.router_id, version)
 
+        if snapshot is None:
+            snapshot = self.load_snapshot_from_cache()
+            snapshot["_rule_id_maps"] = self.get_rule_id_maps(snapshot)
+            snapshot_cache.set(self.router_id, version, snapshot)
+
+        for attr, value in snapshot.items():
+            setattr(self, attr, value)
+
+        self.loaded_snapshot_version = version
         self.is_initialized_from_cached_data = True
 
-    def cache_all_data(self):
+    def cache_all_data(self, update_fetched_at=True):
+        """
+        Cache the snapshot of the router, if it was not loaded from cache.
+        The time of the snapshot (see get_snapshot_age) is left as is if not
+        *update_fetched_at*, i.e., when only a part of it was fetched again.
+        """
         if not self.is_initialized_from_cached_data:
-            DEFAULT_CACHE.set(self.device_list_cache_key, self.devices)
-            DEFAULT_CACHE.set(self.url_black_list_cache_key, self.url_black_list)
-            DEFAULT_CACHE.set(self.mac_groups_cache_key, self.mac_groups_list)
-            DEFAULT_CACHE.set(self.acl_l7_list_cache_key, self.acl_l7_list)
-            DEFAULT_CACHE.set(self.domain_blacklist_cache_key, self.domain_blacklist)
+            snapshot = {
+                self.device_list_cache_key: self.devices,
+                self.url_black_list_cache_key: self.url_black_list,
+                self.mac_groups_cache_key: self.mac_groups_list,
+                self.acl_l7_list_cache_key: self.acl_l7_list,
+                self.domain_blacklist_cache_key: self.domain_blacklist,
+                self.macs_block_mac_by_acl_l7_cache_key:
+                    self.macs_block_mac_by_acl_l7,
+            }
+            # Encoded once, for both the version and the cache
+            encoded_snapshot = ROUTER_DATA_CACHE.encode_many(snapshot)
+            version = self.get_snapshot_version(encoded_snapshot)
+
+            # The previous snapshot, if it changed, to publish the changes.
+            # Its lists in cache are replaced as soon as they are fetched, it
+            # was loaded before, see cache_snapshot_list.
+            previous_version = DEFAULT_CACHE.get(self.snapshot_version_cache_key)
+            previous_snapshot = None
+            if previous_version is not None and previous_version != version:
+                previous_snapshot = (
+                    self._previous_snapshot
+                    or snapshot_cache.get(self.router_id, previous_version)
+                    or self.load_snapshot_from_cache())
+
+            ROUTER_DATA_CACHE.set_many_encoded(encoded_snapshot)
+            self._previous_snapshot = None
+            snapshot_info = {self.snapshot_version_cache_key: version}
+            if update_fetched_at:
+                snapshot_info[self.snapshot_fetched_at_cache_key] = (
+                    timezone.now().timestamp())
+            DEFAULT_CACHE.set_many(snapshot_info)
+
+            if previous_snapshot is not None:
+                publish_events(self.router_id, diff_snapshots(
+                    previous_snapshot,
+                    {attr: snapshot[key]
+                     for key, attr in self.snapshot_cache_keys.items()}))
+
+            labels = {"router": self.router_id}
+            metrics.set_gauge(
+                "snapshot_size_bytes", labels,
+                sum(len(value) for value in encoded_snapshot.values()
+                    if isinstance(value, bytes)))
+            metrics.set_gauge("snapshot_devices", labels, len(self.devices))
+
+    def get_snapshot_age(self):
+        # Seconds since the last snapshot fetched from the router
+        fetched_at = DEFAULT_CACHE.get(self.snapshot_fetched_at_cache_key)
+        if fetched_at is None:
+            return None
+        return max(timezone.now().timestamp() - fetched_at, 0)
+
+    def is_snapshot_stale(self, snapshot_age):
+        # The cached snapshot is still served when the router is unreachable,
+        # but it is marked as stale.
+        if snapshot_age is None:
+            return True
+
+        if RouterCircuitBreaker(self.router_id).is_open():
+            return True
+
+        stale_after_intervals = getattr(
+            settings, "BEHAVIORAL_CONTROL_SNAPSHOT_STALE_AFTER_INTERVALS", 3)
+        return (
+            snapshot_age
+            > self.router_instance.fetch_interval * stale_after_intervals)
+
+    @staticmethod
+    def get_snapshot_version(encoded_snapshot):
+        # A digest of the values as written to the cache (see encode_many),
+        # which are only pickled here if the codec is disabled.
+        digest = hashlib.blake2b(digest_size=16)
+        for value in encoded_snapshot.values():
+            if not isinstance(value, bytes):
+                value = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+            digest.update(len(value).to_bytes(8, "big"))
+            digest.update(value)
+        return digest.hexdigest()
 
     def purge_local_cache_and_update_devices(self):
         # removed data cached in the instance
         self._devices = None
         return self.devices
 
-    def update_device_db_instances(self):
-        for device_info in self.devices:
-            json_serializer = DeviceParseSerializer(data=device_info)
-            json_serializer.is_valid(raise_exception=True)
-            device_info_data = json_serializer.data
+    def update_device_db_instances(self, devices=None):
+        # Devices were validated when parsed, see parse_devices.
+        if devices is None:
+            devices = self.devices
 
+        for device_info_data in devices:
             mac = device_info_data["mac"]
             model_data = {"mac": mac}
 
@@ -377,20 +552,113 @@ class RouterDataManager:
                 # the update.
                 cached_device_name = DEFAULT_CACHE.get(get_device_db_cache_key(mac))
                 if name and name != cached_device_name:
-                    d_serializer.update(instance, d_serializer.data)
+                    d_serializer.update(instance, d_serializer.validated_data)
+
+    @staticmethod
+    def get_device_fingerprint(device_json):
+        # Digest of the fields of a monitor_lanip row which are kept
+        values = [device_json.get(k) for k in DEVICE_FINGERPRINT_FIELDS]
+        return hashlib.blake2b(
+            json.dumps(values, default=str).encode(), digest_size=8).hexdigest()
+
+    def list_all_monitor_lanip(self):
+        """
+        Return all the rows of list_monitor_lanip, whose default limit is the
+        first 100 devices. The rows over the first page are fetched in one
+        more call.
+        """
+        page_size = getattr(
+            settings, "BEHAVIORAL_CONTROL_DEVICE_FETCH_PAGE_SIZE", 1000)
+        devices_json = self.ikuai_client.list_monitor_lanip(
+            limit=[0, page_size])
+        rows = devices_json.get("data") or []
+        total = devices_json.get("total") or 0
+        if total <= len(rows):
+            return devices_json
+
+        rest = self.ikuai_client.list_monitor_lanip(limit=[len(rows), total])
+
+        # Devices might have come or gone between the calls
+        rows_by_mac = {}
+        for row in rows + (rest.get("data") or []):
+            rows_by_mac.setdefault(row.get("mac"), row)
+        return dict(devices_json, data=list(rows_by_mac.values()))
+
+    @staticmethod
+    def is_last_seen_outdated(last_seen, now):
+        # The last_seen of online devices is refreshed at this interval, not
+        # at each fetch, so that unchanged devices are seldom written.
+        interval = getattr(
+            settings, "BEHAVIORAL_CONTROL_DEVICE_LAST_SEEN_INTERVAL", 600)
+        if isinstance(last_seen, str):
+            last_seen = parse_datetime(last_seen)
+        return last_seen is None or (now - last_seen).total_seconds() >= interval
+
+    def parse_devices(self, devices_json):
+        """
+        Return the validated devices of a list_monitor_lanip result, a dict
+        mapping the MAC addresses of the new or changed devices to their
+        fingerprints, and the same for the unchanged devices whose last_seen
+        is outdated. Devices whose fingerprint is the one in their cached
+        record are taken from the record without validation.
+        """
+        rows = devices_json.get("data") or []
+        macs = [str(row.get("mac", "")).replace("-", ":") for row in rows]
+        fingerprints = [self.get_device_fingerprint(row) for row in rows]
+        records = self.device_store.get_records(macs) if macs else {}
+        now = timezone.now()
+
+        devices = []
+        changed_indexes = []
+        outdated_fingerprints = {}
+        for i, (mac, fingerprint) in enumerate(zip(macs, fingerprints)):
+            record = records.get(mac)
+            if record is not None and record.get("fingerprint") == fingerprint:
+                if self.is_last_seen_outdated(record.get("last_seen"), now):
+                    outdated_fingerprints[mac] = fingerprint
+                device = {
+                    k: v for k, v in record.items() if k != "fingerprint"}
+                # As validated by DeviceParseSerializer
+                device.update(online=None, last_seen=None)
+                devices.append(device)
+            else:
+                devices.append(None)
+                changed_indexes.append(i)
+
+        serializer = ResultListMonitorLANIPSerializer(data={
+            "total": devices_json.get("total"),
+            "data": [rows[i] for i in changed_indexes]})
+        serializer.is_valid(raise_exception=True)
+
+        changed_fingerprints = {}
+        for i, device in zip(changed_indexes, serializer.data["data"]):
+            devices[i] = dict(device)
+            changed_fingerprints[device["mac"]] = fingerprints[i]
+
+        return devices, changed_fingerprints, outdated_fingerprints
 
     @property
     def devices(self):
         if self._devices is None:
-            devices_json = self.ikuai_client.list_monitor_lanip()
-            serializer = ResultListMonitorLANIPSerializer(data=devices_json)
-            serializer.is_valid(raise_exception=True)
-
-            # fixme: default number of devices is maximum 100
-            self._devices = serializer.data["data"]
-
-            self.update_device_db_instances()
-            DEFAULT_CACHE.set(self.device_list_cache_key, self._devices)
+            with metrics.time_stage(self.router_id, "device_fetch"):
+                devices_json = self.list_all_monitor_lanip()
+                (self._devices, self._changed_device_fingerprints,
+                 self._outdated_device_fingerprints) = (
+                    self.parse_devices(devices_json))
+
+            # Devices online at the previous fetch but not any more
+            self._previous_devices = (
+                self.remember_previous_snapshot()["_devices"] or [])
+            self._departed_macs = (
+                {d["mac"] for d in self._previous_devices}
+                - {d["mac"] for d in self._devices})
+
+            changed_devices = [
+                d for d in self._devices
+                if d["mac"] in self._changed_device_fingerprints]
+            with metrics.time_stage(self.router_id, "db_sync"):
+                self.update_device_db_instances(changed_devices)
+            self.cache_snapshot_list(self.device_list_cache_key, self._devices)
 
         return self._devices
 
@@ -415,7 +683,7 @@ class RouterDataManager:
                 block_mac_by_proto_ctrl=True).values_list("mac", flat=True))
             self._macs_block_mac_by_acl_l7 = ret
 
-            DEFAULT_CACHE.set(
+            self.cache_snapshot_list(
                 self.macs_block_mac_by_acl_l7_cache_key, ret)
         return self._macs_block_mac_by_acl_l7
 
@@ -423,38 +691,63 @@ class RouterDataManager:
     def online_mac_list(self):
         return list(self.device_dict.keys())
 
-    def get_device_cache_key(self, mac):
-        return get_router_device_cache_key(self.router_id, mac)
-
     def get_cached_all_mac(self):
-        return DEFAULT_CACHE.get(self.all_mac_cache_key, set())
+        return self.device_store.get_macs()
 
     def update_all_mac_cache(self):
-        all_cached_macs = self.get_cached_all_mac()
-        all_cached_macs = all_cached_macs | set(self.online_mac_list)
-
-        for mac in all_cached_macs:
+        for mac in self.online_mac_list:
             assert isinstance(mac, str)
 
-        DEFAULT_CACHE.set(self.all_mac_cache_key, all_cached_macs)
+        self.device_store.add_macs(self.online_mac_list)
 
     def get_cached_device_info(self, mac):
-        return DEFAULT_CACHE.get(self.get_device_cache_key(mac))
+        return self.device_store.get_record(mac)
+
+    @staticmethod
+    def validate_device_record(info):
+        # Device records are validated when written, so that they are used
+        # as is when read, e.g., when merging offline devices.
+        serializer = DeviceParseSerializer(data=info)
+        serializer.is_valid(raise_exception=True)
 
     def cache_device_info(self, mac, info):
-        DEFAULT_CACHE.set(self.get_device_cache_key(mac), info)
+        self.validate_device_record(info)
+        self.device_store.set_records({mac: info})
 
     def update_device_cache_info_attrs(self, mac, **kwargs):
-        info = self.get_cached_device_info(mac)
-        info.update(kwargs)
-        self.cache_device_info(mac, info)
+        self.update_devices_cache_info_attrs([mac], **kwargs)
+
+    def update_devices_cache_info_attrs(self, macs, **kwargs):
+        # Devices which were never cached are skipped
+        records = self.device_store.get_records(macs)
+        for info in records.values():
+            info.update(kwargs)
+            self.validate_device_record(info)
+        self.device_store.set_records(records)
 
-    # todo: remove single cached device
     def cache_each_device_info(self):
+        # Only new or changed devices, and online devices whose last_seen is
+        # outdated, are cached, with their fingerprint. The last_seen of
+        # devices which went offline is then updated.
         if not self.is_initialized_from_cached_data:
-            for mac, device_info in deepcopy(self.device_dict).items():
-                device_info["last_seen"] = timezone.now()
-                self.cache_device_info(mac, device_info)
+            # The devices were validated when parsed, see parse_devices
+            self.device_dict  # noqa
+            last_seen = timezone.now()
+
+            records = {}
+            for mac, fingerprint in chain(
+                    self._changed_device_fingerprints.items(),
+                    self._outdated_device_fingerprints.items()):
+                records[mac] = dict(
+                    self.device_dict[mac], fingerprint=fingerprint,
+                    last_seen=last_seen)
+
+            departed = self.device_store.get_records(self._departed_macs)
+            for record in departed.values():
+                record["last_seen"] = last_seen
+            records.update(departed)
+
+            self.device_store.set_records(records)
 
     @property
     def mac_groups_list(self):
@@ -468,7 +761,8 @@ class RouterDataManager:
             # of the serializer later.
             self._mac_groups_list = serializer.data
 
-            DEFAULT_CACHE.set(self.mac_groups_cache_key, self._mac_groups_list)
+            self.cache_snapshot_list(
+                self.mac_groups_cache_key, self._mac_groups_list)
 
         return self._mac_groups_list
 
@@ -497,7 +791,8 @@ class RouterDataManager:
             serializer.is_valid(raise_exception=True)
             self._acl_l7_list = serializer.data["data"]
 
-            DEFAULT_CACHE.set(self.acl_l7_list_cache_key, self._acl_l7_list)
+            self.cache_snapshot_list(
+                self.acl_l7_list_cache_key, self._acl_l7_list)
 
         return self._acl_l7_list
 
@@ -511,7 +806,7 @@ class RouterDataManager:
             serializer.is_valid(raise_exception=True)
             self._url_black_list = serializer.data["data"]
 
-            DEFAULT_CACHE.set(
+            self.cache_snapshot_list(
                 self.url_black_list_cache_key, self._url_black_list)
 
         return self._url_black_list
@@ -526,11 +821,92 @@ class RouterDataManager:
             serializer.is_valid(raise_exception=True)
             self._domain_black_list = serializer.data["data"]
 
-            DEFAULT_CACHE.set(
+            self.cache_snapshot_list(
                 self.domain_blacklist_cache_key, self._domain_black_list)
 
         return self._domain_black_list
 
+    # Snapshot attribute holding the rules of each kind
+    rule_list_attrs = {
+        "acl_l7": "_acl_l7_list",
+        "domain_blacklist": "_domain_black_list",
+        "url_black": "_url_black_list",
+    }
+
+    @classmethod
+    def get_rule_id_maps(cls, snapshot):
+        """
+        Return {kind: {id: rule}} for each kind of rules (including
+        "mac_group") of *snapshot*, a dict of snapshot attributes.
+        """
+        ret = {
+            kind: {int(rule["id"]): rule for rule in snapshot.get(attr) or []}
+            for kind, attr in cls.rule_list_attrs.items()}
+
+        mac_groups_list = snapshot.get("_mac_groups_list") or {}
+        ret["mac_group"] = {
+            int(group["id"]): group
+            for group in mac_groups_list.get("data") or []}
+        return ret
+
+    @property
+    def rule_id_maps(self):
+        # Computed once per decoded snapshot (see init_data_from_cache)
+        if self._rule_id_maps is None:
+            self._rule_id_maps = self.get_rule_id_maps({
+                "_acl_l7_list": self.acl_l7_list,
+                "_domain_black_list": self.domain_blacklist,
+                "_url_black_list": self.url_black_list,
+                "_mac_groups_list": self.mac_groups_list,
+            })
+        return self._rule_id_maps
+
+    # Snapshot attributes fetched again when the rules of a kind changed
+    rule_refresh_attrs = {
+        "acl_l7": ("_acl_l7_list",),
+        "domain_blacklist": ("_domain_black_list",),
+        "url_black": ("_url_black_list",),
+        "mac_group": (
+            "_mac_groups_list", "_mac_groups_map", "_mac_groups_map_reverse"),
+    }
+
+    def refresh_rules(self, kind):
+        """
+        Fetch only the rules of *kind* from the router, and cache them with
+        the rest of the cached snapshot, e.g., after the rules were deleted.
+        The snapshot should exist (see get_snapshot_age).
+        """
+        self.init_data_from_cache()
+        self._previous_snapshot = {
+            attr: getattr(self, attr)
+            for attr in self.snapshot_cache_keys.values()}
+        for attr in self.rule_refresh_attrs[kind]:
+            setattr(self, attr, None)
+        self._rules_by_group = None
+        self._rule_id_maps = None
+        self.is_initialized_from_cached_data = False
+
+        # The devices and the other rules are as old as before
+        self.cache_all_data(update_fetched_at=False)
+
+        if kind == "acl_l7":
+            # acl_mac entries follow the acl_l7 rules of the devices
+            self.update_mac_control_rule_from_acl_l7()
+
+    def get_rule_view_data(self, kind, rule_id):
+        """
+        The view data of one rule, as in get_acl_l7_list_data() or
+        get_domain_blacklist_data(). Raise KeyError if there's no such rule.
+        """
+        serializer_class = {
+            "acl_l7": AclL7RuleSerializer,
+            "domain_blacklist": DomainBlackListSerializer,
+        }[kind]
+        serializer = serializer_class(
+            data=deepcopy(self.rule_id_maps[kind][int(rule_id)]))
+        serializer.is_valid(raise_exception=True)
+        return serializer.get_datatable_data(self.router_id)
+
     def get_device_rule_dict(self):
         mac_rule_dict = defaultdict(dict)
         for domain_blacklist in deepcopy(self.domain_blacklist):
@@ -578,26 +954,74 @@ class RouterDataManager:
 
         return dict(mac_rule_dict)
 
-    def get_device_rule_data(self):
-        device_dict = deepcopy(self.device_dict)
+    # (rule kind, attribute holding the rules, field of the rule listing
+    # the mac groups it applies to)
+    rule_group_fields = [
+        ("domain_blacklist", "domain_blacklist", "ipaddr"),
+        ("url_black", "url_black_list", "ip_addr"),
+        ("acl_l7", "acl_l7_list", "src_addr"),
+    ]
 
-        # {{{ include devices which were not online
-        all_macs = list(self.get_cached_all_mac())
+    @property
+    def rules_by_group(self):
+        """
+        An index of the rules by mac group name: {group_name: [(kind,
+        (rule index, position of the group in the rule), rule), ...]}.
+        """
+        if self._rules_by_group is None:
+            ret = defaultdict(list)
+            for kind, attr, field in self.rule_group_fields:
+                for i, rule in enumerate(getattr(self, attr)):
+                    for j, group_name in enumerate(rule[field].split(",")):
+                        ret[group_name].append((kind, (i, j), rule))
+            self._rules_by_group = dict(ret)
+        return self._rules_by_group
+
+    def get_device_rule_dict_for_mac(self, mac):
+        """
+        The value of ``get_device_rule_dict()[mac]`` (an empty dict for
+        devices without rules), resolved from the groups of the device only.
+        """
+        matched = []
+        for group_name in self.mac_groups_reverse.get(mac, ()):
+            matched.extend(self.rules_by_group.get(group_name, ()))
 
-        for mac in all_macs:
-            if mac in self.online_mac_list:
-                continue
+        ret = {}
+        for kind, _, rule in sorted(
+                matched, key=lambda x: (x[0], x[1])):
+            status = "enabled" if rule["enabled"] == "yes" else "disabled"
+            ret.setdefault(kind, {}).setdefault(status, []).append(
+                deepcopy(rule))
+        return ret
 
-            cached_this_device_info = self.get_cached_device_info(mac)
+    def get_device_rule_data_for_mac(self, mac):
+        """
+        The value of ``get_device_rule_data()[mac]``, built for one device.
+        Raise KeyError if the device is neither online nor cached.
+        """
+        if mac in self.device_dict:
+            device_info = deepcopy(self.device_dict[mac])
+        else:
+            device_info = self.device_store.get_record(mac)
+            if device_info is None:
+                raise KeyError(mac)
+            device_info["online"] = False
+
+        device_info.update(self.get_device_rule_dict_for_mac(mac))
+        return self.get_device_list_for_views({mac: device_info})[mac]
 
-            if not cached_this_device_info:
-                continue
+    def get_device_rule_data(self):
+        device_dict = deepcopy(self.device_dict)
 
-            serializer = DeviceParseSerializer(data=cached_this_device_info)
-            serializer.is_valid(raise_exception=True)
+        # {{{ include devices which were not online
+
+        # Records were validated when cached, and are read in one go.
+        offline_macs = self.get_cached_all_mac() - device_dict.keys()
+        offline_device_dict = self.device_store.get_records(offline_macs)
 
+        for mac, cached_this_device_info in offline_device_dict.items():
+            cached_this_device_info["online"] = False
             device_dict[mac] = cached_this_device_info
-            device_dict[mac]["online"] = False
 
         # }}}
 
@@ -765,11 +1189,266 @@ class RouterDataManager:
 
         raise NotImplementedError()
 
-    def get_active_acl_mac_rule_of_device(self, mac):
-        acl_mac_list = self.ikuai_client.list_acl_mac()["data"]
+    @staticmethod
+    def index_by_mac(entries):
+        ret = defaultdict(list)
+        for entry in entries:
+            ret[entry["mac"]].append(entry)
+        return dict(ret)
+
+    def _get_mac_index(self, attr, cache_key, list_method):
+        # Managers initialized from cache use the indexes cached by the
+        # last fetch, the others (i.e. fetch cycles) list and cache them.
+        if getattr(self, attr) is None:
+            index = None
+            if (self.is_initialized_from_cached_data
+                    and self._mac_indexes_from_cache):
+                index = ROUTER_DATA_CACHE.get(cache_key)
+            if index is None:
+                result = getattr(self.ikuai_client, list_method)()
+                index = self.index_by_mac(result.get("data") or [])
+                ROUTER_DATA_CACHE.set(cache_key, index)
+            setattr(self, attr, index)
+        return getattr(self, attr)
+
+    @property
+    def mac_comment_index(self):
+        """
+        {mac: [mac comment entries on the router]}
+        """
+        return self._get_mac_index(
+            "_mac_comment_index", self.mac_comment_index_cache_key,
+            "list_mac_comment")
+
+    @property
+    def acl_mac_index(self):
+        """
+        {mac: [acl_mac entries on the router]}
+        """
+        return self._get_mac_index(
+            "_acl_mac_index", self.acl_mac_index_cache_key, "list_acl_mac")
+
+    def reload_edit_data(self):
+        """
+        In a manager initialized from the snapshot, read again from the
+        router the data which edits of devices are computed from, i.e., the
+        mac groups and the mac indexes, so that edits made since the
+        snapshot are not overwritten.
+        """
+        for attr in self.rule_refresh_attrs["mac_group"]:
+            setattr(self, attr, None)
+        self._rules_by_group = None
+        self._rule_id_maps = None
+        self._mac_comment_index = None
+        self._acl_mac_index = None
+        self._mac_indexes_from_cache = False
+
+    def cache_mac_indexes(self):
+        self._mac_comment_index = None
+        self._acl_mac_index = None
+        return self.mac_comment_index, self.acl_mac_index
+
+    def invalidate_mac_indexes(self):
+        # After the entries are changed on the router
+        self._mac_comment_index = None
+        self._acl_mac_index = None
+        DEFAULT_CACHE.delete_many(
+            [self.mac_comment_index_cache_key, self.acl_mac_index_cache_key])
+
+    @staticmethod
+    def get_protocol_names(protocols_json):
+        """
+        The names in the protocol tree of the router (categories included,
+        since rules can also use them), in the order of the tree.
+        """
+        names = []
+
+        def collect(node):
+            if isinstance(node, dict):
+                if node.get("name"):
+                    names.append(str(node["name"]))
+                for value in node.values():
+                    if isinstance(value, (list, dict)):
+                        collect(value)
+            elif isinstance(node, list):
+                for item in node:
+                    collect(item)
+
+        collect(protocols_json)
+        return list(dict.fromkeys(names))
+
+    def list_domain_group_names(self):
+        """
+        The names of all the domain groups of the router. The groups over
+        the first page are fetched in one more call, like the devices.
+        """
+        page_size = getattr(
+            settings, "BEHAVIORAL_CONTROL_DOMAIN_GROUP_FETCH_PAGE_SIZE", 1000)
+
+        def list_domain_groups(start, stop):
+            # Not wrapped by the client, see QueryRPParam for the param
+            return self.ikuai_client.exec(
+                func_name="domain_group", action="show",
+                param={"TYPE": "total,data", "limit": f"{start},{stop}",
+                       "ORDER_BY": "", "ORDER": ""})["Data"]
+
+        result = list_domain_groups(0, page_size)
+        groups = result.get("data") or []
+        total = result.get("total") or 0
+        if total > len(groups):
+            groups += list_domain_groups(len(groups), total).get("data") or []
+
+        # Groups might have been added or removed between the calls
+        return list(dict.fromkeys(group["group_name"] for group in groups))
+
+    def _get_catalog(self, attr, cache_key, fetch, in_use):
+        # The lists of the router change with its firmware, thus they are
+        # cached for a long time instead of being fetched by each fetch
+        # cycle. Values used by the rules are always included, so that the
+        # rules can be edited even if the list could not be fetched.
+        if getattr(self, attr) is None:
+            catalog = ROUTER_DATA_CACHE.get(cache_key)
+            if catalog is None:
+                try:
+                    catalog = fetch()
+                except (*ROUTER_UNREACHABLE_ERRORS, RouterAPIError) as e:
+                    logger.warning(
+                        f"Router {self.router_id}: failed to fetch the "
+                        f"{attr[1:]}: {type(e).__name__}: {e}")
+                    catalog = []
+                else:
+                    ROUTER_DATA_CACHE.set(
+                        cache_key, catalog,
+                        getattr(settings, "BEHAVIORAL_CONTROL_CATALOG_TIMEOUT",
+                                24 * 60 * 60))
+                    self.touch_catalog_version()
+            setattr(self, attr, list(dict.fromkeys([*catalog, *in_use])))
+        return getattr(self, attr)
+
+    @property
+    def protocol_catalog(self):
+        """
+        The names of the protocols which acl_l7 rules can use.
+        """
+        return self._get_catalog(
+            "_protocol_catalog", self.protocol_catalog_cache_key,
+            lambda: self.get_protocol_names(
+                self.ikuai_client.list_protocols_json()),
+            self.split_rule_values(self.acl_l7_list, "app_proto"))
+
+    @property
+    def domain_group_catalog(self):
+        """
+        The names of the domain groups which domain blacklists can use.
+        """
+        return self._get_catalog(
+            "_domain_group_catalog", self.domain_group_catalog_cache_key,
+            self.list_domain_group_names,
+            self.split_rule_values(self.domain_blacklist, "domain_group"))
+
+    @staticmethod
+    def split_rule_values(rules, key):
+        return [value for rule in rules or []
+                for value in (rule.get(key) or "").split(",") if value]
+
+    def touch_catalog_version(self):
+        # The protocol and domain group indexes of all the processes are
+        # built again, see autocomplete. Not expiring, an expired version
+        # could match the version of an index.
+        DEFAULT_CACHE.set(
+            self.catalog_version_cache_key, uuid.uuid4().hex, timeout=None)
+
+    def invalidate_catalogs(self):
+        self._protocol_catalog = None
+        self._domain_group_catalog = None
+        DEFAULT_CACHE.delete_many(
+            [self.protocol_catalog_cache_key,
+             self.domain_group_catalog_cache_key])
+        self.touch_catalog_version()
+
+    def set_mac_comment(self, mac, comment):
+        """
+        Edit the mac comments of *mac*, or add one if there's none.
+        """
+        entries = self.mac_comment_index.get(mac)
+        if entries:
+            for entry in entries:
+                self.ikuai_client.edit_mac_comment(
+                    mac_comment_id=entry["id"], mac=mac, comment=comment)
+        else:
+            self.ikuai_client.add_mac_comment(mac=mac, comment=comment)
+        self.invalidate_mac_indexes()
+
+    def remove_acl_macs_of_device(self, mac):
+        for entry in self.acl_mac_index.get(mac, ()):
+            self.ikuai_client.del_acl_mac(acl_mac_id=entry["id"])
+        self.invalidate_mac_indexes()
+
+    def remove_acl_macs_of_devices(self, macs, active_only=False):
+        """
+        Delete the acl_mac entries (or only the enabled ones) of *macs* with
+        a single call.
+        """
+        acl_mac_ids = [
+            entry["id"]
+            for mac in macs for entry in self.acl_mac_index.get(mac, ())
+            if not active_only or entry["enabled"] == "yes"]
+        if not acl_mac_ids:
+            return
+        self.ikuai_client.del_acl_mac(acl_mac_id=join_row_ids(acl_mac_ids))
+        self.invalidate_mac_indexes()
+
+    def add_acl_mac_rules(self, macs):
+        # The router has no bulk add, but the indexes are only invalidated
+        # once. Devices which are already blocked are skipped.
+        added = False
+        for mac in macs:
+            if self.get_active_acl_mac_rule_of_device(mac) is None:
+                logger.debug(f"Added acl_mac: {mac}.")
+                self.ikuai_client.add_acl_mac(mac=mac)
+                added = True
+        if added:
+            self.invalidate_mac_indexes()
+
+    def edit_mac_group_members(self, macs, join_groups=(), leave_groups=()):
+        """
+        Add *macs* to the groups in *join_groups* and remove them from the
+        groups in *leave_groups*, with one edit per changed group. Return the
+        names of the groups which were not left because they would become
+        empty.
+        """
+        skipped = []
+        edited = False
+        for info in self.mac_groups_list["data"]:
+            group_name = info["group_name"]
+            addr_pools = [v for v in info["addr_pool"].split(",") if v]
+
+            if group_name in leave_groups:
+                new_addr_pools = [v for v in addr_pools if v not in macs]
+                if not new_addr_pools:
+                    skipped.append(group_name)
+                    continue
+            elif group_name in join_groups:
+                new_addr_pools = addr_pools + [
+                    mac for mac in macs if mac not in addr_pools]
+            else:
+                continue
+
+            if new_addr_pools == addr_pools:
+                continue
+
+            self.ikuai_client.edit_mac_group(
+                group_id=info["id"], group_name=group_name,
+                addr_pools=new_addr_pools)
+            edited = True
+
+        if edited:
+            self.reset_property_cache()
+        return skipped
 
-        for acl_mac in acl_mac_list:
-            if acl_mac["mac"] == mac and acl_mac["enabled"] == "yes":
+    def get_active_acl_mac_rule_of_device(self, mac):
+        for acl_mac in self.acl_mac_index.get(mac, ()):
+            if acl_mac["enabled"] == "yes":
                 return acl_mac
 
         return None
@@ -782,11 +1461,15 @@ class RouterDataManager:
         if active_acl_mac is None:
             return
 
-        return self.ikuai_client.del_acl_mac(acl_mac_id=active_acl_mac["id"])
+        ret = self.ikuai_client.del_acl_mac(acl_mac_id=active_acl_mac["id"])
+        self.invalidate_mac_indexes()
+        return ret
 
     def add_acl_mac_rule(self, data):
         logger.debug(f"Added acl_mac: {data}.")
-        return self.ikuai_client.add_acl_mac(**data)
+        ret = self.ikuai_client.add_acl_mac(**data)
+        self.invalidate_mac_indexes()
+        return ret
 
     def update_mac_control_rule_from_acl_l7_by_time(self, now_datetime=None):
 
@@ -891,3 +1574,15 @@ class RouterDataManager:
 
     def update_mac_control_rule_from_acl_l7(self):
         return self.update_mac_control_rule_from_acl_l7_by_time(timezone.now())
+
+
+def get_rd_manager_from_snapshot(router):
+    """
+    A RouterDataManager initialized from the cached snapshot, if there is
+    one, so that pages are rendered without calling the router. Call
+    :meth:`RouterDataManager.reload_edit_data` before editing the router.
+    """
+    rd_manager = RouterDataManager(router_instance=router)
+    if rd_manager.get_snapshot_age() is not None:
+        rd_manager.init_data_from_cache()
+    return rd_manager
@@ -0,0 +1,204 @@
+import json
+import threading
+
+from django.core.cache import caches
+from django.core.serializers.json import DjangoJSONEncoder
+
+from my_router import metrics
+from my_router.constants import DEFAULT_CACHE
+from my_router.utils import (get_default_redis_connection,
+                             get_router_device_records_cache_key,
+                             get_router_known_macs_cache_key,
+                             omit_redis_exception)
+
+# Fields of DeviceParseSerializer from the monitor_lanip data, the rest
+# (rates, traffic, AP info, etc.) is not kept in the records.
+DEVICE_FINGERPRINT_FIELDS = (
+    "comment", "ip_addr", "client_device", "reject", "mac", "id",
+    "hostname", "client_type")
+
+# Changed by the router at each poll, thus not in the fingerprint: they are
+# as of the last change of the device, its last_seen is refreshed apart.
+DEVICE_VOLATILE_FIELDS = ("uptime", "timestamp")
+
+DEVICE_RECORD_FIELDS = DEVICE_FINGERPRINT_FIELDS + DEVICE_VOLATILE_FIELDS + (
+    "online", "last_seen", "fingerprint")
+
+
+def dump_device_record(info):
+    return json.dumps(
+        {k: v for k, v in info.items() if k in DEVICE_RECORD_FIELDS},
+        cls=DjangoJSONEncoder, separators=(",", ":"))
+
+
+def load_device_record(value):
+    if isinstance(value, bytes):
+        value = value.decode()
+    return json.loads(value)
+
+
+class RouterDeviceStore:
+    """
+    The MAC addresses ever seen on a router, and a compact record of the
+    info of each device.
+
+    This is the fallback used when the default cache is not a Redis cache
+    (e.g., locmem in tests). The set and the records are kept in the default
+    cache under two keys, and updates are serialized within the process.
+    """
+
+    _lock = threading.Lock()
+
+    def __init__(self, router_id):
+        self.router_id = router_id
+        self.known_macs_cache_key = get_router_known_macs_cache_key(router_id)
+        self.records_cache_key = get_router_device_records_cache_key(router_id)
+
+    def get_macs(self):
+        return set(DEFAULT_CACHE.get(self.known_macs_cache_key, set()))
+
+    def add_macs(self, macs):
+        macs = set(macs)
+        if not macs:
+            return
+        with self._lock:
+            DEFAULT_CACHE.set(
+                self.known_macs_cache_key, self.get_macs() | macs)
+
+    def _get_all_records(self):
+        return DEFAULT_CACHE.get(self.records_cache_key, {})
+
+    def get_records(self, macs=None):
+        """
+        Return a dict mapping the MAC addresses to their records, for all
+        devices if *macs* is None. Devices without records are omitted.
+        """
+        records = self._get_all_records()
+        if macs is not None:
+            records = {mac: records[mac] for mac in macs if mac in records}
+        return {mac: load_device_record(v) for mac, v in records.items()}
+
+    def get_record(self, mac):
+        return self.get_records([mac]).get(mac)
+
+    def set_records(self, records):
+        """
+        Save the records of the devices, which are also added to the known
+        MAC addresses.
+        """
+        if not records:
+            return
+        dumped = {mac: dump_device_record(info) for mac, info in records.items()}
+        with self._lock:
+            all_records = self._get_all_records()
+            all_records.update(dumped)
+            DEFAULT_CACHE.set_many({
+                self.records_cache_key: all_records,
+                self.known_macs_cache_key: self.get_macs() | set(records)})
+
+    def update_record(self, mac, **kwargs):
+        info = self.get_record(mac)
+        if info is None:
+            return
+        info.update(kwargs)
+        self.set_records({mac: info})
+
+    def remove(self, macs):
+        macs = set(macs)
+        if not macs:
+            return
+        with self._lock:
+            all_records = {
+                mac: v for mac, v in self._get_all_records().items()
+                if mac not in macs}
+            DEFAULT_CACHE.set_many({
+                self.records_cache_key: all_records,
+                self.known_macs_cache_key: self.get_macs() - macs})
+
+    def clear(self):
+        DEFAULT_CACHE.delete_many(
+            [self.known_macs_cache_key, self.records_cache_key])
+
+
+class RedisRouterDeviceStore(RouterDeviceStore):
+    """
+    Known MAC addresses are a Redis set and the records a Redis hash of
+    MAC address to record, so that concurrent fetches update them
+    atomically and reads are a single round trip.
+    """
+
+    def __init__(self, router_id, connection):
+        super().__init__(router_id)
+        self.connection = connection
+
+        # Same prefix and version as the other keys of the default cache
+        cache_instance = caches["default"]
+        self.known_macs_key = cache_instance.make_key(self.known_macs_cache_key)
+        self.records_key = cache_instance.make_key(self.records_cache_key)
+
+    @omit_redis_exception(return_value=set)
+    def get_macs(self):
+        metrics.count_cache_op()
+        return {
+            mac.decode() if isinstance(mac, bytes) else mac
+            for mac in self.connection.smembers(self.known_macs_key)}
+
+    @omit_redis_exception()
+    def add_macs(self, macs):
+        macs = list(macs)
+        if not macs:
+            return
+        metrics.count_cache_op()
+        self.connection.sadd(self.known_macs_key, *macs)
+
+    @omit_redis_exception(return_value=dict)
+    def get_records(self, macs=None):
+        metrics.count_cache_op()
+        if macs is None:
+            records = self.connection.hgetall(self.records_key)
+            return {
+                mac.decode() if isinstance(mac, bytes) else mac:
+                    load_device_record(value)
+                for mac, value in records.items()}
+
+        macs = list(macs)
+        if not macs:
+            return {}
+        values = self.connection.hmget(self.records_key, macs)
+        return {
+            mac: load_device_record(value)
+            for mac, value in zip(macs, values) if value is not None}
+
+    @omit_redis_exception()
+    def set_records(self, records):
+        if not records:
+            return
+        metrics.count_cache_op()
+        pipe = self.connection.pipeline()
+        pipe.sadd(self.known_macs_key, *records)
+        pipe.hset(self.records_key, mapping={
+            mac: dump_device_record(info) for mac, info in records.items()})
+        pipe.execute()
+
+    @omit_redis_exception()
+    def remove(self, macs):
+        macs = list(macs)
+        if not macs:
+            return
+        metrics.count_cache_op()
+        pipe = self.connection.pipeline()
+        pipe.srem(self.known_macs_key, *macs)
+        pipe.hdel(self.records_key, *macs)
+        pipe.execute()
+
+    @omit_redis_exception()
+    def clear(self):
+        metrics.count_cache_op()
+        self.connection.delete(self.known_macs_key, self.records_key)
+
+
+def get_device_store(router_id):
+    connection = get_default_redis_connection()
+    if connection is None:
+        return RouterDeviceStore(router_id)
+    return RedisRouterDeviceStore(router_id, connection)
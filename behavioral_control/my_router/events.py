@@ -0,0 +1,244 @@
+"""
+Change events between consecutive snapshots of a router.
+
+When a fetch cycle writes a snapshot whose content changed, the differences
+with the previous snapshot are published as compact events, e.g.::
+
+    {"type": "device_online", "mac": "44:a8:bc:43:97:2d"}
+    {"type": "rule_modified", "kind": "acl_l7", "id": 3}
+    {"type": "mac_group_left", "group": "kids", "mac": "44:a8:bc:43:97:2d"}
+
+Events are appended to a Redis stream per router, or to an in-process queue
+when the default cache is not Redis, and are consumed with
+:func:`read_events`.
+"""
+
+import json
+import threading
+import time
+from collections import defaultdict, deque
+
+from django.conf import settings
+from django.core.cache import caches
+
+from my_router import metrics
+from my_router.utils import (get_default_redis_connection,
+                             get_router_events_cache_key, omit_redis_exception)
+
+# Snapshot attribute: the kind of the rules in rule events
+RULE_LISTS = {
+    "_acl_l7_list": "acl_l7",
+    "_domain_black_list": "domain_blacklist",
+    "_url_black_list": "url_black",
+}
+
+
+def get_mac_groups_rows(mac_groups_list):
+    if not mac_groups_list:
+        return []
+    return mac_groups_list.get("data") or []
+
+
+def _diff_rows(kind, old_rows, new_rows):
+    old_by_id = {row["id"]: row for row in old_rows or []}
+    new_by_id = {row["id"]: row for row in new_rows or []}
+
+    events = []
+    for row_id in new_by_id.keys() - old_by_id.keys():
+        events.append({"type": "rule_added", "kind": kind, "id": row_id})
+    for row_id in old_by_id.keys() - new_by_id.keys():
+        events.append({"type": "rule_removed", "kind": kind, "id": row_id})
+    for row_id in new_by_id.keys() & old_by_id.keys():
+        if new_by_id[row_id] != old_by_id[row_id]:
+            events.append({"type": "rule_modified", "kind": kind, "id": row_id})
+    return events
+
+
+def _get_group_members(mac_groups_rows):
+    return {
+        row["group_name"]: {mac for mac in row["addr_pool"].split(",") if mac}
+        for row in mac_groups_rows}
+
+
+def diff_snapshots(old_snapshot, new_snapshot):
+    """
+    Return the events turning *old_snapshot* into *new_snapshot*, both dicts
+    mapping the attributes of :class:`RouterDataManager` to their values
+    (see ``RouterDataManager.snapshot_cache_keys``).
+    """
+    events = []
+
+    old_macs = {d["mac"] for d in old_snapshot.get("_devices") or []}
+    new_macs = {d["mac"] for d in new_snapshot.get("_devices") or []}
+    for mac in sorted(new_macs - old_macs):
+        events.append({"type": "device_online", "mac": mac})
+    for mac in sorted(old_macs - new_macs):
+        events.append({"type": "device_offline", "mac": mac})
+
+    for attr, kind in RULE_LISTS.items():
+        events.extend(
+            _diff_rows(kind, old_snapshot.get(attr), new_snapshot.get(attr)))
+
+    old_groups = get_mac_groups_rows(old_snapshot.get("_mac_groups_list"))
+    new_groups = get_mac_groups_rows(new_snapshot.get("_mac_groups_list"))
+    events.extend(_diff_rows("mac_group", old_groups, new_groups))
+
+    old_members = _get_group_members(old_groups)
+    new_members = _get_group_members(new_groups)
+    for group in sorted(old_members.keys() | new_members.keys()):
+        old = old_members.get(group, set())
+        new = new_members.get(group, set())
+        for mac in sorted(new - old):
+            events.append({"type": "mac_group_joined", "group": group, "mac": mac})
+        for mac in sorted(old - new):
+            events.append({"type": "mac_group_left", "group": group, "mac": mac})
+
+    return events
+
+
+def get_stream_maxlen():
+    return getattr(settings, "BEHAVIORAL_CONTROL_EVENT_STREAM_MAXLEN", 1000)
+
+
+def parse_event_id(event_id):
+    # Event ids are "<milliseconds>-<sequence>", as in Redis streams
+    milliseconds, _, sequence = str(event_id).partition("-")
+    return int(milliseconds), int(sequence or 0)
+
+
+class InProcessEventStream:
+    """
+    The fallback of :class:`RedisEventStream` when the default cache is not
+    Redis. Events are only visible to the process which published them.
+    """
+
+    _queues = defaultdict(deque)
+    _condition = threading.Condition()
+    _last_id = (0, 0)
+
+    def __init__(self, router_id):
+        self.router_id = router_id
+
+    @classmethod
+    def _next_id(cls):
+        milliseconds = int(time.time() * 1000)
+        last_milliseconds, last_sequence = cls._last_id
+        if milliseconds <= last_milliseconds:
+            cls._last_id = (last_milliseconds, last_sequence + 1)
+        else:
+            cls._last_id = (milliseconds, 0)
+        return "%d-%d" % cls._last_id
+
+    def publish(self, events):
+        with self._condition:
+            queue = self._queues[self.router_id]
+            for event in events:
+                queue.append((self._next_id(), event))
+            while len(queue) > get_stream_maxlen():
+                queue.popleft()
+            self._condition.notify_all()
+
+    def _read(self, last_id, count):
+        last = parse_event_id(last_id)
+        ret = [
+            (event_id, event) for event_id, event in self._queues[self.router_id]
+            if parse_event_id(event_id) > last]
+        return ret[:count] if count else ret
+
+    def get_last_id(self):
+        with self._condition:
+            queue = self._queues[self.router_id]
+            return queue[-1][0] if queue else "0"
+
+    def read(self, last_id="0", count=None, block=None):
+        with self._condition:
+            ret = self._read(last_id, count)
+            if not ret and block:
+                self._condition.wait(timeout=block / 1000)
+                ret = self._read(last_id, count)
+            return ret
+
+    @classmethod
+    def clear(cls):
+        with cls._condition:
+            cls._queues.clear()
+
+
+class RedisEventStream:
+    def __init__(self, router_id, connection):
+        self.router_id = router_id
+        self.connection = connection
+        self.key = caches["default"].make_key(
+            get_router_events_cache_key(router_id))
+
+    @omit_redis_exception()
+    def publish(self, events):
+        pipe = self.connection.pipeline()
+        for event in events:
+            pipe.xadd(
+                self.key, {"event": json.dumps(event, separators=(",", ":"))},
+                maxlen=get_stream_maxlen(), approximate=True)
+        pipe.execute()
+
+    @omit_redis_exception(return_value="0")
+    def get_last_id(self):
+        entries = self.connection.xrevrange(self.key, "+", "-", count=1)
+        if not entries:
+            return "0"
+        event_id = entries[0][0]
+        return event_id.decode() if isinstance(event_id, bytes) else event_id
+
+    @omit_redis_exception(return_value=list)
+    def read(self, last_id="0", count=None, block=None):
+        result = self.connection.xread(
+            {self.key: last_id}, count=count, block=block)
+
+        ret = []
+        for _key, entries in result or []:
+            for event_id, fields in entries:
+                if isinstance(event_id, bytes):
+                    event_id = event_id.decode()
+                value = fields.get(b"event", fields.get("event"))
+                ret.append((event_id, json.loads(value)))
+        return ret
+
+
+def is_event_stream_shared():
+    # Whether the events published by a process (e.g. the celery polls)
+    # are read by the others, see InProcessEventStream
+    return get_default_redis_connection() is not None
+
+
+def get_event_stream(router_id):
+    connection = get_default_redis_connection()
+    if connection is None:
+        return InProcessEventStream(router_id)
+    return RedisEventStream(router_id, connection)
+
+
+def publish_events(router_id, events):
+    if not events:
+        return
+    get_event_stream(router_id).publish(events)
+
+    for event in events:
+        metrics.inc(
+            "snapshot_events_total", {"router": router_id, "type": event["type"]})
+
+
+def get_last_event_id(router_id):
+    """
+    Return the id of the last retained event of the router, or "0", from
+    which a consumer only reads the events published afterwards.
+    """
+    return get_event_stream(router_id).get_last_id()
+
+
+def read_events(router_id, last_id="0", count=100, block=None):
+    """
+    Return a list of ``(event_id, event)`` of the events of the router
+    published after *last_id* ("0" for all the retained events). If *block*
+    is given, wait up to *block* milliseconds for new events.
+    """
+    return get_event_stream(router_id).read(
+        last_id=last_id, count=count, block=block)
@@ -39,6 +39,83 @@ class MinutesWidget(forms.Select):
         super().__init__(attrs={"class": self.class_name, **(attrs or {})})
 
 
+class AutocompleteSelect(forms.Select):
+    """
+    Only the selected option is rendered, the others are searched page by
+    page from *url* while typing (see :mod:`my_router.autocomplete`).
+    """
+
+    class Media:
+        css = {
+            "all": ("select2/dist/css/select2.min.css",)
+        }
+        js = [
+            "select2/dist/js/select2.min.js",
+            "js/autocomplete.js",
+        ]
+
+    def __init__(self, url, attrs=None, choices=()):
+        attrs = {
+            "class": "vAutocomplete", "data-autocomplete-url": url,
+            **(attrs or {})}
+        super().__init__(attrs=attrs, choices=choices)
+
+    def optgroups(self, name, value, attrs=None):
+        labels = {str(v): label for v, label in self.choices}
+        options = [
+            self.create_option(
+                name, v, labels.get(v, v), True, index, attrs=attrs)
+            for index, v in enumerate(value)]
+        return [(None, options, 0)]
+
+
+class AutocompleteSelectMultiple(AutocompleteSelect, forms.SelectMultiple):
+    """
+    Like :class:`AutocompleteSelect`, with several selected options.
+    """
+
+
+class AutocompleteChoiceField(forms.ChoiceField):
+    """
+    A ChoiceField whose choices are only used for validation and for the
+    label of the selected value.
+    """
+    autocomplete_widget = AutocompleteSelect
+
+    def __init__(self, url, *args, **kwargs):
+        kwargs.setdefault("widget", self.autocomplete_widget(url=url))
+        super().__init__(*args, **kwargs)
+
+    def valid_value(self, value):
+        # The set of the values is built again when the choices are replaced
+        choices = self.choices
+        if getattr(self, "_valid_values_choices", None) is not choices:
+            self._valid_values = {str(v) for v, _label in choices}
+            self._valid_values_choices = choices
+        return str(value) in self._valid_values
+
+
+class AutocompleteMultipleChoiceField(
+        AutocompleteChoiceField, forms.MultipleChoiceField):
+    """
+    Like :class:`AutocompleteChoiceField`, with several values.
+    """
+    autocomplete_widget = AutocompleteSelectMultiple
+
+
+def get_choice_field(autocomplete_url=None, **kwargs):
+    # Pickers fall back to a plain select without an autocomplete url
+    if autocomplete_url:
+        return AutocompleteChoiceField(autocomplete_url, **kwargs)
+    return forms.ChoiceField(**kwargs)
+
+
+def get_multiple_choice_field(autocomplete_url=None, **kwargs):
+    if autocomplete_url:
+        return AutocompleteMultipleChoiceField(autocomplete_url, **kwargs)
+    return forms.MultipleChoiceField(**kwargs)
+
+
 class BaseEditForm(StyledFormMixin, forms.Form):
     class Media:
         css = {
@@ -134,10 +211,12 @@ class BaseEditWithApplyToForm(BaseEditForm):
     def __init__(self, add_new, name, start_time, end_time,
                  days, apply_to_choices, apply_to_initial, enabled,
                  *args, **kwargs):
+        apply_to_url = kwargs.pop("apply_to_url", None)
         super().__init__(add_new, name, start_time, end_time,
                          days, enabled, *args, **kwargs)
 
-        self.fields["apply_to"] = forms.MultipleChoiceField(
+        self.fields["apply_to"] = get_multiple_choice_field(
+            autocomplete_url=apply_to_url,
             label=_("Apply to"),
             choices=apply_to_choices, initial=apply_to_initial,
             required=False
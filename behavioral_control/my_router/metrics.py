@@ -0,0 +1,447 @@
+"""
+Instrumentation of the fetch cycle, exposed in the Prometheus text format
+by the ``/metrics`` view.
+
+The metrics are kept in the default cache so that the values recorded by
+the celery workers (polls) and the web workers (edits) are aggregated.
+Within a fetch cycle (see :func:`collect_fetch`) or a request (see
+:class:`MetricsMiddleware`), observations are buffered in a
+:class:`MetricsCollector` and written at the end of the cycle or request.
+"""
+
+import time
+from bisect import bisect_left
+from collections import defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from threading import Lock
+
+import django.core.cache as cache
+from django.conf import settings
+from django.db import connection
+
+from my_router.client_pool import ClientCallProxy
+
+METRICS_KEY_PREFIX = "metrics:v1"
+METRICS_SERIES_KEY = f"{METRICS_KEY_PREFIX}:series"
+
+HISTOGRAM_BUCKETS = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+# name: (type, help)
+METRICS = {
+    "router_api_call_duration_seconds": (
+        "histogram", "Duration of the API calls to the router."),
+    "router_api_call_errors_total": (
+        "counter", "API calls to the router which raised an error."),
+    "router_api_queue_delay_seconds": (
+        "histogram", "Time router API calls waited for the rate limiter."),
+    "fetch_stage_duration_seconds": (
+        "histogram", "Duration of the stages of the fetch cycle."),
+    "fetch_cycles_total": (
+        "counter", "Fetch cycles run."),
+    "fetch_router_calls_total": (
+        "counter", "Router API calls made by the fetch cycles."),
+    "fetch_db_queries_total": (
+        "counter", "Database queries made by the fetch cycles."),
+    "fetch_cache_ops_total": (
+        "counter", "Cache operations made by the fetch cycles."),
+    "snapshot_size_bytes": (
+        "gauge", "Size of the last router snapshot written to the cache."),
+    "snapshot_devices": (
+        "gauge", "Number of devices in the last router snapshot."),
+    "snapshot_events_total": (
+        "counter", "Change events published between router snapshots."),
+}
+
+METRICS_NAME_PREFIX = "behavioral_control_"
+
+_current_collector = ContextVar("metrics_collector", default=None)
+
+# The series known to be in the index of the cache, so that the index is
+# only read when a collector has others. Forgotten after a while, in case
+# the index was reset (see reset_metrics) or evicted meanwhile.
+KNOWN_SERIES_TIMEOUT = 60
+_known_series = set()
+_known_series_expires_at = 0.
+_known_series_lock = Lock()
+
+
+def forget_known_series():
+    global _known_series_expires_at
+    with _known_series_lock:
+        _known_series.clear()
+        _known_series_expires_at = 0.
+
+
+def _get_new_series(series):
+    global _known_series_expires_at
+    with _known_series_lock:
+        now = time.monotonic()
+        if now >= _known_series_expires_at:
+            _known_series.clear()
+            _known_series_expires_at = now + KNOWN_SERIES_TIMEOUT
+        return series - _known_series
+
+
+def _add_known_series(series):
+    with _known_series_lock:
+        _known_series.update(series)
+
+
+def metrics_enabled():
+    return getattr(settings, "BEHAVIORAL_CONTROL_METRICS_ENABLED", True)
+
+
+def get_metrics_cache():
+    # Not the instrumented DEFAULT_CACHE, writing metrics must not be
+    # counted as cache operations of the fetch cycle.
+    return cache.caches["default"]
+
+
+def _labels_to_key(labels):
+    return ",".join(f"{k}={v}" for k, v in sorted(labels.items()))
+
+
+def _get_value_key(name, labels, suffix=""):
+    return f"{METRICS_KEY_PREFIX}:{name}:{_labels_to_key(labels)}:{suffix}"
+
+
+class MetricsCollector:
+    """
+    Buffers counter increments, histogram observations and gauge values,
+    :meth:`flush` writes them to the cache.
+    """
+
+    def __init__(self):
+        self._increments = defaultdict(int)
+        self._gauges = {}
+        self._series = set()
+
+    def _add_series(self, name, labels):
+        self._series.add((name, tuple(sorted(labels.items()))))
+
+    def inc(self, name, labels, value=1):
+        self._add_series(name, labels)
+        self._increments[_get_value_key(name, labels)] += value
+
+    def observe(self, name, labels, value):
+        self._add_series(name, labels)
+        bucket = bisect_left(HISTOGRAM_BUCKETS, value)
+        self._increments[_get_value_key(name, labels, f"bucket{bucket}")] += 1
+        self._increments[_get_value_key(name, labels, "count")] += 1
+
+        # Sums are kept in microseconds, the cache only increments integers.
+        self._increments[_get_value_key(name, labels, "sum")] += (
+            int(value * 1e6))
+
+    def set_gauge(self, name, labels, value):
+        self._add_series(name, labels)
+        self._gauges[_get_value_key(name, labels)] = value
+
+    @contextmanager
+    def time(self, name, labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, labels, time.perf_counter() - start)
+
+    def flush(self):
+        # Most requests record nothing, they don't reach the cache at all
+        if not metrics_enabled() or not self._series:
+            return
+
+        metrics_cache = get_metrics_cache()
+        for key, value in self._increments.items():
+            try:
+                metrics_cache.incr(key, value)
+            except ValueError:
+                # A new key, unless another worker created it meanwhile
+                if not metrics_cache.add(key, value, timeout=None):
+                    metrics_cache.incr(key, value)
+
+        if self._gauges:
+            metrics_cache.set_many(self._gauges, timeout=None)
+
+        # New series are rare (a new router or endpoint), the index is only
+        # read when the process does not know some of them, and written when
+        # it misses some of them.
+        if _get_new_series(self._series):
+            known_series = metrics_cache.get(METRICS_SERIES_KEY, set())
+            if not self._series.issubset(known_series):
+                known_series = known_series | self._series
+                metrics_cache.set(
+                    METRICS_SERIES_KEY, known_series, timeout=None)
+            _add_known_series(known_series)
+
+        self._increments.clear()
+        self._gauges.clear()
+        self._series.clear()
+
+
+@contextmanager
+def _recording():
+    # Records into the collector of the current fetch cycle or request if
+    # any, otherwise into a collector flushed right away.
+    collector = _current_collector.get()
+    if collector is not None:
+        yield collector
+        return
+
+    collector = MetricsCollector()
+    yield collector
+    collector.flush()
+
+
+def inc(name, labels, value=1):
+    with _recording() as collector:
+        collector.inc(name, labels, value)
+
+
+def observe(name, labels, value):
+    with _recording() as collector:
+        collector.observe(name, labels, value)
+
+
+def set_gauge(name, labels, value):
+    with _recording() as collector:
+        collector.set_gauge(name, labels, value)
+
+
+@contextmanager
+def time_stage(router_id, stage):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(
+            "fetch_stage_duration_seconds",
+            {"router": router_id, "stage": stage},
+            time.perf_counter() - start)
+
+
+def count_cache_op():
+    # Only counted within a fetch cycle
+    collector = _current_collector.get()
+    if isinstance(collector, FetchCycleCollector):
+        collector.cache_ops += 1
+
+
+def count_router_call():
+    # Only counted within a fetch cycle
+    collector = _current_collector.get()
+    if isinstance(collector, FetchCycleCollector):
+        collector.router_calls += 1
+
+
+class FetchCycleCollector(MetricsCollector):
+    def __init__(self, router_id):
+        super().__init__()
+        self.router_id = router_id
+        self.router_calls = 0
+        self.db_queries = 0
+        self.cache_ops = 0
+
+    def count_query(self, execute, sql, params, many, context):
+        self.db_queries += 1
+        return execute(sql, params, many, context)
+
+
+@contextmanager
+def collect_fetch(router_id):
+    """
+    Instruments a fetch cycle of the router: the duration, the router calls,
+    the database queries and the cache operations.
+    """
+    if not metrics_enabled():
+        yield None
+        return
+
+    collector = FetchCycleCollector(router_id)
+    token = _current_collector.set(collector)
+    labels = {"router": router_id}
+    try:
+        with connection.execute_wrapper(collector.count_query):
+            with collector.time(
+                    "fetch_stage_duration_seconds",
+                    {"router": router_id, "stage": "total"}):
+                yield collector
+    finally:
+        _current_collector.reset(token)
+
+        collector.inc("fetch_cycles_total", labels)
+        collector.inc(
+            "fetch_router_calls_total", labels, collector.router_calls)
+        collector.inc("fetch_db_queries_total", labels, collector.db_queries)
+        collector.inc("fetch_cache_ops_total", labels, collector.cache_ops)
+        collector.flush()
+
+
+@contextmanager
+def collect():
+    """
+    Buffers the observations made in this context, e.g., the router calls
+    of a request, and writes them once at the end.
+    """
+    if not metrics_enabled() or _current_collector.get() is not None:
+        yield
+        return
+
+    collector = MetricsCollector()
+    token = _current_collector.set(collector)
+    try:
+        yield
+    finally:
+        _current_collector.reset(token)
+        collector.flush()
+
+
+class MetricsMiddleware:
+    """
+    Writes the metrics recorded while handling a request in one batch.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        with collect():
+            return self.get_response(request)
+
+
+class InstrumentedCache:
+    """
+    Wraps a cache so that the operations made within a fetch cycle are
+    counted.
+    """
+
+    counted_operations = frozenset([
+        "get", "set", "add", "delete", "get_many", "set_many", "delete_many",
+        "incr", "decr", "touch", "has_key", "clear"])
+
+    def __init__(self, cache_instance):
+        self._cache = cache_instance
+
+    def __getattr__(self, name):
+        attr = getattr(self._cache, name)
+        if name not in self.counted_operations:
+            return attr
+
+        def counted_operation(*args, **kwargs):
+            count_cache_op()
+            return attr(*args, **kwargs)
+
+        return counted_operation
+
+
+class InstrumentedClient(ClientCallProxy):
+    """
+    Wraps an IKuaiClient so that the duration of each API call is recorded
+    per endpoint.
+    """
+
+    def __init__(self, client, router_id):
+        super().__init__(client)
+        self._router_id = router_id
+
+    def call(self, name, func, *args, **kwargs):
+        labels = {"router": self._router_id, "endpoint": name}
+        count_router_call()
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        except Exception:
+            inc("router_api_call_errors_total", labels)
+            raise
+        finally:
+            observe(
+                "router_api_call_duration_seconds", labels,
+                time.perf_counter() - start)
+
+
+def _format_labels(labels):
+    # labels: a list of (name, value) tuples
+    if not labels:
+        return ""
+    formatted = ",".join(
+        '{}="{}"'.format(
+            k, str(v).replace("\\", "\\\\").replace('"', '\\"'))
+        for k, v in labels)
+    return "{%s}" % formatted
+
+
+def render_metrics():
+    """
+    Return all the recorded metrics in the Prometheus text format.
+    """
+    metrics_cache = get_metrics_cache()
+    series = metrics_cache.get(METRICS_SERIES_KEY, set())
+
+    series_by_name = defaultdict(list)
+    for name, labels in series:
+        if name in METRICS:
+            series_by_name[name].append(labels)
+
+    keys = []
+    for name, labels_list in series_by_name.items():
+        metric_type = METRICS[name][0]
+        for labels in labels_list:
+            labels = dict(labels)
+            if metric_type == "histogram":
+                keys.extend(
+                    _get_value_key(name, labels, suffix)
+                    for suffix in (
+                        [f"bucket{i}" for i in range(len(HISTOGRAM_BUCKETS) + 1)]
+                        + ["count", "sum"]))
+            else:
+                keys.append(_get_value_key(name, labels))
+
+    values = metrics_cache.get_many(keys)
+
+    lines = []
+    for name in sorted(series_by_name):
+        metric_type, help_text = METRICS[name]
+        full_name = f"{METRICS_NAME_PREFIX}{name}"
+        lines.append(f"# HELP {full_name} {help_text}")
+        lines.append(f"# TYPE {full_name} {metric_type}")
+
+        for labels in sorted(series_by_name[name], key=str):
+            labels_dict = dict(labels)
+            label_items = list(labels)
+            if metric_type != "histogram":
+                value = values.get(_get_value_key(name, labels_dict), 0)
+                lines.append(
+                    f"{full_name}{_format_labels(label_items)} {value}")
+                continue
+
+            cumulative = 0
+            for i, le in enumerate(list(HISTOGRAM_BUCKETS) + ["+Inf"]):
+                cumulative += values.get(
+                    _get_value_key(name, labels_dict, f"bucket{i}"), 0)
+                lines.append(
+                    f"{full_name}_bucket"
+                    f"{_format_labels(label_items + [('le', le)])} {cumulative}")
+            count = values.get(_get_value_key(name, labels_dict, "count"), 0)
+            total = values.get(_get_value_key(name, labels_dict, "sum"), 0) / 1e6
+            lines.append(f"{full_name}_sum{_format_labels(label_items)} {total}")
+            lines.append(
+                f"{full_name}_count{_format_labels(label_items)} {count}")
+
+    return "\n".join(lines) + "\n"
+
+
+def reset_metrics():
+    metrics_cache = get_metrics_cache()
+    series = metrics_cache.get(METRICS_SERIES_KEY, set())
+    keys = [METRICS_SERIES_KEY]
+    for name, labels in series:
+        labels = dict(labels)
+        keys.append(_get_value_key(name, labels))
+        keys.extend(
+            _get_value_key(name, labels, suffix)
+            for suffix in (
+                [f"bucket{i}" for i in range(len(HISTOGRAM_BUCKETS) + 1)]
+                + ["count", "sum"]))
+    metrics_cache.delete_many(keys)
+    forget_known_series()
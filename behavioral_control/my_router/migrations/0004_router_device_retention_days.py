@@ -0,0 +1,24 @@
+# Generated by Django 4.2.30 on 2026-10-19 14:34
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("my_router", "0003_device_block_mac_by_proto_ctrl"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="router",
+            name="device_retention_days",
+            field=models.PositiveIntegerField(
+                default=90,
+                help_text="Devices offline for more than this number of days "
+                "are removed, unless they are known, controlled via proto "
+                "ctrl or in a MAC group. 0 means devices are kept forever.",
+                verbose_name="Device retention days",
+            ),
+        ),
+    ]
@@ -9,11 +9,28 @@ from django.utils.translation import gettext_lazy as _
 from django_celery_beat.models import IntervalSchedule, PeriodicTask
 from pyikuai import IKuaiClient
 
+from my_router.circuit_breaker import (CircuitBreakerClient,
+                                       RouterCircuitBreaker)
+from my_router.client_pool import client_pool
 from my_router.constants import (DEFAULT_CACHE, ROUTER_STATUS_CHOICES,
                                  router_status)
+from my_router.device_store import get_device_store
 from my_router.fields import MACAddressField
-from my_router.utils import (get_device_db_cache_key,
-                             get_router_device_cache_key)
+from my_router.metrics import InstrumentedClient
+from my_router.rate_limit import (RateLimitedClient, discard_router_limiter,
+                                  get_router_limiter)
+from my_router.utils import get_device_db_cache_key
+
+# The default of the model field is a constant so that migrations don't
+# depend on the settings, the setting is the initial value of the forms
+# creating routers.
+DEFAULT_DEVICE_RETENTION_DAYS = 90
+
+
+def get_default_device_retention_days():
+    return getattr(
+        settings, "BEHAVIORAL_CONTROL_DEVICE_RETENTION_DAYS",
+        DEFAULT_DEVICE_RETENTION_DAYS)
 
 
 class Router(models.Model):
@@ -55,6 +72,15 @@ class Router(models.Model):
         validators=[MinValueValidator(1)]
     )
 
+    device_retention_days = models.PositiveIntegerField(
+        verbose_name=_("Device retention days"),
+        help_text=_("Devices offline for more than this number of days are "
+                    "removed, unless they are known, controlled via proto "
+                    "ctrl or in a MAC group. 0 means devices are kept "
+                    "forever."),
+        default=DEFAULT_DEVICE_RETENTION_DAYS,
+    )
+
     task = models.OneToOneField(
         PeriodicTask, on_delete=models.CASCADE, null=True, blank=True)
 
@@ -65,11 +91,31 @@ class Router(models.Model):
     def __str__(self):
         return self.name
 
-    def get_client(self):
+    def create_client(self):
         return IKuaiClient(
             url=self.url, username=self.admin_username,
             password=self.admin_password)
 
+    @property
+    def connection_settings(self):
+        return self.url, self.admin_username, self.admin_password
+
+    def get_client(self):
+        if self.pk is None:
+            return self.create_client()
+
+        # Logged-in clients are reused by each thread, see client_pool.
+        # Calls to the router are throttled per router, see rate_limit, and
+        # fail fast while the router is unreachable, see circuit_breaker.
+        return client_pool.get(
+            self.pk,
+            self.connection_settings,
+            lambda: CircuitBreakerClient(
+                RateLimitedClient(
+                    InstrumentedClient(self.create_client(), self.pk),
+                    get_router_limiter(self.pk)),
+                RouterCircuitBreaker(self.pk)))
+
     def setup_task(self):
         self.task = PeriodicTask.objects.create(
             name=_("Fetch info and set cache for %s") % self.name,
@@ -89,6 +135,8 @@ class Router(models.Model):
     def delete(self, *args, **kwargs):
         if self.task is not None:
             self.task.delete()
+        client_pool.discard(self.pk)
+        discard_router_limiter(self.pk)
         return super(Router, self).delete(*args, **kwargs)
 
 
@@ -156,9 +204,9 @@ class Device(models.Model):
         DEFAULT_CACHE.set(get_device_db_cache_key(self.mac), self.name)
 
     def remove_cache(self):
-        # Remove both the name cache and router device cache.
+        # Remove both the name cache and the record in the router device store.
         DEFAULT_CACHE.delete(get_device_db_cache_key(self.mac))
-        DEFAULT_CACHE.delete(get_router_device_cache_key(self.router.id, self.mac))
+        get_device_store(self.router.id).remove([self.mac])
 
     def __str__(self):
         return _("{device} on {router}").format(device=self.name, router=self.router)
@@ -0,0 +1,403 @@
+"""
+Throttling of the API calls to the routers.
+
+The budget of a router is shared by all the processes (web workers and
+celery) through Redis when the default cache is Redis, see
+:class:`RedisRouterCallLimiter`. Otherwise each process has its own
+:class:`RouterCallLimiter`, so that the limits and priorities only hold
+within a process.
+"""
+
+import heapq
+import itertools
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from contextvars import ContextVar
+from threading import Condition, Lock
+
+from django.conf import settings
+from django.core.cache import caches
+
+from my_router import metrics
+from my_router.client_pool import ClientCallProxy
+from my_router.constants import router_call_priority
+from my_router.utils import (get_default_redis_connection,
+                             get_router_api_limiter_cache_key,
+                             omit_redis_exception)
+
+_current_call_priority = ContextVar(
+    "router_call_priority", default=router_call_priority.interactive)
+
+
+def get_call_priority():
+    return _current_call_priority.get()
+
+
+@contextmanager
+def call_priority(priority):
+    """
+    Router calls made in this context are queued with *priority*, e.g.,
+    periodic polls run with ``router_call_priority.background`` so that
+    interactive edits are served first.
+    """
+    token = _current_call_priority.set(priority)
+    try:
+        yield
+    finally:
+        _current_call_priority.reset(token)
+
+
+class RouterCallLimiter:
+    """
+    A token bucket and a concurrency cap for the API calls to one router,
+    in the memory of the process.
+
+    Calls over the budget wait in a priority queue (lower value first, FIFO
+    within the same priority). ``rate`` is in calls per second, a falsy
+    ``rate`` or ``max_concurrency`` disables that limit.
+    """
+
+    def __init__(self, rate, burst, max_concurrency, clock=time.monotonic,
+                 router_id=None):
+        self.router_id = router_id
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.max_concurrency = max_concurrency
+        self._clock = clock
+
+        self._cond = Condition()
+        self._tokens = float(self.burst)
+        self._updated_at = clock()
+        self._in_flight = 0
+        self._waiting = []
+        self._sequence = itertools.count()
+        self._stats = {}
+
+    def _refill(self):
+        if not self.rate:
+            return
+        now = self._clock()
+        self._tokens = min(
+            self.burst, self._tokens + (now - self._updated_at) * self.rate)
+        self._updated_at = now
+
+    def _can_run(self):
+        if self.max_concurrency and self._in_flight >= self.max_concurrency:
+            return False
+        return not self.rate or self._tokens >= 1
+
+    def _get_wait_timeout(self):
+        if self.rate and self._tokens < 1:
+            return (1 - self._tokens) / self.rate
+
+        # Waiting for a call to finish, release() will notify.
+        return None
+
+    def _record(self, priority, delay):
+        stats = self._stats.setdefault(priority, {
+            "calls": 0, "queued": 0, "total_delay": 0., "max_delay": 0.})
+        stats["calls"] += 1
+        if delay > 0:
+            stats["queued"] += 1
+            stats["total_delay"] += delay
+            stats["max_delay"] = max(stats["max_delay"], delay)
+
+    def acquire(self, priority=None):
+        """
+        Block until the call is admitted, return the time spent in the queue.
+        """
+        if priority is None:
+            priority = get_call_priority()
+
+        enqueued_at = self._clock()
+        waited = False
+        with self._cond:
+            ticket = (priority, next(self._sequence))
+            heapq.heappush(self._waiting, ticket)
+            try:
+                while True:
+                    self._refill()
+                    if self._waiting[0] == ticket and self._can_run():
+                        break
+                    waited = True
+                    self._cond.wait(self._get_wait_timeout())
+            except BaseException:
+                self._waiting.remove(ticket)
+                heapq.heapify(self._waiting)
+                self._cond.notify_all()
+                raise
+
+            heapq.heappop(self._waiting)
+            if self.rate:
+                self._tokens -= 1
+            self._in_flight += 1
+
+            delay = self._clock() - enqueued_at if waited else 0
+            self._record(priority, delay)
+
+            # The next waiter might be admitted as well.
+            self._cond.notify_all()
+
+        return delay
+
+    def release(self):
+        with self._cond:
+            self._in_flight -= 1
+            self._cond.notify_all()
+
+    @contextmanager
+    def limit(self, priority=None):
+        self.acquire(priority)
+        try:
+            yield
+        finally:
+            self.release()
+
+    def get_stats(self):
+        with self._cond:
+            return {
+                "in_flight": self._in_flight,
+                "waiting": len(self._waiting),
+                "priorities": {
+                    priority: dict(stats)
+                    for priority, stats in self._stats.items()},
+            }
+
+
+# KEYS: the waiting queue (ticket by priority, then by enqueue time), the
+# last poll time of the waiters, the calls in flight (ticket by lease
+# expiry) and the token bucket (a hash of "tokens" and "updated_at").
+# ARGV: ticket, priority, rate, burst, max_concurrency, lease, stale_after.
+# Return [1, "0"] if the ticket is admitted, else [0, wait], wait being the
+# seconds until the next token or "-1" if waiting for a turn or a slot.
+_ACQUIRE_SCRIPT = """
+local queue, seen, in_flight, bucket = KEYS[1], KEYS[2], KEYS[3], KEYS[4]
+local ticket = ARGV[1]
+local rate = tonumber(ARGV[3])
+local burst = tonumber(ARGV[4])
+local max_concurrency = tonumber(ARGV[5])
+local lease = tonumber(ARGV[6])
+local stale_after = tonumber(ARGV[7])
+
+-- The clock of the server, shared by all the processes
+local time = redis.call("TIME")
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+
+-- Calls of processes which died before releasing, and waiters which gave up
+redis.call("ZREMRANGEBYSCORE", in_flight, "-inf", now)
+local stale = redis.call("ZRANGEBYSCORE", seen, "-inf", now - stale_after)
+for _, stale_ticket in ipairs(stale) do
+    redis.call("ZREM", queue, stale_ticket)
+    redis.call("ZREM", seen, stale_ticket)
+end
+
+redis.call("ZADD", queue, "NX",
+    string.format("%.0f", tonumber(ARGV[2]) * 1e13 + now * 1000), ticket)
+redis.call("ZADD", seen, now, ticket)
+local ttl = math.ceil(lease + stale_after)
+redis.call("EXPIRE", queue, ttl)
+redis.call("EXPIRE", seen, ttl)
+
+if redis.call("ZRANGE", queue, 0, 0)[1] ~= ticket then
+    return {0, "-1"}
+end
+if max_concurrency > 0 and redis.call("ZCARD", in_flight) >= max_concurrency
+then
+    return {0, "-1"}
+end
+
+if rate > 0 then
+    local tokens = burst
+    local state = redis.call("HMGET", bucket, "tokens", "updated_at")
+    if state[1] then
+        tokens = math.min(
+            burst, tonumber(state[1]) + (now - tonumber(state[2])) * rate)
+    end
+    if tokens < 1 then
+        return {0, tostring((1 - tokens) / rate)}
+    end
+    redis.call("HSET", bucket, "tokens", tostring(tokens - 1),
+        "updated_at", tostring(now))
+    redis.call("EXPIRE", bucket, math.ceil(burst / rate) + 1)
+end
+
+redis.call("ZREM", queue, ticket)
+redis.call("ZREM", seen, ticket)
+redis.call("ZADD", in_flight, now + lease, ticket)
+redis.call("EXPIRE", in_flight, ttl)
+return {1, "0"}
+"""
+
+
+class RedisRouterCallLimiter(RouterCallLimiter):
+    """
+    The limiter of a router with its token bucket, calls in flight and
+    waiting queue in Redis, so that the limits and the priorities hold
+    across all the processes calling the router.
+
+    Admission is checked atomically by a Lua script, waiters poll it every
+    ``poll_interval`` seconds at most. A call in flight is forgotten after
+    ``lease`` seconds in case its process died before releasing it, and a
+    waiter which stopped polling for ``stale_after`` seconds is dropped
+    from the queue. The stats are those of the calls of this process.
+    """
+
+    poll_interval = 0.05
+
+    def __init__(self, rate, burst, max_concurrency, connection, router_id,
+                 clock=time.monotonic, lease=60, stale_after=10):
+        super().__init__(rate, burst, max_concurrency, clock=clock,
+                         router_id=router_id)
+        self.connection = connection
+        self.lease = lease
+        self.stale_after = stale_after
+
+        # Same prefix and version as the other keys of the default cache
+        key = caches["default"].make_key(
+            get_router_api_limiter_cache_key(router_id))
+        self.queue_key = f"{key}:queue"
+        self.seen_key = f"{key}:seen"
+        self.in_flight_key = f"{key}:in_flight"
+        self.bucket_key = f"{key}:bucket"
+        self._script = connection.register_script(_ACQUIRE_SCRIPT)
+
+        # The tickets admitted in this thread, for release()
+        self._local = threading.local()
+
+    @property
+    def _tickets(self):
+        if not hasattr(self._local, "tickets"):
+            self._local.tickets = []
+        return self._local.tickets
+
+    # Calls are not throttled while Redis is down, rather than all failing.
+    @omit_redis_exception(return_value=(1, "0"))
+    def _try_acquire(self, ticket, priority):
+        return self._script(
+            keys=[self.queue_key, self.seen_key, self.in_flight_key,
+                  self.bucket_key],
+            args=[ticket, priority, self.rate or 0, self.burst,
+                  self.max_concurrency or 0, self.lease, self.stale_after])
+
+    @omit_redis_exception()
+    def _discard(self, ticket):
+        pipeline = self.connection.pipeline()
+        pipeline.zrem(self.queue_key, ticket)
+        pipeline.zrem(self.seen_key, ticket)
+        pipeline.zrem(self.in_flight_key, ticket)
+        pipeline.execute()
+
+    def acquire(self, priority=None):
+        if priority is None:
+            priority = get_call_priority()
+
+        ticket = uuid.uuid4().hex
+        enqueued_at = self._clock()
+        waited = False
+        try:
+            while True:
+                admitted, wait = self._try_acquire(ticket, priority)
+                if int(admitted):
+                    break
+                waited = True
+                wait = float(wait)
+                time.sleep(
+                    self.poll_interval if wait < 0
+                    else min(wait, self.poll_interval))
+        except BaseException:
+            self._discard(ticket)
+            raise
+
+        self._tickets.append(ticket)
+        delay = self._clock() - enqueued_at if waited else 0
+        with self._cond:
+            self._record(priority, delay)
+        return delay
+
+    def release(self):
+        self._discard(self._tickets.pop())
+
+    @omit_redis_exception(return_value=lambda: (0, 0))
+    def _get_counts(self):
+        pipeline = self.connection.pipeline()
+        pipeline.zcard(self.in_flight_key)
+        pipeline.zcard(self.queue_key)
+        return pipeline.execute()
+
+    def get_stats(self):
+        in_flight, waiting = self._get_counts()
+        with self._cond:
+            return {
+                "in_flight": in_flight,
+                "waiting": waiting,
+                "priorities": {
+                    priority: dict(stats)
+                    for priority, stats in self._stats.items()},
+            }
+
+
+class RateLimitedClient(ClientCallProxy):
+    """
+    Wraps an IKuaiClient so that each of its API calls goes through
+    the limiter of the router.
+    """
+
+    def __init__(self, client, limiter):
+        super().__init__(client)
+        self._limiter = limiter
+
+    def call(self, name, func, *args, **kwargs):
+        priority = get_call_priority()
+        delay = self._limiter.acquire(priority)
+        try:
+            metrics.observe(
+                "router_api_queue_delay_seconds",
+                {"router": self._limiter.router_id, "priority": priority},
+                delay)
+            return func(*args, **kwargs)
+        finally:
+            self._limiter.release()
+
+
+_limiters = {}
+_limiters_lock = Lock()
+
+
+def get_router_limiter(router_id):
+    with _limiters_lock:
+        if router_id not in _limiters:
+            kwargs = dict(
+                rate=getattr(
+                    settings, "BEHAVIORAL_CONTROL_ROUTER_API_RATE", 5),
+                burst=getattr(
+                    settings, "BEHAVIORAL_CONTROL_ROUTER_API_BURST", 10),
+                max_concurrency=getattr(
+                    settings, "BEHAVIORAL_CONTROL_ROUTER_API_CONCURRENCY", 2),
+                router_id=router_id)
+            connection = get_default_redis_connection()
+            if connection is None:
+                _limiters[router_id] = RouterCallLimiter(**kwargs)
+            else:
+                _limiters[router_id] = RedisRouterCallLimiter(
+                    connection=connection, **kwargs)
+        return _limiters[router_id]
+
+
+def discard_router_limiter(router_id):
+    with _limiters_lock:
+        _limiters.pop(router_id, None)
+
+
+def clear_router_limiters():
+    with _limiters_lock:
+        _limiters.clear()
+
+
+def get_all_limiter_stats():
+    with _limiters_lock:
+        limiters = dict(_limiters)
+    return {
+        router_id: limiter.get_stats()
+        for router_id, limiter in limiters.items()}
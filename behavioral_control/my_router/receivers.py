@@ -1,12 +1,54 @@
+from weakref import WeakKeyDictionary, WeakValueDictionary
+
 from django.contrib.auth import get_user_model
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
 from django.db.models.signals import post_delete, post_save, pre_save
 from django.dispatch import receiver
 from rest_framework.authtoken.models import Token
 
+from my_router import logger
+from my_router.autocomplete import touch_device_table
 from my_router.constants import router_status
+from my_router.data_manager import RouterDataManager
 from my_router.models import Device, Router
+from my_router.retention import is_router_refresh_suppressed
 from my_router.views import fetch_new_info_save_and_set_cache
 
+# The refreshes scheduled and not run yet, by connection then by router id
+# and savepoint ids. The callbacks are only referenced by Django's on_commit
+# queue, so that those discarded by a rollback also leave the registry.
+_pending_router_refreshes = WeakKeyDictionary()
+
+
+def schedule_router_refresh(router_id):
+    """
+    Fetch the router once the current transaction is committed (at once in
+    autocommit mode). Refreshes of the same router scheduled within a
+    transaction, e.g. when deleting devices in bulk, are coalesced.
+    """
+    connection = connections[DEFAULT_DB_ALIAS]
+    pending = _pending_router_refreshes.setdefault(
+        connection, WeakValueDictionary())
+
+    # Only refreshes scheduled in the same savepoint are reused, as the
+    # callbacks of rolled back savepoints are discarded by Django.
+    key = (router_id, tuple(connection.savepoint_ids))
+    if key in pending:
+        return
+
+    def refresh():
+        pending.pop(key, None)
+        # The changes are committed already, the request must not fail
+        try:
+            fetch_new_info_save_and_set_cache(router_id=router_id)
+        except Exception as e:
+            logger.error(
+                f"Router {router_id}: failed to refresh after commit: "
+                f"{type(e).__name__}: {e}")
+
+    pending[key] = refresh
+    transaction.on_commit(refresh)
+
 
 @receiver(post_save, sender=get_user_model())
 def create_auth_token(sender, instance=None, created=False, **kwargs):
@@ -14,16 +56,34 @@ def create_auth_token(sender, instance=None, created=False, **kwargs):
         Token.objects.create(user=instance)
 
 
+@receiver(pre_save, sender=Router)
+def cache_router_old_connection_settings(sender, instance, **kwargs):
+    instance._old_connection_settings = None
+    if instance.pk:
+        existing_instance = sender.objects.filter(pk=instance.pk).first()
+        if existing_instance is not None:
+            instance._old_connection_settings = (
+                existing_instance.connection_settings)
+
+
 @receiver(post_save, sender=Router)
 def create_or_update_router_fetch_task(sender, instance: Router, created, **kwargs):
     if created:
         instance.setup_task()
-        fetch_new_info_save_and_set_cache(router=instance)
+        schedule_router_refresh(instance.id)
     else:
         if instance.task is not None:
             instance.task.enabled = instance.status == router_status.active
             instance.task.save()
 
+        # The url might point to another router (or firmware) now, the
+        # catalogs are kept when only the name, interval... changed.
+        old_connection_settings = getattr(
+            instance, "_old_connection_settings", None)
+        if (old_connection_settings is not None
+                and old_connection_settings != instance.connection_settings):
+            RouterDataManager(router_instance=instance).invalidate_catalogs()
+
 
 @receiver(pre_save, sender=Device)
 def cache_device_old_block_mac_by_proto_ctrl_values(sender, instance, **kwargs):
@@ -39,6 +99,7 @@ def cache_device_old_block_mac_by_proto_ctrl_values(sender, instance, **kwargs):
 def handle_device_info_after_save(sender, instance: Device, created, **kwargs):
     # cache_device_info_after_save
     instance.update_name_cache()
+    touch_device_table(instance.router_id)
 
     if not created:
         if hasattr(instance, "_old_values"):
@@ -51,5 +112,9 @@ def handle_device_info_after_save(sender, instance: Device, created, **kwargs):
 
 @receiver(post_delete, sender=Device)
 def remove_device_cache_after_delete(sender, instance: Device, **kwargs):
+    # Devices compacted in batches are evicted by batch, see retention.
+    if is_router_refresh_suppressed():
+        return
     instance.remove_cache()
-    fetch_new_info_save_and_set_cache(router=instance.router)
+    touch_device_table(instance.router_id)
+    schedule_router_refresh(instance.router_id)
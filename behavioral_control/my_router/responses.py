@@ -0,0 +1,163 @@
+"""
+JSON responses for the AJAX views, encoded with orjson when it is installed
+and compressed according to the Accept-Encoding of the request. Large lists
+are streamed row by row, so that the whole encoded payload is never held in
+memory.
+"""
+
+import json
+import re
+import zlib
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import HttpResponse, StreamingHttpResponse
+from django.utils.module_loading import import_string
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Responses smaller than this are not worth compressing
+MIN_COMPRESS_LENGTH = 200
+
+_django_json_encoder = DjangoJSONEncoder()
+
+
+def _orjson_dumps(obj):
+    # Datetimes are passed to DjangoJSONEncoder, so that both encoders
+    # produce the same strings.
+    return orjson.dumps(
+        obj, default=_django_json_encoder.default,
+        option=orjson.OPT_PASSTHROUGH_DATETIME)
+
+
+def _stdlib_dumps(obj):
+    return json.dumps(
+        obj, cls=DjangoJSONEncoder, separators=(",", ":")).encode()
+
+
+def get_json_dumps():
+    """
+    Return the function encoding an object to JSON bytes: the dotted path in
+    BEHAVIORAL_CONTROL_JSON_DUMPS if configured, otherwise orjson when it is
+    installed, otherwise the stdlib encoder.
+    """
+    dumps = getattr(settings, "BEHAVIORAL_CONTROL_JSON_DUMPS", None)
+    if dumps:
+        return import_string(dumps)
+    if orjson is not None:
+        return _orjson_dumps
+    return _stdlib_dumps
+
+
+def dumps_json(obj):
+    return get_json_dumps()(obj)
+
+
+def get_accepted_encoding(request):
+    """
+    Return "br", "gzip" or None, the preferred supported encoding in the
+    Accept-Encoding header of *request*.
+    """
+    accepted = {}
+    for item in request.headers.get("Accept-Encoding", "").split(","):
+        coding, _, params = item.strip().partition(";")
+        match = re.search(r"q=([0-9.]+)", params)
+        try:
+            quality = float(match.group(1)) if match else 1.0
+        except ValueError:
+            quality = 0.0
+        if quality > 0:
+            accepted[coding.strip().lower()] = quality
+
+    supported = ["br", "gzip"] if brotli is not None else ["gzip"]
+    candidates = [coding for coding in supported if coding in accepted]
+    if not candidates:
+        return None
+    return max(candidates, key=lambda coding: accepted[coding])
+
+
+class Compressor:
+    def __init__(self, encoding):
+        self.encoding = encoding
+        if encoding == "br":
+            self._compressor = brotli.Compressor()
+        else:
+            self._compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+
+    def compress(self, data):
+        if self.encoding == "br":
+            return self._compressor.process(data)
+        return self._compressor.compress(data)
+
+    def flush(self):
+        if self.encoding == "br":
+            return self._compressor.finish()
+        return self._compressor.flush()
+
+
+def iter_json_list(rows, dumps, chunk_size):
+    yield b"["
+    chunk = []
+    for i, row in enumerate(rows):
+        if i:
+            chunk.append(b",")
+        chunk.append(dumps(row))
+        if len(chunk) >= chunk_size:
+            yield b"".join(chunk)
+            chunk = []
+    chunk.append(b"]")
+    yield b"".join(chunk)
+
+
+def iter_compressed(chunks, compressor):
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def _set_content_encoding(response, encoding):
+    response["Vary"] = "Accept-Encoding"
+    if encoding:
+        response["Content-Encoding"] = encoding
+
+
+def json_response(request, data, status=200):
+    """
+    A replacement of ``JsonResponse(data, safe=False)``. Lists longer than
+    BEHAVIORAL_CONTROL_JSON_STREAM_MIN_ROWS are streamed row by row.
+    """
+    dumps = get_json_dumps()
+    encoding = get_accepted_encoding(request)
+
+    stream_min_rows = getattr(
+        settings, "BEHAVIORAL_CONTROL_JSON_STREAM_MIN_ROWS", 1000)
+    if isinstance(data, list) and len(data) >= stream_min_rows:
+        chunks = iter_json_list(data, dumps, chunk_size=100)
+        if encoding:
+            chunks = iter_compressed(chunks, Compressor(encoding))
+        response = StreamingHttpResponse(
+            chunks, status=status, content_type="application/json")
+        _set_content_encoding(response, encoding)
+        return response
+
+    content = dumps(data)
+    if encoding and len(content) >= MIN_COMPRESS_LENGTH:
+        compressor = Compressor(encoding)
+        content = compressor.compress(content) + compressor.flush()
+    else:
+        encoding = None
+
+    response = HttpResponse(
+        content, status=status, content_type="application/json")
+    _set_content_encoding(response, encoding)
+    return response
@@ -0,0 +1,126 @@
+import threading
+from contextlib import contextmanager
+from datetime import timedelta
+
+from django.conf import settings
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from my_router import logger
+from my_router.autocomplete import touch_device_table
+from my_router.constants import DEFAULT_CACHE
+from my_router.device_store import get_device_store
+from my_router.utils import (get_device_compaction_lock_cache_key,
+                             get_device_db_cache_key)
+
+_local = threading.local()
+
+
+@contextmanager
+def suppress_router_refresh():
+    """
+    Within the block, deleting devices does not trigger a fetch of the
+    router (see the post_delete receiver of Device), nor the eviction of
+    their cache one by one.
+    """
+    suppressed = getattr(_local, "suppressed", False)
+    _local.suppressed = True
+    try:
+        yield
+    finally:
+        _local.suppressed = suppressed
+
+
+def is_router_refresh_suppressed():
+    return getattr(_local, "suppressed", False)
+
+
+def acquire_compaction_lock(router_id):
+    """
+    Return True at most once per compaction interval for each router, so
+    that compaction can be started from each poll.
+    """
+    interval = getattr(
+        settings, "BEHAVIORAL_CONTROL_DEVICE_COMPACTION_INTERVAL", 3600)
+    return DEFAULT_CACHE.add(
+        get_device_compaction_lock_cache_key(router_id), True, timeout=interval)
+
+
+def get_protected_macs(rd_manager):
+    # Online devices and devices in MAC groups of the cached snapshot
+    return set(rd_manager.device_dict) | {
+        mac for macs in rd_manager.mac_groups.values() for mac in macs}
+
+
+def get_stale_devices(router, now=None):
+    """
+    Return a list of (pk, mac) of the devices of *router* offline for more
+    than its ``device_retention_days``. Known devices, devices controlled
+    via proto ctrl, online devices and devices in MAC groups are protected.
+    """
+    from my_router.data_manager import RouterDataManager
+    from my_router.models import Device
+
+    if not router.device_retention_days:
+        return []
+
+    rd_manager = RouterDataManager(router_instance=router)
+    if rd_manager.get_snapshot_age() is None:
+        # Without a snapshot, online and grouped devices are unknown
+        return []
+    rd_manager.init_data_from_cache()
+    protected_macs = get_protected_macs(rd_manager)
+
+    now = now or timezone.now()
+    horizon = now - timedelta(days=router.device_retention_days)
+
+    candidates = [
+        (pk, mac, added_datetime)
+        for pk, mac, added_datetime in Device.objects.filter(
+            router=router, known=False, block_mac_by_proto_ctrl=False
+        ).values_list("pk", "mac", "added_datetime")
+        if mac not in protected_macs]
+
+    records = rd_manager.device_store.get_records(
+        [mac for _, mac, _ in candidates])
+
+    stale = []
+    for pk, mac, added_datetime in candidates:
+        last_seen = None
+        if mac in records and records[mac].get("last_seen"):
+            last_seen = parse_datetime(records[mac]["last_seen"])
+        if (last_seen or added_datetime) < horizon:
+            stale.append((pk, mac))
+    return stale
+
+
+def compact_router_devices(router, now=None, batch_size=None):
+    """
+    Delete the stale devices of *router* (see :func:`get_stale_devices`)
+    in batches and evict their cache. Return the number of devices deleted.
+    """
+    from my_router.models import Device
+
+    if batch_size is None:
+        batch_size = getattr(
+            settings, "BEHAVIORAL_CONTROL_DEVICE_COMPACTION_BATCH_SIZE", 500)
+
+    stale = get_stale_devices(router, now=now)
+    device_store = get_device_store(router.id)
+
+    for i in range(0, len(stale), batch_size):
+        batch = stale[i:i + batch_size]
+        macs = [mac for _, mac in batch]
+
+        with suppress_router_refresh():
+            Device.objects.filter(pk__in=[pk for pk, _ in batch]).delete()
+
+        device_store.remove(macs)
+        DEFAULT_CACHE.delete_many([get_device_db_cache_key(mac) for mac in macs])
+
+    if stale:
+        touch_device_table(router.id)
+        logger.info(
+            f"Removed {len(stale)} devices offline for more than "
+            f"{router.device_retention_days} days on router {router.id}")
+    return len(stale)
@@ -8,7 +8,7 @@ from django.urls import reverse
 from django.utils.timezone import now
 from rest_framework import serializers
 
-from my_router.models import Device
+from my_router.models import Device, Router
 from my_router.utils import days_string_conversion
 
 
@@ -83,6 +83,22 @@ class DeviceModelSerializer(serializers.ModelSerializer):
             })
 
 
+class RouterSerializer(serializers.ModelSerializer):
+    # The credentials of the router are never exposed
+    class Meta:
+        model = Router
+        fields = ["id", "name", "description", "ikuai_version", "status",
+                  "fetch_interval", "snapshot_age"]
+
+    snapshot_age = serializers.SerializerMethodField()
+
+    def get_snapshot_age(self, obj):
+        from my_router.data_manager import RouterDataManager
+
+        snapshot_age = RouterDataManager(router_instance=obj).get_snapshot_age()
+        return None if snapshot_age is None else int(snapshot_age)
+
+
 class DeviceJsonSerializer(serializers.Serializer):  # noqa
 
     index = serializers.IntegerField(default=0, source="id")
@@ -0,0 +1,59 @@
+from collections import OrderedDict
+from threading import Lock
+
+from django.conf import settings
+
+
+class SnapshotLRUCache:
+    """
+    A process-local LRU of decoded router snapshots, keyed by router id.
+
+    Each entry remembers the snapshot version it was decoded from, a lookup
+    only hits when the version currently stored in the shared cache matches.
+    The cached snapshots are shared between requests of the same worker, so
+    callers must treat them as read-only.
+    """
+
+    def __init__(self, maxsize=16):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, router_id, version):
+        if version is None:
+            return None
+
+        with self._lock:
+            entry = self._entries.get(router_id)
+            if entry is None:
+                return None
+
+            cached_version, snapshot = entry
+            if cached_version != version:
+                del self._entries[router_id]
+                return None
+
+            self._entries.move_to_end(router_id)
+            return snapshot
+
+    def set(self, router_id, version, snapshot):
+        if version is None or self.maxsize <= 0:
+            return
+
+        with self._lock:
+            self._entries[router_id] = (version, snapshot)
+            self._entries.move_to_end(router_id)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def discard(self, router_id):
+        with self._lock:
+            self._entries.pop(router_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+snapshot_cache = SnapshotLRUCache(
+    maxsize=getattr(settings, "BEHAVIORAL_CONTROL_SNAPSHOT_LRU_SIZE", 16))
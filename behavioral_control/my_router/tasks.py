@@ -1,10 +1,29 @@
 from django.utils.translation import gettext as _
 
 from celery import shared_task
+from my_router.circuit_breaker import RouterUnavailable
+from my_router.constants import router_call_priority
+from my_router.models import Router
+from my_router.rate_limit import call_priority
+from my_router.retention import acquire_compaction_lock, compact_router_devices
 from my_router.views import fetch_new_info_save_and_set_cache
 
 
 @shared_task(bind=True, name="fetch_devices_and_set_cache")
 def fetch_devices_and_set_cache(self, router_id):
-    fetch_new_info_save_and_set_cache(router_id)
+    # Polls yield to interactive router calls of the same worker.
+    with call_priority(router_call_priority.background):
+        try:
+            fetch_new_info_save_and_set_cache(router_id)
+        except RouterUnavailable as e:
+            # The circuit opened during this fetch, the next poll will probe.
+            return {"message": str(e)}
+
+    # At most once per compaction interval, remove the devices offline for
+    # longer than the retention of the router.
+    if acquire_compaction_lock(router_id):
+        # The router might be deleted before its task
+        router = Router.objects.filter(id=router_id).first()
+        if router is not None:
+            compact_router_devices(router)
     return {"message": _("Done")}
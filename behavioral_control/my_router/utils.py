@@ -1,15 +1,33 @@
 from __future__ import annotations
 
+import functools
+
 from django import forms
+from django.core.cache import caches
 
+from my_router import logger
 from my_router.constants import (
     CACHE_VERSION, DEVICE_DB_CACHE_KEY_PATTERN,
-    ROUTER_ACL_L7_LIST_CACHE_KEY_PATTERN, ROUTER_DEVICE_CACHE_KEY_PATTERN,
-    ROUTER_DEVICE_MAC_ADDRESSES_CACHE_KEY_PATTERN,
+    ROUTER_ACL_L7_LIST_CACHE_KEY_PATTERN,
+    ROUTER_ACL_MAC_INDEX_CACHE_KEY_PATTERN,
+    ROUTER_API_LIMITER_CACHE_KEY_PATTERN,
+    ROUTER_CATALOG_VERSION_CACHE_KEY_PATTERN,
+    ROUTER_CIRCUIT_COOL_DOWN_CACHE_KEY_PATTERN,
+    ROUTER_CIRCUIT_FAILURES_CACHE_KEY_PATTERN,
+    ROUTER_CIRCUIT_PROBE_CACHE_KEY_PATTERN,
+    ROUTER_DEVICE_COMPACTION_LOCK_CACHE_KEY_PATTERN,
     ROUTER_DEVICE_MAC_GROUPS_LIST_CACHE_KEY_PATTERN,
+    ROUTER_DEVICE_RECORDS_CACHE_KEY_PATTERN,
+    ROUTER_DEVICE_TABLE_VERSION_CACHE_KEY_PATTERN,
     ROUTER_DEVICES_BLOCK_MAC_BY_ACL_L7_CACHE_KEY_PATTERN,
     ROUTER_DEVICES_CACHE_KEY_PATTERN,
     ROUTER_DOMAIN_BLACKLIST_CACHE_KEY_PATTERN,
+    ROUTER_DOMAIN_GROUP_CATALOG_CACHE_KEY_PATTERN,
+    ROUTER_EVENTS_CACHE_KEY_PATTERN, ROUTER_KNOWN_MACS_CACHE_KEY_PATTERN,
+    ROUTER_MAC_COMMENT_INDEX_CACHE_KEY_PATTERN,
+    ROUTER_PROTOCOL_CATALOG_CACHE_KEY_PATTERN,
+    ROUTER_SNAPSHOT_FETCHED_AT_CACHE_KEY_PATTERN,
+    ROUTER_SNAPSHOT_VERSION_CACHE_KEY_PATTERN,
     ROUTER_URL_BLACK_LIST_CACHE_KEY_PATTERN, days_const)
 
 
@@ -41,13 +59,43 @@ class CacheDataDoesNotExist(Exception):
     pass
 
 
-def get_router_device_cache_key(router_id, mac_address):
-    return ROUTER_DEVICE_CACHE_KEY_PATTERN.format(
-        router_id=router_id, mac=mac_address, cache_version=CACHE_VERSION)
+def get_default_redis_connection():
+    """
+    Return the raw Redis connection of the default cache, or None if the
+    default cache is not a django_redis cache.
+    """
+    try:
+        from django_redis import get_redis_connection
+        return get_redis_connection("default")
+    except (ImportError, NotImplementedError):
+        return None
+
+
+def omit_redis_exception(return_value=None):
+    # Like django_redis with IGNORE_EXCEPTIONS, connection errors are logged
+    # and ignored, so that pages still render when Redis is down.
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            from redis.exceptions import ConnectionError, TimeoutError
+            try:
+                return method(self, *args, **kwargs)
+            except (ConnectionError, TimeoutError) as e:
+                if not getattr(caches["default"], "_ignore_exceptions", False):
+                    raise
+                logger.error(f"Redis error ignored: {type(e).__name__}: {e}")
+                return return_value() if callable(return_value) else return_value
+        return wrapper
+    return decorator
+
+
+def get_router_known_macs_cache_key(router_id):
+    return ROUTER_KNOWN_MACS_CACHE_KEY_PATTERN.format(
+        router_id=router_id, cache_version=CACHE_VERSION)
 
 
-def get_router_all_devices_mac_cache_key(router_id):
-    return ROUTER_DEVICE_MAC_ADDRESSES_CACHE_KEY_PATTERN.format(
+def get_router_device_records_cache_key(router_id):
+    return ROUTER_DEVICE_RECORDS_CACHE_KEY_PATTERN.format(
         router_id=router_id, cache_version=CACHE_VERSION)
 
 
@@ -89,6 +137,90 @@ def get_domain_blacklist_cache_key(router_id):
         cache_version=CACHE_VERSION)
 
 
+def get_snapshot_version_cache_key(router_id):
+    return ROUTER_SNAPSHOT_VERSION_CACHE_KEY_PATTERN.format(
+        router_id=router_id,
+        cache_version=CACHE_VERSION)
+
+
+def get_device_table_version_cache_key(router_id):
+    return ROUTER_DEVICE_TABLE_VERSION_CACHE_KEY_PATTERN.format(
+        router_id=router_id,
+        cache_version=CACHE_VERSION)
+
+
+def get_snapshot_fetched_at_cache_key(router_id):
+    return ROUTER_SNAPSHOT_FETCHED_AT_CACHE_KEY_PATTERN.format(
+        router_id=router_id,
+        cache_version=CACHE_VERSION)
+
+
+def get_device_compaction_lock_cache_key(router_id):
+    return ROUTER_DEVICE_COMPACTION_LOCK_CACHE_KEY_PATTERN.format(
+        router_id=router_id,
+        cache_version=CACHE_VERSION)
+
+
+def get_mac_comment_index_cache_key(router_id):
+    return ROUTER_MAC_COMMENT_INDEX_CACHE_KEY_PATTERN.format(
+        router_id=router_id,
+        cache_version=CACHE_VERSION)
+
+
+def get_acl_mac_index_cache_key(router_id):
+    return ROUTER_ACL_MAC_INDEX_CACHE_KEY_PATTERN.format(
+        router_id=router_id,
+        cache_version=CACHE_VERSION)
+
+
+def get_protocol_catalog_cache_key(router_id):
+    return ROUTER_PROTOCOL_CATALOG_CACHE_KEY_PATTERN.format(
+        router_id=router_id,
+        cache_version=CACHE_VERSION)
+
+
+def get_catalog_version_cache_key(router_id):
+    return ROUTER_CATALOG_VERSION_CACHE_KEY_PATTERN.format(
+        router_id=router_id,
+        cache_version=CACHE_VERSION)
+
+
+def get_domain_group_catalog_cache_key(router_id):
+    return ROUTER_DOMAIN_GROUP_CATALOG_CACHE_KEY_PATTERN.format(
+        router_id=router_id,
+        cache_version=CACHE_VERSION)
+
+
+def get_router_events_cache_key(router_id):
+    return ROUTER_EVENTS_CACHE_KEY_PATTERN.format(
+        router_id=router_id,
+        cache_version=CACHE_VERSION)
+
+
+def get_circuit_failures_cache_key(router_id):
+    return ROUTER_CIRCUIT_FAILURES_CACHE_KEY_PATTERN.format(
+        router_id=router_id,
+        cache_version=CACHE_VERSION)
+
+
+def get_circuit_cool_down_cache_key(router_id):
+    return ROUTER_CIRCUIT_COOL_DOWN_CACHE_KEY_PATTERN.format(
+        router_id=router_id,
+        cache_version=CACHE_VERSION)
+
+
+def get_circuit_probe_cache_key(router_id):
+    return ROUTER_CIRCUIT_PROBE_CACHE_KEY_PATTERN.format(
+        router_id=router_id,
+        cache_version=CACHE_VERSION)
+
+
+def get_router_api_limiter_cache_key(router_id):
+    return ROUTER_API_LIMITER_CACHE_KEY_PATTERN.format(
+        router_id=router_id,
+        cache_version=CACHE_VERSION)
+
+
 def days_string_conversion(input_, reverse_=False):
     """
     This function either converts a string containing digits 1 to 7 to a list of
@@ -136,3 +268,8 @@ def find_data_with_id_from_list_of_dict(l_of_d: list, id_to_find):
             return d
 
     raise ValueError(f"id {id_to_find} not found in give data.")
+
+
+def join_row_ids(row_ids):
+    # The router deletes several rows in one call with comma-joined ids
+    return ",".join(str(row_id) for row_id in row_ids)
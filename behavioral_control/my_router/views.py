@@ -1,26 +1,48 @@
 from __future__ import annotations
 
+import json
 from copy import deepcopy
 from datetime import time
+from time import monotonic
 
+from asgiref.sync import sync_to_async
 from crispy_forms.layout import Layout, Submit
 from django import forms
+from django.conf import settings
 from django.contrib import messages
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.mixins import LoginRequiredMixin
-from django.db import transaction
-from django.http import (Http404, HttpResponseForbidden, HttpResponseRedirect,
-                         JsonResponse)
+from django.core.handlers.asgi import ASGIRequest
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import close_old_connections, transaction
+from django.http import (Http404, HttpResponse, HttpResponseForbidden,
+                         HttpResponseRedirect, JsonResponse,
+                         StreamingHttpResponse)
 from django.shortcuts import get_object_or_404, redirect, render
 from django.urls import reverse, reverse_lazy
+from django.utils.crypto import constant_time_compare
 from django.utils.translation import gettext_lazy as _
 from django.views.generic.edit import FormView, UpdateView
 
-from my_router.data_manager import RouterDataManager
-from my_router.forms import BaseEditWithApplyToForm
+from my_router import logger, metrics
+from my_router.autocomplete import (AUTOCOMPLETE_KINDS, get_prefix_index,
+                                    search_items)
+from my_router.bulk import (BULK_DEVICE_ACTIONS, BULK_DEVICE_MAC_GROUP_ACTIONS,
+                            BulkUpdateError, bulk_delete_rules,
+                            bulk_update_devices, get_bulk_device_action_kwargs)
+from my_router.circuit_breaker import (ROUTER_UNREACHABLE_ERRORS,
+                                       RouterCircuitBreaker)
+from my_router.constants import DEFAULT_CACHE
+from my_router.data_manager import (RouterDataManager,
+                                    get_rd_manager_from_snapshot)
+from my_router.events import (get_last_event_id, is_event_stream_shared,
+                              read_events)
+from my_router.forms import (BaseEditWithApplyToForm, get_choice_field,
+                             get_multiple_choice_field)
 from my_router.models import Device, Router
+from my_router.responses import json_response
 from my_router.utils import (StyledForm, StyledModelForm,
-                             find_data_with_id_from_list_of_dict)
+                             get_snapshot_version_cache_key)
 
 
 def routers_context_processor(request):
@@ -62,11 +84,49 @@ def fetch_new_info_save_and_set_cache(router_id: int | None = None,
 
     assert router is not None and router_id is not None
 
+    with metrics.collect_fetch(router_id):
+        _fetch_new_info_save_and_set_cache(router, router_id)
+
+
+def _fetch_new_info_save_and_set_cache(router, router_id):
     rd_manager = RouterDataManager(router_instance=router)
-    rd_manager.cache_each_device_info()
-    rd_manager.cache_all_data()
-    rd_manager.update_all_mac_cache()
-    rd_manager.update_mac_control_rule_from_acl_l7()
+
+    breaker = RouterCircuitBreaker(router_id)
+    if breaker.is_open():
+        # Only one worker probes the router after the cool-down, the others
+        # skip the fetch and the cached snapshot is served as stale.
+        if not breaker.acquire_probe():
+            logger.info(f"Router {router_id} is unreachable, skipped fetching")
+            return
+
+        try:
+            rd_manager.ikuai_client.probe()
+        except ROUTER_UNREACHABLE_ERRORS:
+            logger.info(f"Router {router_id} is still unreachable")
+            return
+
+    # The fetch of the devices and their sync to the database are timed
+    # as stages of their own, see RouterDataManager.devices
+    rd_manager.devices  # noqa
+    with metrics.time_stage(router_id, "device_cache"):
+        rd_manager.cache_each_device_info()
+    with metrics.time_stage(router_id, "snapshot_cache"):
+        rd_manager.cache_all_data()
+    with metrics.time_stage(router_id, "mac_cache"):
+        rd_manager.update_all_mac_cache()
+    with metrics.time_stage(router_id, "mac_index"):
+        rd_manager.cache_mac_indexes()
+    with metrics.time_stage(router_id, "mac_control"):
+        rd_manager.update_mac_control_rule_from_acl_l7()
+
+
+def set_snapshot_staleness_headers(response, rd_manager):
+    snapshot_age = rd_manager.get_snapshot_age()
+    if snapshot_age is not None:
+        response["X-Router-Snapshot-Age"] = str(int(snapshot_age))
+    if rd_manager.is_snapshot_stale(snapshot_age):
+        response["X-Router-Snapshot-Stale"] = "1"
+    return response
 
 
 @login_required
@@ -82,7 +142,13 @@ def fetch_cached_info(request, router_id, info_name):
             rd_manager.init_data_from_cache()
             info = rd_manager.get_view_data(
                 info_name=info_name, query_params=query_params)
-            return JsonResponse(data=info, safe=False)
+            response = json_response(request, info)
+            set_snapshot_staleness_headers(response, rd_manager)
+            # The live updates of the page start from this version
+            if rd_manager.loaded_snapshot_version is not None:
+                response["X-Router-Snapshot-Version"] = (
+                    rd_manager.loaded_snapshot_version)
+            return response
         except Exception as e:
             import traceback
             traceback.print_exc()
@@ -93,6 +159,254 @@ def fetch_cached_info(request, router_id, info_name):
     return HttpResponseForbidden()
 
 
+# The key identifying a row of the view data, for the live updates
+VIEW_DATA_ROW_KEYS = {
+    "device": "mac",
+    "domain_blacklist": "id",
+    "url_black": "id",
+    "acl_l7": "id",
+    "mac_group": "id",
+}
+
+
+def get_view_data_row_list(rd_manager, info_name, query_params):
+    rows = rd_manager.get_view_data(
+        info_name=info_name, query_params=query_params)
+    if isinstance(rows, dict):
+        # The url_black rules are grouped by "enabled" and "disabled"
+        rows = [row for group in rows.values() for row in group]
+    return rows
+
+
+def get_view_data_rows(router, info_name, query_params):
+    rd_manager = RouterDataManager(router_instance=router)
+    rd_manager.init_data_from_cache()
+    row_key = VIEW_DATA_ROW_KEYS[info_name]
+    return {
+        row[row_key]: row
+        for row in get_view_data_row_list(rd_manager, info_name, query_params)}
+
+
+def diff_view_data_rows(old_rows, new_rows):
+    """
+    Return the rows added or changed, and the keys of the rows removed.
+    """
+    upsert = [
+        row for key, row in new_rows.items() if old_rows.get(key) != row]
+    remove = [key for key in old_rows if key not in new_rows]
+    return upsert, remove
+
+
+def format_sse(data=None, event=None, event_id=None):
+    lines = []
+    if event_id is not None:
+        lines.append(f"id: {event_id}")
+    if event is not None:
+        lines.append(f"event: {event}")
+    if data is not None:
+        lines.append(f"data: {data}")
+    return "\n".join(lines) + "\n\n"
+
+
+def iter_view_data_deltas(router, info_name, query_params, last_id=None,
+                          version=None):
+    """
+    Yield Server-Sent Events with the rows of the view data changed since
+    the page loaded, each time the snapshot of the router changes. A
+    "reload" event is sent instead when the rows of the client are unknown:
+    when reconnecting after changes, or when the snapshot *version* the page
+    loaded its rows from is not the current one.
+
+    The stream ends after BEHAVIORAL_CONTROL_LIVE_UPDATE_TIMEOUT seconds so
+    that workers are not held forever, the browser then reconnects.
+    """
+    timeout = getattr(settings, "BEHAVIORAL_CONTROL_LIVE_UPDATE_TIMEOUT", 60)
+    heartbeat = getattr(
+        settings, "BEHAVIORAL_CONTROL_LIVE_UPDATE_HEARTBEAT", 15)
+    deadline = monotonic() + timeout
+
+    yield "retry: 3000\n\n"
+
+    if last_id and read_events(router.id, last_id=last_id, count=1):
+        # Changed while disconnected
+        last_id = get_last_event_id(router.id)
+        yield format_sse(data="{}", event="reload", event_id=last_id)
+    elif not last_id:
+        last_id = get_last_event_id(router.id)
+        if version and version != get_current_snapshot_version(router):
+            # Changed between the page load and this connection
+            yield format_sse(data="{}", event="reload", event_id=last_id)
+
+    rows = get_view_data_rows(router, info_name, query_params)
+
+    while monotonic() < deadline:
+        block = max(min(heartbeat, deadline - monotonic()), 0.001)
+        events = read_events(router.id, last_id=last_id, block=int(block * 1000))
+        if not events:
+            yield ": keep-alive\n\n"
+            continue
+
+        last_id = events[-1][0]
+        new_rows = get_view_data_rows(router, info_name, query_params)
+        upsert, remove = diff_view_data_rows(rows, new_rows)
+        rows = new_rows
+
+        if upsert or remove:
+            data = json.dumps(
+                {"upsert": upsert, "remove": remove}, cls=DjangoJSONEncoder)
+            yield format_sse(data=data, event="delta", event_id=last_id)
+        else:
+            # Only move the position of the client
+            yield format_sse(event_id=last_id)
+
+
+async def aiter_view_data_deltas(*args, **kwargs):
+    """
+    :func:`iter_view_data_deltas` for ASGI servers, which would read a sync
+    iterator to its end before sending anything. Each event is produced in
+    a thread apart from the one of the sync views, since waiting for the
+    router events blocks.
+    """
+    events = iter_view_data_deltas(*args, **kwargs)
+    get_next_event = sync_to_async(_get_next_event, thread_sensitive=False)
+    try:
+        while (event := await get_next_event(events)) is not None:
+            yield event
+    finally:
+        await sync_to_async(_close_events, thread_sensitive=False)(events)
+
+
+def _get_next_event(events):
+    try:
+        return next(events, None)
+    finally:
+        # Not closed at the end of a request in the threads of sync_to_async
+        close_old_connections()
+
+
+def _close_events(events):
+    events.close()
+    close_old_connections()
+
+
+def get_current_snapshot_version(router):
+    return DEFAULT_CACHE.get(get_snapshot_version_cache_key(router.id))
+
+
+def get_snapshot_poll_events(router, last_id=None, version=None):
+    """
+    The events of a live update stream which is polled instead of held
+    open: the client reconnects after the fetch interval of the router, and
+    reloads the table if the snapshot version changed since its last poll
+    (or, at the first poll, since its page loaded the snapshot *version*).
+    The id of the events is the snapshot version.
+    """
+    event_id = "v:%s" % get_current_snapshot_version(router)
+    if not last_id and version:
+        last_id = f"v:{version}"
+    poll_interval = max(
+        router.fetch_interval,
+        getattr(settings, "BEHAVIORAL_CONTROL_LIVE_UPDATE_POLL_INTERVAL", 5))
+
+    ret = f"retry: {poll_interval * 1000}\n\n"
+    if last_id and last_id != event_id:
+        return ret + format_sse(data="{}", event="reload", event_id=event_id)
+    return ret + format_sse(event_id=event_id)
+
+
+def can_stream_live_updates(request):
+    """
+    Whether live updates are pushed through a stream held open, which needs
+    the events of all the processes (a Redis stream) and a server which
+    doesn't dedicate a worker to each open stream (ASGI or gevent). Otherwise
+    the stream is polled, see get_snapshot_poll_events.
+    """
+    streaming = getattr(
+        settings, "BEHAVIORAL_CONTROL_LIVE_UPDATE_STREAMING", None)
+    if streaming is not None:
+        return streaming
+
+    if not is_event_stream_shared():
+        return False
+
+    if isinstance(request, ASGIRequest):
+        # Streamed by aiter_view_data_deltas
+        return True
+
+    try:
+        from gevent import monkey
+    except ImportError:
+        return False
+    return monkey.is_module_patched("socket")
+
+
+@login_required
+def stream_cached_info(request, router_id, info_name):
+    router = get_object_or_404(Router, id=router_id)
+    if info_name not in VIEW_DATA_ROW_KEYS:
+        raise Http404()
+
+    query_params = {}
+    for key, value in request.GET.items():
+        query_params[key] = value
+
+    # The snapshot version the page loaded its rows from, see fetch_cached_info
+    version = query_params.pop("version", None)
+
+    last_id = request.headers.get("Last-Event-ID")
+    if can_stream_live_updates(request):
+        # An async iterator is streamed as it goes by ASGI servers only
+        iter_deltas = (
+            aiter_view_data_deltas if isinstance(request, ASGIRequest)
+            else iter_view_data_deltas)
+        response = StreamingHttpResponse(
+            iter_deltas(
+                router, info_name, query_params, last_id=last_id,
+                version=version),
+            content_type="text/event-stream")
+    else:
+        response = HttpResponse(
+            get_snapshot_poll_events(router, last_id=last_id, version=version),
+            content_type="text/event-stream")
+    response["Cache-Control"] = "no-cache"
+    # Not buffered by nginx
+    response["X-Accel-Buffering"] = "no"
+    return response
+
+
+@login_required
+def autocomplete(request, router_id, kind):
+    router = get_object_or_404(Router, id=router_id)
+    if kind not in AUTOCOMPLETE_KINDS:
+        raise Http404()
+
+    try:
+        page = int(request.GET.get("page", 1))
+    except ValueError:
+        page = 1
+
+    rd_manager = get_rd_manager_from_snapshot(router)
+    return json_response(
+        request,
+        search_items(rd_manager, kind, request.GET.get("term"), page))
+
+
+def metrics_view(request):
+    # Scraped by Prometheus with a bearer token, or browsed by staff.
+    token = getattr(settings, "BEHAVIORAL_CONTROL_METRICS_TOKEN", None)
+    authorized = request.user.is_authenticated and request.user.is_staff
+    if not authorized and token:
+        authorized = constant_time_compare(
+            request.headers.get("Authorization", ""), f"Bearer {token}")
+
+    if not authorized:
+        return HttpResponseForbidden()
+
+    return HttpResponse(
+        metrics.render_metrics(),
+        content_type="text/plain; version=0.0.4; charset=utf-8")
+
+
 class DeviceForm(StyledModelForm):
     class Meta:
         model = Device
@@ -105,6 +419,7 @@ class DeviceForm(StyledModelForm):
 
         mac_group_choices = kwargs.pop("mac_group_choices", ())
         mac_group_initial = kwargs.pop("mac_group_initial", ())
+        mac_group_url = kwargs.pop("mac_group_url", None)
         is_blocked = kwargs.pop("reject", False)
         has_error = kwargs.pop("has_error", False)
         super().__init__(*args, **kwargs)
@@ -116,7 +431,8 @@ class DeviceForm(StyledModelForm):
             label=_("Blocked"),
             initial=is_blocked, required=False)
 
-        self.fields["mac_group"] = forms.MultipleChoiceField(
+        self.fields["mac_group"] = get_multiple_choice_field(
+            autocomplete_url=mac_group_url,
             label=_("Mac Group"),
             choices=mac_group_choices, initial=mac_group_initial,
             required=False)
@@ -149,12 +465,14 @@ class DeviceUpdateView(LoginRequiredMixin, UpdateView):
     def get_form_kwargs(self):
         kwargs = super().get_form_kwargs()
 
-        router_id = self.kwargs["router_id"]
-        self.rd_manager = RouterDataManager(router_id=router_id)
+        self.rd_manager = get_rd_manager_from_snapshot(self.object.router)
+        if self.request.method == "POST":
+            # The router is edited from its current data, not the snapshot
+            self.rd_manager.reload_edit_data()
 
         try:
-            device_with_rules = self.rd_manager.get_device_rule_data()[
-                self.object.mac]
+            device_with_rules = self.rd_manager.get_device_rule_data_for_mac(
+                self.object.mac)
             self._original_data = deepcopy(device_with_rules)
 
             kwargs["reject"] = bool(device_with_rules["reject"])
@@ -163,6 +481,8 @@ class DeviceUpdateView(LoginRequiredMixin, UpdateView):
 
             kwargs["mac_group_choices"] = (
                 (v, v) for v in mac_groups)
+            kwargs["mac_group_url"] = reverse(
+                "autocomplete", args=(self.object.router_id, "mac_group"))
 
             kwargs["mac_group_initial"] = (
                 self.rd_manager.mac_groups_reverse.get(self.object.mac, ()))
@@ -201,17 +521,7 @@ class DeviceUpdateView(LoginRequiredMixin, UpdateView):
 
         if "name" in changed_data:
             new_name = form_data["name"]
-            mac_comment_list = (
-                self.rd_manager.ikuai_client.list_mac_comment().get("data", []))
-            for item in mac_comment_list:
-                if item["mac"] == mac:
-                    self.rd_manager.ikuai_client.edit_mac_comment(
-                        mac_comment_id=item["id"], mac=mac, comment=new_name
-                    )
-            else:
-                self.rd_manager.ikuai_client.add_mac_comment(
-                    mac=mac, comment=new_name
-                )
+            self.rd_manager.set_mac_comment(mac, new_name)
 
             update_cache_kwargs["comment"] = new_name
 
@@ -219,49 +529,32 @@ class DeviceUpdateView(LoginRequiredMixin, UpdateView):
 
         if "reject" in changed_data:
             if form_data["reject"] is True:
-                self.rd_manager.ikuai_client.add_acl_mac(
-                    mac=self._original_data["mac"]
-                )
+                self.rd_manager.add_acl_mac_rule({"mac": mac})
                 update_cache_kwargs["reject"] = 1
             else:
-                acl_mac_list = (
-                    self.rd_manager.ikuai_client.list_acl_mac().get("data", []))
-
-                ids_to_rm = [acl_mac["id"] for acl_mac in acl_mac_list]
-
-                for _id in ids_to_rm:
-                    self.rd_manager.ikuai_client.del_acl_mac(_id)
-
+                self.rd_manager.remove_acl_macs_of_device(mac)
                 update_cache_kwargs["reject"] = 0
             remote_updated = True
 
         if "mac_group" in changed_data:
-            group_names_contain = form_data["mac_group"]
-            router_mac_group_infos = self.rd_manager.mac_groups_list["data"]
-
-            for info in router_mac_group_infos:
-                group_name = info["group_name"]
-                addr_pools = info["addr_pool"].split(",")
-                group_id = info["id"]
-
-                if group_name not in group_names_contain:
-                    addr_pools = [v for v in addr_pools if v != self.object.mac]
-                    if not addr_pools:
-                        messages.add_message(
-                            self.request,
-                            messages.ERROR,
-                            _(
-                                "The device is the only element in group '%s' "
-                                "and can't be removed.") % (group_name,))
-                        continue
-                else:
-                    addr_pools.append(self.object.mac)
+            # Only the groups the device joins or leaves are edited
+            current_groups = set(
+                self.rd_manager.mac_groups_reverse.get(self.object.mac, ()))
+            new_groups = set(form_data["mac_group"])
 
-                self.rd_manager.ikuai_client.edit_mac_group(
-                    group_id=group_id, group_name=group_name,
-                    addr_pools=addr_pools)
+            skipped_groups = self.rd_manager.edit_mac_group_members(
+                [self.object.mac],
+                join_groups=new_groups - current_groups,
+                leave_groups=current_groups - new_groups)
+
+            for group_name in skipped_groups:
+                messages.add_message(
+                    self.request,
+                    messages.ERROR,
+                    _(
+                        "The device is the only element in group '%s' "
+                        "and can't be removed.") % (group_name,))
 
-            self.rd_manager.reset_property_cache()
             remote_updated = True
 
         if update_cache_kwargs:
@@ -315,15 +608,60 @@ def list_devices(request, router_id):
     return render(request, "my_router/device-list.html", {
         "router_id": router_id,
         "form_description": _("List of devices"),
+        "bulk_device_actions": [
+            (name, description)
+            for name, (description, _kwargs) in BULK_DEVICE_ACTIONS.items()],
+        "bulk_device_mac_group_actions": BULK_DEVICE_MAC_GROUP_ACTIONS.items(),
     })
 
 
+@login_required
+def bulk_update_device_list(request, router_id):
+    router = get_object_or_404(Router, id=router_id)
+
+    if request.method != "POST":
+        return HttpResponseForbidden()
+
+    devices = Device.objects.filter(
+        router=router, mac__in=request.POST.getlist("mac"))
+
+    try:
+        kwargs = get_bulk_device_action_kwargs(
+            request.POST.get("action"), request.POST.getlist("mac_group"))
+        skipped_groups = bulk_update_devices(router, devices, **kwargs)
+    except BulkUpdateError as e:
+        return JsonResponse(
+            data={"error": str(e),
+                  "applied": [str(d) for d in e.applied],
+                  "not_applied": [str(d) for d in e.not_applied]},
+            status=400)
+    except Exception as e:
+        return JsonResponse(
+            data={"error": f"{type(e).__name__}： {str(e)}"}, status=400)
+
+    return JsonResponse(
+        data={"success": True, "skipped_mac_groups": skipped_groups})
+
+
+def get_rule_value_choices(items, rule_value=None):
+    """
+    The choices of a rule picker: the *items* of the catalog, and
+    *rule_value* if the rule uses several values, which are kept together
+    as one choice.
+    """
+    if rule_value and "," in rule_value:
+        return [*items, (rule_value, rule_value)]
+    return items
+
+
 class DomainBlacklistEditForm(BaseEditWithApplyToForm):
     def __init__(self, domain_group_choices,
                  init_domain_group=None, *args, **kwargs):
+        domain_group_url = kwargs.pop("domain_group_url", None)
         super().__init__(*args, **kwargs)
 
-        self.fields["domain_group"] = forms.ChoiceField(
+        self.fields["domain_group"] = get_choice_field(
+            autocomplete_url=domain_group_url,
             label=_("Domain Groups"),
             required=True,
             choices=domain_group_choices,
@@ -354,25 +692,31 @@ def list_domain_blacklist(request, router_id):
     })
 
 
-@login_required
-def delete_domain_blacklist(request, router_id, domain_blacklist_id):
+def delete_rules(request, router_id, kind, rule_ids):
     router = get_object_or_404(Router, id=router_id)
 
-    rd_manager = RouterDataManager(router_instance=router)
-
     if request.method != "POST":
         return HttpResponseForbidden()
     try:
-        rd_manager.ikuai_client.del_domain_blacklist(domain_blacklist_id)
+        bulk_delete_rules(router, kind, rule_ids)
     except Exception as e:
         return JsonResponse(
             data={"error": f"{type(e).__name__}： {str(e)}"}, status=400)
 
-    fetch_new_info_save_and_set_cache(router=router)
-
     return JsonResponse(data={"success": True})
 
 
+@login_required
+def bulk_delete_rule_list(request, router_id, kind):
+    return delete_rules(request, router_id, kind, request.POST.getlist("id"))
+
+
+@login_required
+def delete_domain_blacklist(request, router_id, domain_blacklist_id):
+    return delete_rules(
+        request, router_id, "domain_blacklist", [domain_blacklist_id])
+
+
 class AddEditViewMixin(LoginRequiredMixin):
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
@@ -396,7 +740,7 @@ class AddEditViewMixin(LoginRequiredMixin):
     @property
     def rd_manager(self):
         if self._rd_manager is None:
-            self._rd_manager = RouterDataManager(router_instance=self.router)
+            self._rd_manager = get_rd_manager_from_snapshot(self.router)
         return self._rd_manager
 
     @property
@@ -413,7 +757,8 @@ class AddEditViewMixin(LoginRequiredMixin):
         return self._id_value
 
     def get_all_data_with_id_as_key(self):
-        raise NotImplementedError()
+        # The rules as on the router, not serialized for views
+        return self.rd_manager.rule_id_maps[self.rule_kind]
 
     @property
     def all_data_with_id_as_key(self):
@@ -431,7 +776,8 @@ class AddEditViewMixin(LoginRequiredMixin):
         return ((v, v) for v in list(self.rd_manager.mac_groups.keys()))
 
     def get_data_item(self):
-        return self.all_data_with_id_as_key[self.id_value]
+        self.validate_id_value()
+        return self.rd_manager.get_rule_view_data(self.rule_kind, self.id_value)
 
     @property
     def data_item(self):
@@ -474,6 +820,8 @@ class AddEditViewMixin(LoginRequiredMixin):
         if has_apply_to:
             apply_to_choices = self.get_apply_to_choices()
             kwargs['apply_to_choices'] = apply_to_choices
+            kwargs['apply_to_url'] = reverse(
+                "autocomplete", args=(self.kwargs["router_id"], "mac_group"))
 
             if self.is_add_new:
                 kwargs['apply_to_initial'] = []
@@ -531,13 +879,11 @@ class DomainBlacklistEditView(AddEditViewMixin, FormView):
     form_weekdays_field_name = "weekdays"
     template_name = 'my_router/domain_blacklist-page.html'
     id_name = "domain_blacklist_id"
+    rule_kind = "domain_blacklist"
     success_url_name = "domain_blacklist-edit"
     form_description_for_edit = _("Edit Domain Blacklist")
     form_description_for_add = _("Add Domain Blacklist")
 
-    def get_all_data_with_id_as_key(self):
-        return self.rd_manager.get_domain_blacklist_data()
-
     def get_extra_form_kwargs(self):
         extra_kwargs = {}
 
@@ -547,12 +893,12 @@ class DomainBlacklistEditView(AddEditViewMixin, FormView):
 
         extra_kwargs['init_domain_group'] = init_domain_group_value
 
-        available_domain_black_list = set(
-            value["domain_group"]
-            for value in self.all_data_with_id_as_key.values())
-
-        extra_kwargs["domain_group_choices"] = (
-                    (v, v) for v in available_domain_black_list)
+        # The domain groups of the router, see autocomplete
+        extra_kwargs["domain_group_choices"] = get_rule_value_choices(
+            get_prefix_index(self.rd_manager, "domain_group").items,
+            init_domain_group_value)
+        extra_kwargs["domain_group_url"] = reverse(
+            "autocomplete", args=(self.kwargs["router_id"], "domain_group"))
 
         return extra_kwargs
 
@@ -601,9 +947,11 @@ class ACLL7EditForm(BaseEditWithApplyToForm):
     def __init__(self, protocols_choices, initial_protocols=None,
                  initial_action="drop",
                  initial_priority=28, *args, **kwargs):
+        protocols_url = kwargs.pop("protocols_url", None)
         super().__init__(*args, **kwargs)
 
-        self.fields["app_proto"] = forms.ChoiceField(
+        self.fields["app_proto"] = get_choice_field(
+            autocomplete_url=protocols_url,
             label=_("APP protocols"),
             required=True,
             choices=protocols_choices,
@@ -642,13 +990,11 @@ class ACLL7EditView(AddEditViewMixin, FormView):
     form_weekdays_field_name = "week"
     template_name = 'my_router/protocol_control-page.html'
     id_name = "acl_l7_id"
+    rule_kind = "acl_l7"
     success_url_name = "acl_l7-list"
     form_description_for_edit = _("Edit Protocol Control")
     form_description_for_add = _("Add Protocol Control")
 
-    def get_all_data_with_id_as_key(self):
-        return self.rd_manager.get_acl_l7_list_data()
-
     def get_form_kwargs(self):
         kwargs = super().get_form_kwargs()
         if self.is_add_new:
@@ -666,12 +1012,12 @@ class ACLL7EditView(AddEditViewMixin, FormView):
 
         extra_kwargs['initial_protocols'] = init_app_proto_value
 
-        available_protocol_list = set(
-            value["app_proto"]
-            for value in self.all_data_with_id_as_key.values())
-
-        extra_kwargs["protocols_choices"] = (
-                    (v, v) for v in available_protocol_list)
+        # The protocols of the router, see autocomplete
+        extra_kwargs["protocols_choices"] = get_rule_value_choices(
+            get_prefix_index(self.rd_manager, "protocol").items,
+            init_app_proto_value)
+        extra_kwargs["protocols_url"] = reverse(
+            "autocomplete", args=(self.kwargs["router_id"], "protocol"))
 
         if not self.is_add_new:
             extra_kwargs["initial_action"] = self.data_item["action"]
@@ -759,6 +1105,7 @@ def list_acl_l7(request, router_id):
         query_params[key] = value
 
     rd_manager = RouterDataManager(router_instance=router)
+    rd_manager.init_data_from_cache()
     acl_l7_list = rd_manager.get_acl_l7_list_for_view(query_params=query_params)
 
     mac_group_names = set(
@@ -796,21 +1143,7 @@ def list_acl_l7(request, router_id):
 
 @login_required
 def delete_acl_l7(request, router_id, acl_l7_id):
-    router = get_object_or_404(Router, id=router_id)
-
-    rd_manager = RouterDataManager(router_instance=router)
-
-    if request.method != "POST":
-        return HttpResponseForbidden()
-    try:
-        rd_manager.ikuai_client.del_acl_l7(acl_l7_id)
-    except Exception as e:
-        return JsonResponse(
-            data={"error": f"{type(e).__name__}： {str(e)}"}, status=400)
-
-    fetch_new_info_save_and_set_cache(router=router)
-
-    return JsonResponse(data={"success": True})
+    return delete_rules(request, router_id, "acl_l7", [acl_l7_id])
 
 
 @login_required
@@ -825,6 +1158,7 @@ class MacGroupEditForm(StyledForm):
 
     def __init__(self, add_new, name_initial,
                  apply_to_choices, apply_to_initial, *args, **kwargs):
+        apply_to_url = kwargs.pop("apply_to_url", None)
         super().__init__(*args, **kwargs)
 
         self.fields["group_name"] = forms.CharField(
@@ -832,7 +1166,8 @@ class MacGroupEditForm(StyledForm):
             max_length=64, required=True,
             initial=name_initial)
 
-        self.fields["apply_to"] = forms.MultipleChoiceField(
+        self.fields["apply_to"] = get_multiple_choice_field(
+            autocomplete_url=apply_to_url,
             label=_("Apply to"),
             choices=apply_to_choices, initial=apply_to_initial,
             required=False
@@ -849,7 +1184,7 @@ class MacGroupEditForm(StyledForm):
 @login_required
 def edit_mac_group(request, router_id, group_id):
     router = get_object_or_404(Router, id=router_id)
-    rd_manager = RouterDataManager(router_instance=router)
+    rd_manager = get_rd_manager_from_snapshot(router)
 
     group_id = int(group_id)
 
@@ -857,25 +1192,22 @@ def edit_mac_group(request, router_id, group_id):
     name_initial = ""
     apply_to_initial = []
     if not is_add_new:
-        try:
-            data_item = find_data_with_id_from_list_of_dict(
-                rd_manager.mac_groups_list["data"], group_id)
-        except ValueError:
+        data_item = rd_manager.rule_id_maps["mac_group"].get(group_id)
+        if data_item is None:
             raise Http404()
 
         name_initial = data_item["group_name"]
         apply_to_initial = data_item["addr_pool"].split(",")
 
-    apply_to_choices = []
-    all_devices = Device.objects.filter(router=router)
-    for d in all_devices:
-        apply_to_choices.append((d.mac, d.name or d.mac))
+    # Only the selected devices are rendered, see autocomplete
+    apply_to_choices = get_prefix_index(rd_manager, "device").items
 
     kwargs = dict(
         add_new=is_add_new,
         name_initial=name_initial,
         apply_to_choices=apply_to_choices,
-        apply_to_initial=apply_to_initial)
+        apply_to_initial=apply_to_initial,
+        apply_to_url=reverse("autocomplete", args=(router_id, "device")))
 
     form_description = _("Edit mac groups")
     if is_add_new:
@@ -932,18 +1264,4 @@ def edit_mac_group(request, router_id, group_id):
 
 @login_required
 def delete_mac_group(request, router_id, group_id):
-    router = get_object_or_404(Router, id=router_id)
-
-    rd_manager = RouterDataManager(router_instance=router)
-
-    if request.method != "POST":
-        return HttpResponseForbidden()
-    try:
-        rd_manager.ikuai_client.del_mac_group(group_id)
-    except Exception as e:
-        return JsonResponse(
-            data={"error": f"{type(e).__name__}： {str(e)}"}, status=400)
-
-    fetch_new_info_save_and_set_cache(router=router)
-
-    return JsonResponse(data={"success": True})
+    return delete_rules(request, router_id, "mac_group", [group_id])
@@ -0,0 +1,226 @@
+"""
+End-to-end benchmark of a poll cycle against a local fake iKuai router.
+
+For each router size, it runs ``fetch_new_info_save_and_set_cache`` (a cold
+run, which creates the devices in the database, then warm runs) and the
+AJAX views serving the cached data, and reports the wall time, the router
+calls, the SQL queries and the cache operations.
+
+Run from the ``behavioral_control`` directory::
+
+    python -m tests.bench_fetch_cycle --devices 100 1000 5000 --latency 0.005
+
+This file is not collected by pytest.
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+from contextlib import contextmanager
+from statistics import median
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def setup_django():
+    if BASE_DIR not in sys.path:
+        sys.path.insert(0, BASE_DIR)
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "behavioral_control.settings")
+    os.environ.setdefault(
+        "BEHAVIORAL_CONTROL_LOCAL_TEST_SETTINGS",
+        os.path.join(BASE_DIR, "tests", "settings_for_tests.py"))
+
+    import django
+    django.setup()
+
+
+class CountingCache:
+    # Counts the operations of the cache wrapped by DEFAULT_CACHE
+    def __init__(self, cache_instance):
+        self._cache = cache_instance
+        self.ops = 0
+
+    def __getattr__(self, name):
+        attr = getattr(self._cache, name)
+        if not callable(attr) or name.startswith("_"):
+            return attr
+
+        def counted(*args, **kwargs):
+            self.ops += 1
+            return attr(*args, **kwargs)
+
+        return counted
+
+
+@contextmanager
+def measure(server, counting_cache):
+    from django.db import connection
+    from django.test.utils import CaptureQueriesContext
+
+    result = {}
+    server.router.reset_call_counts()
+    counting_cache.ops = 0
+    with CaptureQueriesContext(connection) as queries:
+        start = time.perf_counter()
+        yield result
+        result["wall_time"] = time.perf_counter() - start
+    result["router_calls"] = server.router.total_calls
+    result["sql_queries"] = len(queries)
+    result["cache_ops"] = counting_cache.ops
+
+
+def bench_router_size(n_devices, latency, repeat, counting_cache,
+                      device_index_offset=0):
+    from django.contrib.auth import get_user_model
+    from django.test import Client
+    from django.urls import reverse
+    from tests.fake_ikuai_server import FakeIKuaiServer
+
+    from my_router.data_manager import RouterDataManager
+    from my_router.models import Device, Router
+    from my_router.views import fetch_new_info_save_and_set_cache
+
+    n_mac_groups = max(n_devices // 50, 1)
+    results = {}
+
+    with FakeIKuaiServer(
+            n_devices=n_devices, n_mac_groups=n_mac_groups,
+            n_acl_l7=n_mac_groups * 2, n_domain_blacklist=n_mac_groups,
+            n_url_black=n_mac_groups, latency=latency,
+            device_index_offset=device_index_offset) as server:
+
+        # Creating the router runs the cold fetch cycle
+        with measure(server, counting_cache) as cold:
+            router = Router.objects.create(
+                name=f"bench-{n_devices}", url=server.url,
+                admin_username=server.username,
+                admin_password=server.password,
+                fetch_interval=60)
+        results["fetch_cold"] = cold
+
+        warm_runs = []
+        for _ in range(repeat):
+            with measure(server, counting_cache) as warm:
+                fetch_new_info_save_and_set_cache(router=router)
+            warm_runs.append(warm)
+        results["fetch_warm"] = summarize(warm_runs)
+        results["devices_in_db"] = Device.objects.filter(router=router).count()
+
+        # All the devices of the router were fetched, not its first page
+        rd_manager = RouterDataManager(router_instance=router)
+        rd_manager.init_data_from_cache()
+        n_fetched = len(rd_manager.devices)
+        assert n_fetched == n_devices, (n_fetched, n_devices)
+
+        user, _ = get_user_model().objects.get_or_create(
+            username="bench", defaults={"is_staff": True})
+        client = Client()
+        client.force_login(user)
+
+        for info_name in ["device", "acl_l7", "mac_group", "domain_blacklist"]:
+            url = reverse("fetch-cached-info", args=(router.id, info_name))
+            runs = []
+            for _ in range(repeat):
+                with measure(server, counting_cache) as view_result:
+                    response = client.get(url)
+                    # Large lists are streamed
+                    content = (
+                        b"".join(response.streaming_content)
+                        if response.streaming else response.content)
+                assert response.status_code == 200, content
+                view_result["response_bytes"] = len(content)
+                runs.append(view_result)
+            results[f"view_{info_name}"] = summarize(runs)
+
+    return results
+
+
+def summarize(runs):
+    # Median of each measurement
+    return {key: median(run[key] for run in runs) for key in runs[0]}
+
+
+def print_results(all_results):
+    header = (
+        f"{'devices':>8} {'stage':<24} {'wall(ms)':>10} {'router':>7} "
+        f"{'sql':>7} {'cache':>7}")
+    print(header)
+    print("-" * len(header))
+    for n_devices, results in all_results.items():
+        for stage, result in results.items():
+            if not isinstance(result, dict):
+                continue
+            print(
+                f"{n_devices:>8} {stage:<24} {result['wall_time'] * 1000:>10.1f} "
+                f"{result['router_calls']:>7} {result['sql_queries']:>7} "
+                f"{result['cache_ops']:>7}")
+        print(f"{n_devices:>8} {'devices in db':<24} {results['devices_in_db']:>10}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--devices", type=int, nargs="+", default=[100, 1000, 5000],
+        help="numbers of devices on the fake router")
+    parser.add_argument(
+        "--latency", type=float, default=0.,
+        help="latency in seconds injected in each router request")
+    parser.add_argument(
+        "--repeat", type=int, default=3, help="warm runs of each stage")
+    parser.add_argument(
+        "--rate-limit", action="store_true",
+        help="keep the router API rate limiter (disabled by default so that "
+             "the numbers reflect the work done)")
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args(argv)
+
+    setup_django()
+
+    from django.conf import settings
+    from django.db import connection
+    from django.test.utils import (override_settings, setup_test_environment,
+                                   teardown_test_environment)
+
+    from my_router import constants
+
+    setup_test_environment()
+    old_db_name = connection.settings_dict["NAME"]
+    connection.creation.create_test_db(verbosity=0)
+
+    counting_cache = CountingCache(constants.DEFAULT_CACHE._cache)
+    constants.DEFAULT_CACHE._cache = counting_cache
+
+    overrides = {}
+    if not args.rate_limit:
+        overrides["BEHAVIORAL_CONTROL_ROUTER_API_RATE"] = 0
+        overrides["BEHAVIORAL_CONTROL_ROUTER_API_CONCURRENCY"] = 0
+
+    all_results = {}
+    device_index_offset = 0
+    try:
+        with override_settings(**overrides):
+            for n_devices in args.devices:
+                # Each router has its own devices, so the first fetch is cold
+                all_results[n_devices] = bench_router_size(
+                    n_devices, args.latency, args.repeat, counting_cache,
+                    device_index_offset=device_index_offset)
+                device_index_offset += n_devices
+    finally:
+        constants.DEFAULT_CACHE._cache = counting_cache._cache
+        connection.creation.destroy_test_db(old_db_name, verbosity=0)
+        teardown_test_environment()
+
+    print_results(all_results)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({
+                "latency": args.latency,
+                "rate_limit": args.rate_limit,
+                "cache_backend": settings.CACHES["default"]["BACKEND"],
+                "results": all_results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,327 @@
+"""
+Microbenchmarks of the CPU heavy parts of rule evaluation and of the view
+data builders, on synthetic data of large routers.
+
+The throughput of each benchmark is divided by that of a fixed calibration
+workload, so that the scores of different machines are comparable. The
+scores are compared with those stored in ``microbenchmark_baseline.json``,
+and the run fails if any of them regresses by more than the threshold.
+
+Run from the ``behavioral_control`` directory::
+
+    python -m tests.bench_microbenchmarks
+    python -m tests.bench_microbenchmarks --filter rule_filter --threshold 0.2
+    python -m tests.bench_microbenchmarks --update-baseline
+
+This file is not collected by pytest.
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+from copy import deepcopy
+from datetime import datetime
+from unittest import mock
+
+from tests.bench_fetch_cycle import setup_django
+
+BASELINE_PATH = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "microbenchmark_baseline.json")
+
+# size name: (devices, mac groups, acl_l7 rules, domain blacklist rules,
+# url black rules, acl_l7 rules of a device)
+SIZES = {
+    "small": (100, 10, 20, 10, 10, 10),
+    "large": (1000, 100, 200, 100, 100, 50),
+}
+
+# Ratio of the online devices which are also cached as offline devices
+OFFLINE_DEVICES_RATIO = 0.1
+
+DEFAULT_THRESHOLD = 0.25
+DEFAULT_MIN_TIME = 0.2
+
+
+def measure(func, min_time=DEFAULT_MIN_TIME, repeat=3):
+    """
+    Return the best throughput, in calls per second, of *repeat* rounds,
+    each of which calls *func* for at least *min_time* seconds.
+    """
+    best = 0.
+    for _ in range(repeat):
+        n_calls = 0
+        start = time.perf_counter()
+        while True:
+            func()
+            n_calls += 1
+            elapsed = time.perf_counter() - start
+            if elapsed >= min_time:
+                break
+        best = max(best, n_calls / elapsed)
+    return best
+
+
+def calibrate(min_time=DEFAULT_MIN_TIME):
+    # Copying and sorting rules, which is what the benchmarked code mostly
+    # does.
+    from tests.data_for_tests import generate_acl_l7_data
+
+    data = generate_acl_l7_data(10, 100)["data"]
+
+    def workload():
+        copied = deepcopy(data)
+        sorted(copied, key=lambda x: (x["prio"], x["time"]))
+
+    return measure(workload, min_time=min_time)
+
+
+def make_data_manager(router, n_devices, n_mac_groups, n_acl_l7,
+                      n_domain_blacklist, n_url_black, device_index_offset=0):
+    """
+    Return a :class:`RouterDataManager` of *router* loaded with synthetic
+    router data. Devices are created in the database, and some offline
+    devices are put in the cache. MAC addresses are generated from
+    *device_index_offset*, so that routers do not share devices.
+    """
+    from django.utils import timezone
+    from tests.data_for_tests import (generate_acl_l7_data,
+                                      generate_domain_blacklist_data,
+                                      generate_mac, generate_mac_groups_data,
+                                      generate_monitor_lanip_data,
+                                      generate_url_black_data)
+    from tests.factories import DeviceFactory
+
+    from my_router.data_manager import RouterDataManager
+    from my_router.models import Device
+
+    n_offline = int(n_devices * OFFLINE_DEVICES_RATIO)
+
+    client = mock.MagicMock()
+    client.list_monitor_lanip.return_value = (
+        generate_monitor_lanip_data(
+            n_devices, device_index_offset=device_index_offset))
+    client.list_mac_groups.return_value = generate_mac_groups_data(
+        n_devices, n_mac_groups, device_index_offset=device_index_offset)
+    client.list_acl_l7.return_value = generate_acl_l7_data(
+        n_mac_groups, n_acl_l7)
+    client.list_domain_blacklist.return_value = (
+        generate_domain_blacklist_data(n_mac_groups, n_domain_blacklist))
+    client.list_url_black.return_value = generate_url_black_data(
+        n_mac_groups, n_url_black)
+
+    Device.objects.bulk_create([
+        DeviceFactory.build(router=router, mac=generate_mac(device_index_offset + i))
+        for i in range(n_devices + n_offline)])
+
+    rd_manager = RouterDataManager(router_instance=router)
+    rd_manager._ikuai_client = client
+
+    with mock.patch.object(RouterDataManager, "update_device_db_instances"):
+        rd_manager.devices  # noqa
+    for attr in ["mac_groups", "acl_l7_list", "domain_blacklist",
+                 "url_black_list"]:
+        getattr(rd_manager, attr)
+
+    offline_devices = generate_monitor_lanip_data(
+        n_offline,
+        device_index_offset=device_index_offset + n_devices)["data"]
+    for device_info in offline_devices:
+        device_info["last_seen"] = timezone.now()
+    rd_manager.device_store.set_records(
+        {device_info["mac"]: device_info for device_info in offline_devices})
+    rd_manager.update_all_mac_cache()
+
+    return rd_manager
+
+
+def get_benchmarks(size_name, router, device_index_offset=0):
+    """
+    Return a dict mapping the benchmark names to callables.
+    """
+    from django.utils import timezone
+    from tests.data_for_tests import generate_device_acl_l7_rule_data
+
+    from my_router.data_manager import RuleDataFilter
+    from my_router.serializers import (AclL7RuleSerializer,
+                                       DeviceWithRuleParseSerializer,
+                                       DomainBlackListSerializer,
+                                       MacGroupRuleSerializer)
+
+    (n_devices, n_mac_groups, n_acl_l7, n_domain_blacklist, n_url_black,
+     n_device_rules) = SIZES[size_name]
+
+    rd_manager = make_data_manager(
+        router, n_devices, n_mac_groups, n_acl_l7, n_domain_blacklist,
+        n_url_black, device_index_offset=device_index_offset)
+
+    device_rules = generate_device_acl_l7_rule_data(n_device_rules)
+    rule_filter = RuleDataFilter(device_rules)
+    now_datetime = timezone.make_aware(datetime(2024, 2, 26, 12, 30))
+
+    def validated(serializer_class, items):
+        serializers = []
+        for item in items:
+            serializer = serializer_class(data=item)
+            serializer.is_valid(raise_exception=True)
+            serializers.append(serializer)
+        return serializers
+
+    acl_l7_serializers = validated(AclL7RuleSerializer, rd_manager.acl_l7_list)
+    domain_blacklist_serializers = validated(
+        DomainBlackListSerializer, rd_manager.domain_blacklist)
+    mac_group_serializers = validated(
+        MacGroupRuleSerializer, rd_manager.mac_groups_list["data"])
+
+    mac_rule_dict = rd_manager.get_device_rule_dict()
+    device_infos = deepcopy(rd_manager.device_dict)
+    for mac, device_info in device_infos.items():
+        device_info.update(mac_rule_dict.get(mac, {}))
+    device_serializers = validated(
+        DeviceWithRuleParseSerializer, list(device_infos.values()))
+    mac_groups_available = list(rd_manager.mac_groups.keys())
+
+    return {
+        "rule_filter.split_weekly": lambda: RuleDataFilter(device_rules),
+        "rule_filter.merge_by_day":
+            rule_filter.merge_similar_strategies_by_day,
+        "rule_filter.find_current_and_next_range":
+            lambda: rule_filter.find_current_and_next_range(now_datetime),
+        "data_manager.get_device_rule_dict": rd_manager.get_device_rule_dict,
+        "data_manager.get_device_rule_data": rd_manager.get_device_rule_data,
+        "data_manager.get_acl_l7_list_data": rd_manager.get_acl_l7_list_data,
+        "serializer.acl_l7.get_datatable_data": lambda: [
+            s.get_datatable_data(router.id) for s in acl_l7_serializers],
+        "serializer.domain_blacklist.get_datatable_data": lambda: [
+            s.get_datatable_data(router.id)
+            for s in domain_blacklist_serializers],
+        "serializer.mac_group.get_datatable_data": lambda: [
+            s.get_datatable_data(router.id) for s in mac_group_serializers],
+        "serializer.device_with_rule.get_datatable_data": lambda: [
+            s.get_datatable_data(mac_groups_available=mac_groups_available)
+            for s in device_serializers],
+    }
+
+
+def run_benchmarks(size_names, name_filter=None, min_time=DEFAULT_MIN_TIME):
+    from tests.factories import RouterFactory
+
+    calibration = calibrate(min_time=min_time)
+    results = {}
+    device_index_offset = 0
+
+    for size_name in size_names:
+        with mock.patch(
+                "my_router.receivers.fetch_new_info_save_and_set_cache"):
+            router = RouterFactory()
+
+        benchmarks = get_benchmarks(
+            size_name, router, device_index_offset=device_index_offset)
+        device_index_offset += 2 * SIZES[size_name][0]
+        for name, func in benchmarks.items():
+            if name_filter and name_filter not in name:
+                continue
+            ops_per_sec = measure(func, min_time=min_time)
+            results[f"{name}[{size_name}]"] = {
+                "ops_per_sec": ops_per_sec,
+                "score": ops_per_sec / calibration,
+            }
+
+    return calibration, results
+
+
+def compare_with_baseline(results, baseline, threshold):
+    """
+    Return a dict mapping the names of the benchmarks which regressed by
+    more than *threshold* to the ratio of their score to the baseline.
+    """
+    regressions = {}
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        ratio = result["score"] / baseline[name]["score"]
+        if ratio < 1 - threshold:
+            regressions[name] = ratio
+    return regressions
+
+
+def print_results(results, baseline):
+    header = f"{'benchmark':<60} {'ops/s':>10} {'score':>10} {'vs base':>8}"
+    print(header)
+    print("-" * len(header))
+    for name, result in results.items():
+        versus = ""
+        if name in baseline:
+            versus = "%.2f" % (result["score"] / baseline[name]["score"])
+        print(
+            f"{name:<60} {result['ops_per_sec']:>10.1f} "
+            f"{result['score']:>10.5f} {versus:>8}")
+
+
+def load_baseline(path):
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)["results"]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--sizes", nargs="+", choices=list(SIZES), default=list(SIZES),
+        help="sizes of the synthetic router data")
+    parser.add_argument(
+        "--filter", help="only run benchmarks whose names contain this")
+    parser.add_argument(
+        "--min-time", type=float, default=DEFAULT_MIN_TIME,
+        help="minimum seconds of each measuring round")
+    parser.add_argument(
+        "--threshold", type=float,
+        default=float(os.environ.get(
+            "BEHAVIORAL_CONTROL_BENCH_THRESHOLD", DEFAULT_THRESHOLD)),
+        help="fail if a score drops by more than this ratio of the baseline")
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument(
+        "--update-baseline", action="store_true",
+        help="write the results to the baseline file instead of comparing")
+    args = parser.parse_args(argv)
+
+    setup_django()
+
+    from django.db import connection
+    from django.test.utils import (override_settings, setup_test_environment,
+                                   teardown_test_environment)
+
+    setup_test_environment()
+    old_db_name = connection.settings_dict["NAME"]
+    connection.creation.create_test_db(verbosity=0)
+
+    try:
+        with override_settings(BEHAVIORAL_CONTROL_METRICS_ENABLED=False):
+            calibration, results = run_benchmarks(
+                args.sizes, name_filter=args.filter, min_time=args.min_time)
+    finally:
+        connection.creation.destroy_test_db(old_db_name, verbosity=0)
+        teardown_test_environment()
+
+    baseline = load_baseline(args.baseline)
+    print(f"calibration: {calibration:.1f} ops/s")
+    print_results(results, baseline)
+
+    if args.update_baseline:
+        baseline.update(results)
+        with open(args.baseline, "w") as f:
+            json.dump(
+                {"results": dict(sorted(baseline.items()))}, f, indent=2)
+        print(f"Baseline written to {args.baseline}")
+        return 0
+
+    regressions = compare_with_baseline(results, baseline, args.threshold)
+    for name, ratio in regressions.items():
+        print(f"REGRESSION: {name} is at {ratio:.0%} of the baseline")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -222,6 +222,21 @@ DEFAULT_DOMAIN_BLACKLIST_EDIT_POST_DATA = {
     'enabled': False,
 }
 
+# Categories with their protocols, like json/protocols_cn.json of the router
+DEFAULT_IKUAI_CLIENT_PROTOCOLS_JSON = [
+    {'name': '所有协议', 'id': 1},
+    {'name': '视频网站', 'id': 2,
+     'children': [{'name': '优酷', 'id': 21}, {'name': '爱奇艺', 'id': 22}]},
+    {'name': '网络游戏', 'id': 3,
+     'children': [{'name': '王者荣耀', 'id': 31}]},
+]
+
+DEFAULT_IKUAI_CLIENT_LIST_DOMAIN_GROUPS = {
+    'total': 3,
+    'data': [{'id': 1, 'group_name': '游戏网站', 'domain': 'game.com'},
+             {'id': 2, 'group_name': '视频网站', 'domain': 'video.com'},
+             {'id': 3, 'group_name': '购物网站', 'domain': 'shop.com'}]}
+
 DEFAULT_IKUAI_CLIENT_LIST_URL_BLACK = {
     'total': 2,
     'data': [{'ip_addr': MAC_GROUP_1,
@@ -241,3 +256,137 @@ DEFAULT_IKUAI_CLIENT_LIST_URL_BLACK = {
               'domain': 'bar.com.foo,foo.com.bar',
               'mode': 0}
              ]}
+
+
+# {{{ synthetic data of large routers
+
+SYNTHETIC_PROTOCOLS = ["所有协议", "网络游戏", "视频网站", "P2P下载", "即时通讯"]
+SYNTHETIC_DOMAIN_GROUPS = ["游戏网站", "视频网站", "购物网站", "社交网站"]
+
+
+def generate_mac(index):
+    return "02:00:%02x:%02x:%02x:%02x" % (
+        (index >> 24) & 0xff, (index >> 16) & 0xff, (index >> 8) & 0xff,
+        index & 0xff)
+
+
+def generate_monitor_lanip_data(n_devices, start_timestamp=1708839156,
+                                device_index_offset=0):
+    data = []
+    for i in range(n_devices):
+        ip_int = 3232263680 + 10 + i  # from 192.168.110.10
+        data.append({
+            'uptime': '2024-02-25 13:32:36',
+            'mac': generate_mac(device_index_offset + i),
+            'dtalk_name': '', 'uprate': '', 'link_addr': '', 'bssid': '',
+            'comment': f'device-{i}' if i % 2 else '',
+            'downrate': '',
+            'reject': 0,
+            'hostname': f'host-{i}',
+            'apmac': '', 'frequencies': '', 'ssid': '', 'apname': '',
+            'ip_addr_int': ip_int,
+            'connect_num': i % 50,
+            'upload': i * 7 % 1000, 'download': i * 13 % 1000,
+            'auth_type': 0,
+            'client_type': 'Unknown', 'client_device': 'Unknown',
+            'timestamp': start_timestamp + i,
+            'id': i + 1,
+            'ac_gid': 0, 'webid': 0, 'ppptype': '',
+            'ip_addr': "%d.%d.%d.%d" % (
+                (ip_int >> 24) & 0xff, (ip_int >> 16) & 0xff,
+                (ip_int >> 8) & 0xff, ip_int & 0xff),
+            'username': '',
+            'total_up': i * 1000, 'total_down': i * 2000,
+            'signal': ''})
+    return {'total': n_devices, 'data': data}
+
+
+def generate_mac_groups_data(n_devices, n_groups, macs_per_group=10,
+                             device_index_offset=0):
+    data = []
+    for i in range(n_groups):
+        macs = [generate_mac(
+                    device_index_offset
+                    + (i * macs_per_group + j) % max(n_devices, 1))
+                for j in range(min(macs_per_group, n_devices))]
+        data.append({
+            'group_name': f'GROUP{i}',
+            'addr_pool': ",".join(dict.fromkeys(macs)),
+            'id': i + 1,
+            'comment': ",".join([""] * len(set(macs)))})
+    return {'total': n_groups, 'data': data}
+
+
+def generate_acl_l7_data(n_groups, n_rules):
+    data = []
+    for i in range(n_rules):
+        start_hour = i % 23
+        data.append({
+            'prio': i % 32,
+            'action': 'drop' if i % 3 else 'accept',
+            'app_proto': SYNTHETIC_PROTOCOLS[i % len(SYNTHETIC_PROTOCOLS)],
+            'src_addr': f'GROUP{i % max(n_groups, 1)}',
+            'dst_addr': '',
+            'week': '1234567' if i % 2 else '12345',
+            'time': '%02d:00-%02d:30' % (start_hour, start_hour + 1),
+            'id': i + 1,
+            'enabled': 'yes' if i % 5 else 'no',
+            'comment': f'rule-{i}'})
+    return {'total': n_rules, 'data': data}
+
+
+def generate_domain_blacklist_data(n_groups, n_rules):
+    data = []
+    for i in range(n_rules):
+        data.append({
+            'time': '00:00-23:59',
+            'id': i + 1,
+            'enabled': 'yes' if i % 2 else 'no',
+            'comment': f'blacklist-{i}',
+            'domain_group':
+                SYNTHETIC_DOMAIN_GROUPS[i % len(SYNTHETIC_DOMAIN_GROUPS)],
+            'weekdays': '1234567',
+            'ipaddr': f'GROUP{i % max(n_groups, 1)}'})
+    return {'total': n_rules, 'data': data}
+
+
+def generate_domain_groups_data():
+    return {'total': len(SYNTHETIC_DOMAIN_GROUPS), 'data': [
+        {'id': i + 1, 'group_name': group_name, 'domain': f'site{i}.com'}
+        for i, group_name in enumerate(SYNTHETIC_DOMAIN_GROUPS)]}
+
+
+def generate_url_black_data(n_groups, n_rules):
+    data = []
+    for i in range(n_rules):
+        data.append({
+            'ip_addr': f'GROUP{i % max(n_groups, 1)}',
+            'id': i + 1,
+            'enabled': 'yes' if i % 2 else 'no',
+            'week': '1234567',
+            'comment': f'url-{i}',
+            'time': '00:00-23:59',
+            'domain': f'site{i}.example.com',
+            'mode': 0})
+    return {'total': n_rules, 'data': data}
+
+
+def generate_device_acl_l7_rule_data(n_rules):
+    # acl_l7 rules of a device as in the device view data, which are the
+    # input of RuleDataFilter
+    data = []
+    for i in range(n_rules):
+        start_hour = i * 5 % 23
+        data.append({
+            'name': f'rule-{i}',
+            # mostly "所有协议", i.e., dropping all protocols
+            'app_proto': SYNTHETIC_PROTOCOLS[0 if i % 3 else i % 5],
+            'enabled': bool(i % 7),
+            'action': 'accept' if i % 4 == 3 else 'drop',
+            'weekdays': ['1234567', '12345', '67', '135'][i % 4],
+            'time': '%02d:00-%02d:%02d' % (
+                start_hour, min(start_hour + 2, 23), 59 if i % 3 else 0),
+            'priority': i % 32})
+    return data
+
+# }}}
@@ -1,7 +1,8 @@
 import factory
 from django.contrib.auth import get_user_model
+from tests.data_for_tests import generate_mac
 
-from my_router.models import Router
+from my_router.models import Device, Router
 
 
 class UserFactory(factory.django.DjangoModelFactory):
@@ -49,3 +50,14 @@ class RouterFactory(factory.django.DjangoModelFactory):
 
     class Meta:
         model = Router
+
+
+class DeviceFactory(factory.django.DjangoModelFactory):
+    # The MAC addresses are those of the synthetic router data, i.e.,
+    # generate_monitor_lanip_data and generate_mac_groups_data
+    name = factory.Sequence(lambda n: "device-%d" % n)
+    mac = factory.Sequence(generate_mac)
+    router = factory.SubFactory(RouterFactory)
+
+    class Meta:
+        model = Device
@@ -0,0 +1,316 @@
+"""
+A local stand-in of an iKuai router, speaking the subset of the web API
+used by :class:`pyikuai.IKuaiClient`, i.e., ``/Action/login``,
+``/Action/call`` and ``/json/protocols_cn.json``.
+
+Usage::
+
+    with FakeIKuaiServer(n_devices=1000, latency=0.01) as server:
+        client = IKuaiClient(
+            url=server.url, username=server.username,
+            password=server.password)
+        client.list_monitor_lanip(limit=[0, 1000])
+"""
+
+import hashlib
+import json
+import secrets
+import threading
+import time
+from collections import Counter
+from copy import deepcopy
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from tests.data_for_tests import (SYNTHETIC_PROTOCOLS, generate_acl_l7_data,
+                                  generate_domain_blacklist_data,
+                                  generate_domain_groups_data,
+                                  generate_mac_groups_data,
+                                  generate_monitor_lanip_data,
+                                  generate_url_black_data)
+
+SESSION_COOKIE_NAME = "sess_key"
+
+# func_name: whether rows can be added/edited/deleted
+FAKE_ROUTER_TABLES = {
+    "monitor_lanip": False,
+    "macgroup": True,
+    "acl_l7": True,
+    "domain_blacklist": True,
+    "domain_group": True,
+    "url_black": True,
+    "mac_comment": True,
+    "acl_mac": True,
+    "mac_qos": True,
+}
+
+
+class FakeIKuaiRouter:
+    """
+    The state of the fake router. Tables are lists of dicts which are
+    shown, added, edited, deleted, enabled and disabled like on the router.
+    """
+
+    def __init__(self, n_devices=100, n_mac_groups=10, n_acl_l7=20,
+                 n_domain_blacklist=10, n_url_black=10, latency=0.,
+                 username="admin", password="admin", device_index_offset=0):
+        # device_index_offset: MAC addresses of the devices are generated
+        # from this index, so that several fake routers do not share devices.
+        self.username = username
+        self.password = password
+        self.latency = latency
+
+        self.tables = {
+            "monitor_lanip": generate_monitor_lanip_data(
+                n_devices,
+                device_index_offset=device_index_offset)["data"],
+            "macgroup": generate_mac_groups_data(
+                n_devices, n_mac_groups,
+                device_index_offset=device_index_offset)["data"],
+            "acl_l7": generate_acl_l7_data(n_mac_groups, n_acl_l7)["data"],
+            "domain_blacklist": generate_domain_blacklist_data(
+                n_mac_groups, n_domain_blacklist)["data"],
+            "domain_group": generate_domain_groups_data()["data"],
+            "url_black": generate_url_black_data(
+                n_mac_groups, n_url_black)["data"],
+            "mac_comment": [],
+            "acl_mac": [],
+            "mac_qos": [],
+        }
+
+        self.sessions = set()
+        self.call_counts = Counter()
+        self._lock = threading.Lock()
+
+    def reset_call_counts(self):
+        with self._lock:
+            self.call_counts.clear()
+
+    @property
+    def total_calls(self):
+        return sum(self.call_counts.values())
+
+    def login(self, payload):
+        expected_passwd = hashlib.md5(self.password.encode()).hexdigest()
+        with self._lock:
+            self.call_counts["login"] += 1
+        if (payload.get("username") != self.username
+                or payload.get("passwd") != expected_passwd):
+            return None
+
+        session = secrets.token_hex(16)
+        with self._lock:
+            self.sessions.add(session)
+        return session
+
+    def drop_sessions(self):
+        # Simulates the router dropping logins, e.g., after a reboot
+        with self._lock:
+            self.sessions.clear()
+
+    def call(self, session, payload):
+        func_name = payload.get("func_name")
+        action = payload.get("action")
+        param = payload.get("param") or {}
+
+        with self._lock:
+            self.call_counts[f"{func_name}:{action}"] += 1
+            if session not in self.sessions:
+                return error_response("no login authentication")
+
+            if func_name == "sysstat" and action == "show":
+                return success_response({
+                    "verinfo": {"verstring": "3.7.10 x64 Build202401011200"},
+                    "cpu": ["3.00%"], "memory": {"used": "20%"},
+                    "stream": {}, "cputemp": [45]})
+
+            if func_name not in FAKE_ROUTER_TABLES:
+                return error_response(f"unknown func_name {func_name}")
+
+            table = self.tables[func_name]
+            if action == "show":
+                return success_response(self.show(table, param))
+
+            if not FAKE_ROUTER_TABLES[func_name]:
+                return error_response(f"{action} not allowed")
+
+            if action == "add":
+                return dict(success_response(), RowId=self.add(table, param))
+            if action == "edit":
+                return self.edit(table, param)
+            if action == "del":
+                self.delete(table, param)
+                return success_response()
+            if action in ("up", "down"):
+                return self.set_enabled(table, param, action == "up")
+
+        return error_response(f"unknown action {action}")
+
+    @staticmethod
+    def show(table, param):
+        types = param.get("TYPE", "total,data").split(",")
+        start, end = map(int, param.get("limit", "0,100").split(","))
+        ret = {}
+        if "total" in types:
+            ret["total"] = len(table)
+        if "data" in types:
+            ret["data"] = deepcopy(table[start:end])
+        return ret
+
+    @staticmethod
+    def _clean_row(param):
+        return {k: v for k, v in param.items() if k != "newRow"}
+
+    def add(self, table, param):
+        new_id = max((row["id"] for row in table), default=0) + 1
+        row = dict(self._clean_row(param), id=new_id)
+        row.setdefault("enabled", "yes")
+        table.append(row)
+        return new_id
+
+    def edit(self, table, param):
+        for row in table:
+            if str(row["id"]) == str(param.get("id")):
+                row.update(self._clean_row(param))
+                row["id"] = int(row["id"])
+                return success_response()
+        return error_response("id not found")
+
+    @staticmethod
+    def delete(table, param):
+        ids = set(str(param.get("id", "")).split(","))
+        table[:] = [row for row in table if str(row["id"]) not in ids]
+
+    @staticmethod
+    def set_enabled(table, param, enabled):
+        ids = set(str(param.get("id", "")).split(","))
+        for row in table:
+            if str(row["id"]) in ids:
+                row["enabled"] = "yes" if enabled else "no"
+        return success_response()
+
+    @staticmethod
+    def get_protocols_json():
+        return [{"name": name, "id": i + 1}
+                for i, name in enumerate(SYNTHETIC_PROTOCOLS)]
+
+
+def success_response(data=None):
+    ret = {"Result": 30000, "ErrMsg": "Success"}
+    if data is not None:
+        ret["Data"] = data
+    return ret
+
+
+def error_response(err_msg):
+    return {"Result": 30001, "ErrMsg": err_msg}
+
+
+class FakeIKuaiRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    @property
+    def router(self) -> FakeIKuaiRouter:
+        return self.server.router
+
+    def log_message(self, format, *args):
+        pass
+
+    def _read_json(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length) if length else b""
+        try:
+            return json.loads(body or b"{}")
+        except json.JSONDecodeError:
+            return {}
+
+    def _get_session(self):
+        for item in (self.headers.get("Cookie") or "").split(";"):
+            name, _, value = item.strip().partition("=")
+            if name == SESSION_COOKIE_NAME:
+                return value
+        return None
+
+    def _send_json(self, data, status=200, headers=None):
+        body = json.dumps(data, ensure_ascii=False).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _simulate_latency(self):
+        if self.router.latency:
+            time.sleep(self.router.latency)
+
+    def do_POST(self):  # noqa
+        self._simulate_latency()
+        payload = self._read_json()
+
+        if self.path == "/Action/login":
+            session = self.router.login(payload)
+            if session is None:
+                return self._send_json(
+                    {"Result": 10001, "ErrMsg": "wrong username or password"})
+            return self._send_json(
+                {"Result": 10000, "ErrMsg": "Success"},
+                headers={
+                    "Set-Cookie": f"{SESSION_COOKIE_NAME}={session}; Path=/"})
+
+        if self.path == "/Action/call":
+            return self._send_json(
+                self.router.call(self._get_session(), payload))
+
+        self._send_json({}, status=404)
+
+    def do_GET(self):  # noqa
+        self._simulate_latency()
+        if self.path == "/json/protocols_cn.json":
+            return self._send_json(self.router.get_protocols_json())
+        self._send_json({}, status=404)
+
+
+class FakeIKuaiServer:
+    """
+    Serves a :class:`FakeIKuaiRouter` on localhost in a background thread.
+    Keyword arguments are passed to :class:`FakeIKuaiRouter`.
+    """
+
+    def __init__(self, host="127.0.0.1", port=0, **router_kwargs):
+        self.router = FakeIKuaiRouter(**router_kwargs)
+        self.httpd = ThreadingHTTPServer((host, port), FakeIKuaiRequestHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.router = self.router
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    @property
+    def username(self):
+        return self.router.username
+
+    @property
+    def password(self):
+        return self.router.password
+
+    def start(self):
+        self._thread = threading.Thread(
+            target=self.httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        if self._thread is not None:
+            self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
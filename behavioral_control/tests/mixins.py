@@ -9,14 +9,22 @@ from django.urls import reverse
 from django.utils import timezone
 from tests.data_for_tests import (DEFAULT_IKUAI_CLIENT_LIST_ACL_L7,
                                   DEFAULT_IKUAI_CLIENT_LIST_DOMAIN_BLACKLIST,
+                                  DEFAULT_IKUAI_CLIENT_LIST_DOMAIN_GROUPS,
                                   DEFAULT_IKUAI_CLIENT_LIST_MAC_GROUPS,
                                   DEFAULT_IKUAI_CLIENT_LIST_MONITOR_LANIP,
-                                  DEFAULT_IKUAI_CLIENT_LIST_URL_BLACK)
+                                  DEFAULT_IKUAI_CLIENT_LIST_URL_BLACK,
+                                  DEFAULT_IKUAI_CLIENT_PROTOCOLS_JSON)
 from tests.factories import RouterFactory, UserFactory
 
+from my_router import metrics
+from my_router.autocomplete import index_cache
+from my_router.client_pool import client_pool
 from my_router.data_manager import RouterDataManager
+from my_router.events import InProcessEventStream
 from my_router.models import Device, Router
+from my_router.rate_limit import clear_router_limiters
 from my_router.receivers import create_or_update_router_fetch_task
+from my_router.snapshot import snapshot_cache
 from my_router.views import fetch_new_info_save_and_set_cache
 
 
@@ -26,6 +34,10 @@ class CacheMixin:
         import django.core.cache as cache
         self.test_cache = cache.caches["default"]
         self.addCleanup(self.test_cache.clear)
+        self.addCleanup(snapshot_cache.clear)
+        self.addCleanup(index_cache.clear)
+        self.addCleanup(InProcessEventStream.clear)
+        self.addCleanup(metrics.forget_known_series)
 
 
 class RequestTestMixin(CacheMixin):
@@ -203,6 +215,8 @@ class MockRouterClientMixin:
             get_ikuai_client_patch.start())
 
         self.addCleanup(get_ikuai_client_patch.stop)
+        self.addCleanup(client_pool.clear)
+        self.addCleanup(clear_router_limiters)
 
     @staticmethod
     def get_local_time(time_str):
@@ -251,6 +265,15 @@ class DataManagerDefaultRetMixin:
     def default_ikuai_client_list_url_black(self):
         return DEFAULT_IKUAI_CLIENT_LIST_URL_BLACK
 
+    @property
+    def default_ikuai_client_protocols_json(self):
+        return DEFAULT_IKUAI_CLIENT_PROTOCOLS_JSON
+
+    @property
+    def default_ikuai_client_exec_domain_group(self):
+        return {"Result": 30000, "ErrMsg": "Success",
+                "Data": DEFAULT_IKUAI_CLIENT_LIST_DOMAIN_GROUPS}
+
 
 class DataManagerTestMixin(
         DataManagerDefaultRetMixin, CacheMixin, MockRouterClientMixin):
@@ -281,6 +304,12 @@ class DataManagerTestMixin(
         self.mock_client.list_url_black.return_value = (
             self.default_ikuai_client_list_url_black)
 
+        self.mock_client.list_protocols_json.return_value = (
+            self.default_ikuai_client_protocols_json)
+
+        self.mock_client.exec.return_value = (
+            self.default_ikuai_client_exec_domain_group)
+
     def tearDown(self):
         # 重新连接信号
         super().tearDown()
@@ -314,6 +343,12 @@ class MockRouterDataManagerViewMixin(
         self.mock_client.list_url_black.return_value = (
             self.default_ikuai_client_list_url_black)
 
+        self.mock_client.list_protocols_json.return_value = (
+            self.default_ikuai_client_protocols_json)
+
+        self.mock_client.exec.return_value = (
+            self.default_ikuai_client_exec_domain_group)
+
 
 class ViewTestMixin(MockRouterDataManagerViewMixin):
     def setUp(self):
@@ -0,0 +1,132 @@
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from rest_framework.authtoken.models import Token
+from rest_framework.test import APIClient
+from tests.data_for_tests import MAC1, MAC2
+from tests.factories import UserFactory
+from tests.mixins import CacheMixin, ViewTestMixin
+
+
+class APITestMixin(CacheMixin, ViewTestMixin):
+    def setUp(self):
+        super().setUp()
+        self.api_client = APIClient()
+        token = Token.objects.get(user=UserFactory())
+        self.api_client.credentials(HTTP_AUTHORIZATION=f"Token {token.key}")
+
+    def get_info_list_url(self, name="devices", router_id=None):
+        return reverse(
+            "api-router-info-list", args=(router_id or self.router.id, name))
+
+
+class RouterAPITest(APITestMixin, TestCase):
+    def test_list(self):
+        resp = self.api_client.get(reverse("api-router-list"))
+        self.assertEqual(resp.status_code, 200)
+
+        results = resp.json()["results"]
+        self.assertEqual([row["id"] for row in results], [self.router.id])
+        self.assertIsNotNone(results[0]["snapshot_age"])
+        self.assertNotIn("admin_password", results[0])
+
+    def test_detail(self):
+        resp = self.api_client.get(
+            reverse("api-router-detail", args=(self.router.id,)),
+            data={"fields": "name"})
+        self.assertEqual(resp.json(), {"name": self.router.name})
+
+    def test_not_found(self):
+        resp = self.api_client.get(reverse("api-router-detail", args=(10,)))
+        self.assertEqual(resp.status_code, 404)
+
+    def test_not_authenticated(self):
+        self.api_client.credentials()
+        resp = self.api_client.get(reverse("api-router-list"))
+        self.assertEqual(resp.status_code, 401)
+
+    def test_read_only(self):
+        resp = self.api_client.post(reverse("api-router-list"), data={})
+        self.assertEqual(resp.status_code, 405)
+
+
+class RouterInfoListAPITest(APITestMixin, TestCase):
+    def test_served_from_snapshot(self):
+        self.mock_client.reset_mock()
+        for name in ["devices", "acl_l7", "domain_blacklist", "url_black",
+                     "mac_groups"]:
+            with self.subTest(name=name):
+                resp = self.api_client.get(self.get_info_list_url(name))
+                self.assertEqual(resp.status_code, 200)
+                self.assertTrue(resp.json()["results"])
+                self.assertIn("X-Router-Snapshot-Age", resp)
+
+        self.assertEqual(self.mock_client.method_calls, [])
+
+    def test_unknown_name(self):
+        resp = self.api_client.get(self.get_info_list_url("foo"))
+        self.assertEqual(resp.status_code, 404)
+
+    def test_router_not_found(self):
+        resp = self.api_client.get(self.get_info_list_url(router_id=10))
+        self.assertEqual(resp.status_code, 404)
+
+    def test_fields(self):
+        resp = self.api_client.get(
+            self.get_info_list_url(), data={"fields": "mac, foo"})
+        self.assertEqual(
+            resp.json()["results"], [{"mac": MAC2}, {"mac": MAC1}])
+
+    def test_cursor_pagination(self):
+        resp = self.api_client.get(
+            self.get_info_list_url(), data={"page_size": 1, "fields": "mac"})
+        data = resp.json()
+        self.assertEqual(data["results"], [{"mac": MAC2}])
+        self.assertIsNone(data["previous"])
+        self.assertIn("fields=mac", data["next"])
+
+        data = self.api_client.get(data["next"]).json()
+        self.assertEqual(data["results"], [{"mac": MAC1}])
+        self.assertIsNone(data["next"])
+
+        data = self.api_client.get(data["previous"]).json()
+        self.assertEqual(data["results"], [{"mac": MAC2}])
+        self.assertIsNone(data["previous"])
+
+    @override_settings(BEHAVIORAL_CONTROL_API_PAGE_SIZE=1)
+    def test_default_page_size(self):
+        resp = self.api_client.get(self.get_info_list_url("acl_l7"))
+        self.assertEqual(len(resp.json()["results"]), 1)
+        self.assertIsNotNone(resp.json()["next"])
+
+    def test_invalid_cursor(self):
+        for cursor in ["foo", "WzFd"]:
+            with self.subTest(cursor=cursor):
+                resp = self.api_client.get(
+                    self.get_info_list_url(), data={"cursor": cursor})
+                self.assertEqual(resp.status_code, 404)
+
+        # The cursor of a list keyed by id
+        next_url = self.api_client.get(
+            self.get_info_list_url("acl_l7"), data={"page_size": 1}
+        ).json()["next"]
+        cursor = next_url.split("cursor=")[1].split("&")[0]
+        resp = self.api_client.get(
+            self.get_info_list_url(), data={"cursor": cursor})
+        self.assertEqual(resp.status_code, 404)
+
+    def test_if_none_match(self):
+        resp = self.api_client.get(self.get_info_list_url())
+        etag = resp["ETag"]
+
+        resp = self.api_client.get(
+            self.get_info_list_url(), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(resp.status_code, 304)
+        self.assertEqual(resp["ETag"], etag)
+        self.assertEqual(resp.content, b"")
+
+        # Another selection of the same data
+        resp = self.api_client.get(
+            self.get_info_list_url(), data={"fields": "mac"},
+            HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(resp.status_code, 200)
+        self.assertNotEqual(resp["ETag"], etag)
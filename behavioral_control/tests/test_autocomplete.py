@@ -0,0 +1,156 @@
+from unittest.mock import patch
+
+from django.core.exceptions import ValidationError
+from django.test import SimpleTestCase, TestCase, override_settings
+from tests.data_for_tests import MAC1, MAC2, MAC_GROUP_1, MAC_GROUP_2
+from tests.mixins import CacheMixin, ViewTestMixin
+
+from my_router.autocomplete import (PrefixIndex, get_prefix_index,
+                                    search_items, touch_device_table)
+from my_router.constants import DEFAULT_CACHE
+from my_router.data_manager import get_rd_manager_from_snapshot
+from my_router.forms import AutocompleteMultipleChoiceField
+from my_router.models import Device
+
+
+class PrefixIndexTest(SimpleTestCase):
+    def setUp(self):
+        self.index = PrefixIndex([
+            ("a", "Alpha", ("alpha", "aa:01")),
+            ("b", "Beta", ("beta", None, "10.0.0.2")),
+            ("c", "Alpine", ("Alpine", "aa:02")),
+        ])
+
+    def test_empty_query(self):
+        self.assertEqual(
+            self.index.search(""),
+            [("a", "Alpha"), ("b", "Beta"), ("c", "Alpine")])
+        self.assertEqual(self.index.search(None), self.index.items)
+
+    def test_prefix(self):
+        # Case insensitive, in the order of the entries
+        self.assertEqual(
+            self.index.search("ALP"), [("a", "Alpha"), ("c", "Alpine")])
+        self.assertEqual(
+            self.index.search(" aa:0 "), [("a", "Alpha"), ("c", "Alpine")])
+        self.assertEqual(self.index.search("10.0"), [("b", "Beta")])
+
+    def test_no_match(self):
+        self.assertEqual(self.index.search("zeta"), [])
+        self.assertEqual(self.index.search("eta"), [])
+
+
+class SearchItemsTest(CacheMixin, ViewTestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.rd_manager = get_rd_manager_from_snapshot(self.router)
+
+    def test_device(self):
+        result = search_items(self.rd_manager, "device", MAC1[:5])
+        self.assertEqual(
+            [item["id"] for item in result["results"]], [MAC1])
+        self.assertFalse(result["pagination"]["more"])
+
+    def test_device_ip_addr(self):
+        result = search_items(self.rd_manager, "device", "192.168.110.4")
+        self.assertEqual(len(result["results"]), 1)
+
+    def test_mac_group(self):
+        result = search_items(self.rd_manager, "mac_group", "")
+        self.assertEqual(
+            {item["id"] for item in result["results"]},
+            {MAC_GROUP_1, MAC_GROUP_2})
+
+    def test_protocol(self):
+        result = search_items(self.rd_manager, "protocol", "王者")
+        self.assertEqual(result["results"], [{"id": "王者荣耀", "text": "王者荣耀"}])
+
+    def test_domain_group(self):
+        result = search_items(self.rd_manager, "domain_group", "购物")
+        self.assertEqual([item["id"] for item in result["results"]], ["购物网站"])
+
+    @override_settings(BEHAVIORAL_CONTROL_AUTOCOMPLETE_PAGE_SIZE=1)
+    def test_pagination(self):
+        first = search_items(self.rd_manager, "device", "", page=1)
+        second = search_items(self.rd_manager, "device", "", page=2)
+        self.assertTrue(first["pagination"]["more"])
+        self.assertFalse(second["pagination"]["more"])
+        self.assertEqual(
+            {first["results"][0]["id"], second["results"][0]["id"]},
+            {MAC1, MAC2})
+
+        self.assertEqual(
+            search_items(self.rd_manager, "device", "", page=3)["results"], [])
+
+    def test_index_built_once_per_version(self):
+        with patch("my_router.autocomplete.build_mac_group_index",
+                   return_value=PrefixIndex([])) as mock_build:
+            get_prefix_index(self.rd_manager, "mac_group")
+            get_prefix_index(self.rd_manager, "mac_group")
+            self.assertEqual(mock_build.call_count, 1)
+
+            # A new snapshot was cached
+            DEFAULT_CACHE.set(self.rd_manager.snapshot_version_cache_key, "foo")
+            get_prefix_index(self.rd_manager, "mac_group")
+            self.assertEqual(mock_build.call_count, 2)
+
+    def test_device_renamed(self):
+        search_items(self.rd_manager, "device", "")
+        device = Device.objects.get(mac=MAC1)
+        device.name = "renamed"
+        device.save()
+
+        result = search_items(self.rd_manager, "device", "renam")
+        self.assertEqual(
+            result["results"], [{"id": MAC1, "text": f"renamed ({MAC1})"}])
+
+    def test_device_index_built_again_when_touched(self):
+        with patch("my_router.autocomplete.build_device_index",
+                   return_value=PrefixIndex([])) as mock_build:
+            get_prefix_index(self.rd_manager, "device")
+            get_prefix_index(self.rd_manager, "device")
+            self.assertEqual(mock_build.call_count, 1)
+
+            # Changed in the database, e.g., by another process
+            touch_device_table(self.router.id)
+            get_prefix_index(self.rd_manager, "device")
+            self.assertEqual(mock_build.call_count, 2)
+
+    def test_catalog_index_built_again_when_invalidated(self):
+        with patch("my_router.autocomplete.build_name_index",
+                   return_value=PrefixIndex([])) as mock_build:
+            get_prefix_index(self.rd_manager, "domain_group")
+            get_prefix_index(self.rd_manager, "domain_group")
+            self.assertEqual(mock_build.call_count, 1)
+
+            # Invalidated by another process, e.g., the router url changed
+            get_rd_manager_from_snapshot(self.router).invalidate_catalogs()
+            get_prefix_index(self.rd_manager, "domain_group")
+            self.assertEqual(mock_build.call_count, 2)
+
+    def test_unknown_kind(self):
+        with self.assertRaises(ValueError):
+            get_prefix_index(self.rd_manager, "foo")
+
+
+class AutocompleteMultipleChoiceFieldTest(SimpleTestCase):
+    def setUp(self):
+        self.field = AutocompleteMultipleChoiceField(
+            "/autocomplete/", choices=[(MAC1, "iPad"), (MAC2, "TVBOX")],
+            required=False)
+
+    def test_validation(self):
+        self.assertEqual(self.field.clean([MAC1]), [MAC1])
+        with self.assertRaises(ValidationError):
+            self.field.clean(["foo"])
+
+    def test_render_selected_only(self):
+        html = self.field.widget.render("apply_to", [MAC2])
+        self.assertIn('data-autocomplete-url="/autocomplete/"', html)
+        self.assertIn(MAC2, html)
+        self.assertNotIn(MAC1, html)
+
+    def test_choices_changed(self):
+        self.field.clean([MAC1])
+        self.field.choices = [("foo", "foo")]
+        self.assertEqual(self.field.clean(["foo"]), ["foo"])
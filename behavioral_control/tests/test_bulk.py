@@ -0,0 +1,166 @@
+from copy import deepcopy
+from unittest.mock import patch
+
+from django.test import TestCase
+from django.urls import reverse
+from tests.data_for_tests import (DEFAULT_IKUAI_CLIENT_LIST_MAC_GROUPS,
+                                  FAKE_MAC, MAC1, MAC2, MAC_GROUP_1,
+                                  MAC_GROUP_2)
+from tests.mixins import CacheMixin, RequestTestMixin, ViewTestMixin
+
+from my_router.bulk import (BulkUpdateError, bulk_delete_rules,
+                            bulk_update_devices, get_bulk_device_action_kwargs)
+from my_router.data_manager import RouterDataManager
+from my_router.models import Device
+
+
+@patch("my_router.receivers.fetch_new_info_save_and_set_cache")
+class BulkUpdateDevicesTest(CacheMixin, ViewTestMixin, TestCase):
+    def setUp(self):
+        # Run the refreshes scheduled by the setup, so that those of the
+        # tests are not coalesced with them
+        with self.captureOnCommitCallbacks(execute=True):
+            super().setUp()
+        self.devices = Device.objects.filter(router=self.router)
+        self.mock_client.reset_mock()
+
+    def test_db_fields(self, mock_fetch_and_set_cache):
+        # The devices are selected and updated in a single query each
+        with self.assertNumQueries(2):
+            bulk_update_devices(self.router, self.devices, known=True, ignore=True)
+
+        self.assertEqual(
+            Device.objects.filter(
+                router=self.router, known=True, ignore=True).count(), 2)
+        self.assertEqual(self.mock_client.method_calls, [])
+        mock_fetch_and_set_cache.assert_not_called()
+
+    def test_unblock_mac_by_proto_ctrl(self, mock_fetch_and_set_cache):
+        self.devices.update(block_mac_by_proto_ctrl=True)
+        RouterDataManager(router_instance=self.router).invalidate_mac_indexes()
+        self.mock_client.list_acl_mac.return_value = {
+            "total": 2, "data": [
+                {"id": 1, "mac": MAC1, "enabled": "yes"},
+                {"id": 2, "mac": MAC2, "enabled": "yes"}]}
+
+        with self.captureOnCommitCallbacks(execute=True):
+            bulk_update_devices(
+                self.router, self.devices, block_mac_by_proto_ctrl=False)
+
+        self.assertFalse(
+            Device.objects.filter(block_mac_by_proto_ctrl=True).exists())
+        self.mock_client.del_acl_mac.assert_called_once()
+        self.assertEqual(
+            set(self.mock_client.del_acl_mac.call_args.kwargs[
+                    "acl_mac_id"].split(",")),
+            {"1", "2"})
+        mock_fetch_and_set_cache.assert_called_once()
+
+    def test_reject(self, mock_fetch_and_set_cache):
+        with self.captureOnCommitCallbacks(execute=True):
+            bulk_update_devices(self.router, self.devices, reject=True)
+
+        self.assertEqual(self.mock_client.add_acl_mac.call_count, 2)
+
+        # The acl_mac entries are read from the router, not the snapshot
+        self.mock_client.list_acl_mac.assert_called_once()
+        mock_fetch_and_set_cache.assert_called_once()
+
+    def test_join_mac_groups_edited_since_snapshot(
+            self, mock_fetch_and_set_cache):
+        mac_groups = deepcopy(DEFAULT_IKUAI_CLIENT_LIST_MAC_GROUPS)
+        mac_groups["data"][0]["addr_pool"] = f"{MAC1},{FAKE_MAC}"
+        self.mock_client.list_mac_groups.return_value = mac_groups
+
+        bulk_update_devices(
+            self.router, self.devices, join_mac_groups=[MAC_GROUP_1])
+        self.mock_client.edit_mac_group.assert_called_once_with(
+            group_id=1, group_name=MAC_GROUP_1,
+            addr_pools=[MAC1, FAKE_MAC, MAC2])
+
+    def test_leave_mac_groups(self, mock_fetch_and_set_cache):
+        skipped = bulk_update_devices(
+            self.router, self.devices, leave_mac_groups=[MAC_GROUP_2])
+        self.assertEqual(skipped, [MAC_GROUP_2])
+        self.mock_client.edit_mac_group.assert_not_called()
+
+    def test_router_failed_partway(self, mock_fetch_and_set_cache):
+        self.mock_client.edit_mac_group.side_effect = RuntimeError("foo")
+
+        with self.captureOnCommitCallbacks(execute=True):
+            with self.assertRaises(BulkUpdateError) as cm:
+                bulk_update_devices(
+                    self.router, self.devices, known=True, reject=True,
+                    join_mac_groups=[MAC_GROUP_1])
+
+        # The database changes and the applied router mutations are kept
+        # and reported, and the router is refreshed
+        self.assertEqual(
+            Device.objects.filter(router=self.router, known=True).count(), 2)
+        self.assertEqual(self.mock_client.add_acl_mac.call_count, 2)
+        self.assertEqual(
+            [str(d) for d in cm.exception.applied],
+            ["Saving the devices", "Block"])
+        self.assertEqual(
+            [str(d) for d in cm.exception.not_applied],
+            ["Editing the mac groups"])
+        self.assertIn("RuntimeError: foo", str(cm.exception))
+        mock_fetch_and_set_cache.assert_called_once()
+
+    def test_no_devices(self, mock_fetch_and_set_cache):
+        self.assertEqual(
+            bulk_update_devices(self.router, Device.objects.none(), known=True),
+            [])
+        mock_fetch_and_set_cache.assert_not_called()
+
+    def test_unknown_action(self, mock_fetch_and_set_cache):
+        with self.assertRaises(ValueError):
+            get_bulk_device_action_kwargs("foo")
+
+
+class BulkDeleteRulesTest(CacheMixin, ViewTestMixin, TestCase):
+    def test_delete(self):
+        self.mock_client.reset_mock()
+        bulk_delete_rules(self.router, "mac_group", ["1", 8])
+        self.mock_client.del_mac_group.assert_called_once_with("1,8")
+        self.mock_client.list_mac_groups.assert_called_once()
+        self.mock_client.list_acl_l7.assert_not_called()
+
+    @patch("my_router.receivers.schedule_router_refresh")
+    def test_no_snapshot(self, mock_schedule_refresh):
+        self.test_cache.clear()
+        bulk_delete_rules(self.router, "acl_l7", [1])
+        self.mock_client.del_acl_l7.assert_called_once_with("1")
+        mock_schedule_refresh.assert_called_once_with(self.router.id)
+
+    def test_no_ids(self):
+        self.mock_client.reset_mock()
+        bulk_delete_rules(self.router, "acl_l7", [])
+        self.assertEqual(self.mock_client.method_calls, [])
+
+
+class DeviceAdminActionTest(ViewTestMixin, RequestTestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.user.is_staff = True
+        self.user.is_superuser = True
+        self.user.save()
+
+    @patch("my_router.admin.bulk_update_devices")
+    def test_action(self, mock_bulk_update_devices):
+        mock_bulk_update_devices.return_value = [MAC_GROUP_2]
+        devices = Device.objects.filter(router=self.router)
+
+        resp = self.client.post(
+            reverse("admin:my_router_device_changelist"), data={
+                "action": "leave_mac_groups",
+                "mac_group": f" {MAC_GROUP_2}, ",
+                "_selected_action": [device.pk for device in devices]})
+        self.assertEqual(resp.status_code, 302)
+
+        mock_bulk_update_devices.assert_called_once()
+        args, kwargs = mock_bulk_update_devices.call_args
+        self.assertEqual(args[0], self.router)
+        self.assertEqual(
+            sorted(device.mac for device in args[1]), sorted([MAC1, MAC2]))
+        self.assertEqual(kwargs, {"leave_mac_groups": [MAC_GROUP_2]})
@@ -0,0 +1,121 @@
+from unittest.mock import MagicMock
+
+import requests
+from django.test import SimpleTestCase
+from pyikuai.exceptions import RequestError, RouterAPIError
+from tests.mixins import CacheMixin
+
+from my_router.circuit_breaker import (CircuitBreakerClient,
+                                       RouterCircuitBreaker, RouterUnavailable)
+
+
+class RouterCircuitBreakerTest(CacheMixin, SimpleTestCase):
+    def setUp(self):
+        super().setUp()
+        self.breaker = RouterCircuitBreaker(
+            1, failure_threshold=2, cool_down=60)
+        self.func = MagicMock(return_value="foo")
+        self.failing_func = MagicMock(
+            side_effect=requests.ConnectionError("timed out"))
+
+    def trip(self):
+        for _ in range(self.breaker.failure_threshold):
+            with self.assertRaises(requests.ConnectionError):
+                self.breaker.call(self.failing_func)
+
+    def test_closed(self):
+        self.assertEqual(self.breaker.call(self.func, "bar", a=1), "foo")
+        self.func.assert_called_once_with("bar", a=1)
+        self.assertFalse(self.breaker.is_open())
+
+    def test_open_after_repeated_failures(self):
+        with self.assertRaises(requests.ConnectionError):
+            self.breaker.call(self.failing_func)
+        self.assertFalse(self.breaker.is_open())
+
+        with self.assertRaises(RequestError):
+            self.breaker.call(MagicMock(side_effect=RequestError("500")))
+        self.assertTrue(self.breaker.is_open())
+
+        # Fail fast without calling the router
+        with self.assertRaises(RouterUnavailable):
+            self.breaker.call(self.func)
+        self.func.assert_not_called()
+
+    def test_success_resets_failures(self):
+        with self.assertRaises(requests.ConnectionError):
+            self.breaker.call(self.failing_func)
+        self.breaker.call(self.func)
+        self.assertEqual(self.breaker.get_failures(), 0)
+
+        with self.assertRaises(requests.ConnectionError):
+            self.breaker.call(self.failing_func)
+        self.assertFalse(self.breaker.is_open())
+
+    def test_api_error_not_tripping(self):
+        api_error_func = MagicMock(side_effect=RouterAPIError("invalid"))
+        for _ in range(3):
+            with self.assertRaises(RouterAPIError):
+                self.breaker.call(api_error_func)
+        self.assertFalse(self.breaker.is_open())
+
+    def test_no_probe_during_cool_down(self):
+        self.trip()
+        self.assertTrue(self.breaker.is_cooling_down())
+        self.assertFalse(self.breaker.acquire_probe())
+
+    def test_probe_closes_circuit(self):
+        self.trip()
+        self.test_cache.delete(self.breaker.cool_down_cache_key)
+
+        self.assertTrue(self.breaker.acquire_probe())
+
+        # Only one probe at a time
+        self.assertFalse(self.breaker.acquire_probe())
+
+        self.assertEqual(self.breaker.call(self.func, probe=True), "foo")
+        self.assertFalse(self.breaker.is_open())
+        self.assertEqual(self.breaker.call(self.func), "foo")
+
+    def test_failed_probe_restarts_cool_down(self):
+        self.trip()
+        self.test_cache.delete(self.breaker.cool_down_cache_key)
+        self.assertTrue(self.breaker.acquire_probe())
+
+        with self.assertRaises(requests.ConnectionError):
+            self.breaker.call(self.failing_func, probe=True)
+
+        self.assertTrue(self.breaker.is_open())
+        self.assertTrue(self.breaker.is_cooling_down())
+        self.assertFalse(self.breaker.acquire_probe())
+
+
+class CircuitBreakerClientTest(CacheMixin, SimpleTestCase):
+    def setUp(self):
+        super().setUp()
+        self.client = MagicMock()
+        self.breaker = RouterCircuitBreaker(
+            1, failure_threshold=1, cool_down=60)
+        self.breaker_client = CircuitBreakerClient(self.client, self.breaker)
+
+    def test_api_call_through_breaker(self):
+        self.client.list_acl_l7.side_effect = requests.Timeout()
+        with self.assertRaises(requests.Timeout):
+            self.breaker_client.list_acl_l7()
+
+        with self.assertRaises(RouterUnavailable):
+            self.breaker_client.list_mac_groups()
+        self.client.list_mac_groups.assert_not_called()
+
+        # Validators do not call the router
+        self.breaker_client.validate_weekday("1234567")
+        self.client.validate_weekday.assert_called_once_with("1234567")
+
+    def test_probe(self):
+        self.client.list_acl_l7.side_effect = requests.Timeout()
+        with self.assertRaises(requests.Timeout):
+            self.breaker_client.list_acl_l7()
+
+        self.breaker_client.probe()
+        self.client.get_sysstat.assert_called_once_with()
+        self.assertFalse(self.breaker.is_open())
@@ -0,0 +1,113 @@
+import pickle
+from datetime import datetime
+from unittest.mock import patch
+
+from django.test import SimpleTestCase, TestCase, override_settings
+from tests.data_for_tests import (DEFAULT_IKUAI_CLIENT_LIST_ACL_L7,
+                                  DEFAULT_IKUAI_CLIENT_LIST_MAC_GROUPS)
+from tests.mixins import CacheMixin, ViewTestMixin
+
+from my_router import codec
+from my_router.codec import (COMPRESSION_NONE, COMPRESSION_ZLIB, MAGIC,
+                             ROWS_KEY, EncodedCache, decode_value,
+                             encode_value, pack_rows)
+from my_router.data_manager import RouterDataManager
+
+
+class CodecTest(SimpleTestCase):
+    def test_pack_rows(self):
+        rows = [{"id": 1, "mac": "a"}, {"id": 2, "mac": "b"}]
+        self.assertEqual(
+            pack_rows({"data": rows, "total": 2}),
+            {"data": {ROWS_KEY: [["id", "mac"], [[1, "a"], [2, "b"]]]},
+             "total": 2})
+
+        # Not the same keys
+        rows = [{"id": 1, "mac": "a"}, {"id": 2}]
+        self.assertEqual(pack_rows(rows), rows)
+
+    def test_round_trip(self):
+        for value in [
+                None, 1, "foo", [], ["a", "b"],
+                DEFAULT_IKUAI_CLIENT_LIST_ACL_L7["data"],
+                DEFAULT_IKUAI_CLIENT_LIST_MAC_GROUPS,
+                [{"last_seen": datetime(2024, 2, 25), "macs": {"a"}},
+                 {"last_seen": None, "macs": set()}]]:
+            with self.subTest(value=value):
+                encoded = encode_value(value)
+                self.assertTrue(encoded.startswith(MAGIC))
+                self.assertEqual(decode_value(encoded), value)
+
+    def test_packer(self):
+        for value, packer in [
+                (DEFAULT_IKUAI_CLIENT_LIST_ACL_L7["data"], codec.PACKER_MSGPACK),
+                ({1: [b"a", None, 1.5]}, codec.PACKER_MSGPACK),
+                ([("a", 1)], codec.PACKER_PICKLE),
+                ({"a": {"b"}}, codec.PACKER_PICKLE),
+                ([2 ** 70], codec.PACKER_PICKLE)]:
+            with self.subTest(value=value):
+                encoded = encode_value(value)
+                self.assertEqual(encoded[len(MAGIC):len(MAGIC) + 1], packer)
+                self.assertEqual(decode_value(encoded), value)
+
+    def test_pickle_fallback(self):
+        value = DEFAULT_IKUAI_CLIENT_LIST_ACL_L7["data"]
+        with patch.object(codec, "msgpack", None):
+            encoded = encode_value(value)
+        self.assertEqual(encoded[len(MAGIC):len(MAGIC) + 1], codec.PACKER_PICKLE)
+        self.assertEqual(decode_value(encoded), value)
+
+    def test_compression_threshold(self):
+        value = DEFAULT_IKUAI_CLIENT_LIST_ACL_L7["data"] * 10
+
+        with patch.object(codec, "zstandard", None):
+            encoded = encode_value(value)
+            self.assertEqual(
+                encoded[len(MAGIC) + 1:len(MAGIC) + 2], COMPRESSION_ZLIB)
+            self.assertLess(
+                len(encoded),
+                len(pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)))
+            self.assertEqual(decode_value(encoded), value)
+
+        with override_settings(BEHAVIORAL_CONTROL_CACHE_COMPRESS_MIN_BYTES=None):
+            encoded = encode_value(value)
+            self.assertEqual(
+                encoded[len(MAGIC) + 1:len(MAGIC) + 2], COMPRESSION_NONE)
+
+    def test_legacy_values(self):
+        self.assertEqual(decode_value([1, 2]), [1, 2])
+        self.assertEqual(decode_value(b"foo"), b"foo")
+
+
+class EncodedCacheTest(CacheMixin, SimpleTestCase):
+    def setUp(self):
+        super().setUp()
+        self.cache = EncodedCache(self.test_cache)
+
+    def test_get_set(self):
+        self.cache.set("foo", [{"id": 1}])
+        self.assertTrue(self.test_cache.get("foo").startswith(MAGIC))
+        self.assertEqual(self.cache.get("foo"), [{"id": 1}])
+        self.assertEqual(self.cache.get("bar", []), [])
+
+        self.cache.set_many({"foo": [1], "bar": [2]})
+        self.assertEqual(
+            self.cache.get_many(["foo", "bar", "baz"]), {"foo": [1], "bar": [2]})
+
+    @override_settings(BEHAVIORAL_CONTROL_CACHE_CODEC=False)
+    def test_disabled(self):
+        self.cache.set("foo", [{"id": 1}])
+        self.assertEqual(self.test_cache.get("foo"), [{"id": 1}])
+        self.assertEqual(self.cache.get("foo"), [{"id": 1}])
+
+
+class RouterDataCacheTest(CacheMixin, ViewTestMixin, TestCase):
+    def test_snapshot_encoded(self):
+        rd_manager = RouterDataManager(router_instance=self.router)
+        self.assertTrue(
+            self.test_cache.get(rd_manager.acl_l7_list_cache_key).startswith(MAGIC))
+
+        rd_manager.init_data_from_cache()
+        self.assertEqual(
+            [rule["id"] for rule in rd_manager.acl_l7_list],
+            [rule["id"] for rule in DEFAULT_IKUAI_CLIENT_LIST_ACL_L7["data"]])
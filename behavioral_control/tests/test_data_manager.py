@@ -1,16 +1,34 @@
 from copy import deepcopy
 from unittest.mock import MagicMock, patch
 
-from django.test import TestCase
-from tests.data_for_tests import FAKE_MAC, MAC1, MAC2, MAC_GROUP_2
+from django.test import TestCase, override_settings
+from django.utils import timezone
+from pyikuai.exceptions import RouterAPIError
+from rest_framework.exceptions import ValidationError
+from tests.data_for_tests import (DEFAULT_IKUAI_CLIENT_LIST_DOMAIN_GROUPS,
+                                  FAKE_MAC, MAC1, MAC2, MAC_GROUP_1,
+                                  MAC_GROUP_2)
 from tests.mixins import DataManagerTestMixin
 
-from my_router.data_manager import DEFAULT_CACHE, RuleDataFilter
+from my_router.codec import encode_value
+from my_router.data_manager import (DEFAULT_CACHE, RouterDataManager,
+                                    RuleDataFilter)
 from my_router.models import Device
 
 
 class DataManagerPropertiesTest(DataManagerTestMixin, TestCase):
 
+    def test_ikuai_client_created_lazily(self):
+        self.router.get_client.assert_not_called()
+
+        self.rd_manager.init_data_from_cache()
+        self.rd_manager.get_view_data("acl_l7")
+        self.router.get_client.assert_not_called()
+
+        self.assertIs(self.rd_manager.ikuai_client, self.mock_client)
+        self.assertIs(self.rd_manager.ikuai_client, self.mock_client)
+        self.router.get_client.assert_called_once()
+
     def test_device_and_dict(self):
         self.assertIsNone(self.rd_manager._devices)
         self.assertIsNotNone(self.rd_manager.devices)
@@ -83,9 +101,7 @@ class DataManagerCacheTest(DataManagerTestMixin, TestCase):
         self.rd_manager.cache_each_device_info()
 
         # Add none exist mac to all_mac_cache
-        all_mac_list = list(self.rd_manager.get_cached_all_mac())
-        all_mac_list.append(FAKE_MAC)
-        DEFAULT_CACHE.set(self.rd_manager.all_mac_cache_key, all_mac_list)
+        self.rd_manager.device_store.add_macs([FAKE_MAC])
 
         self.rd_manager.reset_property_cache()
         device_data = deepcopy(self.default_ikuai_client_list_monitor_lanip)
@@ -103,6 +119,179 @@ class DataManagerCacheTest(DataManagerTestMixin, TestCase):
 
         self.assertNotIn(FAKE_MAC, ret.keys())
 
+    def test_get_device_rule_data_offline_devices_read_once(self):
+        self.rd_manager.cache_each_device_info()
+
+        device_data = deepcopy(self.default_ikuai_client_list_monitor_lanip)
+        device_data["total"] = 0
+        device_data["data"] = []
+        self.rd_manager.reset_property_cache()
+        self.mock_client.list_monitor_lanip.return_value = device_data
+
+        with patch.object(
+                self.rd_manager.device_store, "get_records",
+                wraps=self.rd_manager.device_store.get_records
+        ) as mock_get_records:
+            ret = self.rd_manager.get_device_rule_data()
+
+        mock_get_records.assert_called_once()
+        for mac in [MAC1, MAC2]:
+            self.assertFalse(ret[mac]["online"])
+
+    def test_get_device_rule_data_for_mac(self):
+        self.rd_manager.cache_each_device_info()
+        all_data = self.rd_manager.get_device_rule_data()
+
+        for mac in [MAC1, MAC2]:
+            with self.subTest(mac=mac):
+                self.assertEqual(
+                    self.rd_manager.get_device_rule_data_for_mac(mac),
+                    all_data[mac])
+                self.assertEqual(
+                    self.rd_manager.get_device_rule_dict_for_mac(mac),
+                    self.rd_manager.get_device_rule_dict().get(mac, {}))
+
+        with self.assertRaises(KeyError):
+            self.rd_manager.get_device_rule_data_for_mac(FAKE_MAC)
+
+    def test_get_device_rule_data_for_mac_offline(self):
+        self.rd_manager.cache_each_device_info()
+
+        device_data = deepcopy(self.default_ikuai_client_list_monitor_lanip)
+        device_data["total"] = 0
+        device_data["data"] = []
+        self.rd_manager.reset_property_cache()
+        self.mock_client.list_monitor_lanip.return_value = device_data
+
+        self.assertEqual(
+            self.rd_manager.get_device_rule_data_for_mac(MAC1),
+            self.rd_manager.get_device_rule_data()[MAC1])
+        self.assertFalse(
+            self.rd_manager.get_device_rule_data_for_mac(MAC1)["online"])
+
+    def test_cache_device_info_validated(self):
+        info = deepcopy(self.default_ikuai_client_list_monitor_lanip["data"][0])
+        info["ip_addr"] = "foo"
+
+        with self.assertRaises(ValidationError):
+            self.rd_manager.cache_device_info(info["mac"], info)
+        self.assertIsNone(self.rd_manager.get_cached_device_info(info["mac"]))
+
+    def fetch_devices(self):
+        self.rd_manager.reset_property_cache()
+        self.rd_manager.devices  # noqa
+        self.rd_manager.cache_each_device_info()
+
+    def test_unchanged_devices_skipped(self):
+        self.fetch_devices()
+        self.assertEqual(Device.objects.count(), 2)
+        first_devices = self.rd_manager.devices
+
+        with patch(
+                "my_router.data_manager.ResultListMonitorLANIPSerializer"
+        ) as mock_serializer_class, patch.object(
+                self.rd_manager.device_store, "set_records"
+        ) as mock_set_records:
+            mock_serializer_class.return_value.data = {"data": []}
+            with self.assertNumQueries(0):
+                self.fetch_devices()
+
+        # Validated nothing and cached nothing
+        self.assertEqual(
+            mock_serializer_class.call_args.kwargs["data"]["data"], [])
+        mock_set_records.assert_called_once_with({})
+        self.assertEqual(self.rd_manager.devices, first_devices)
+
+    def test_newer_timestamp_skipped(self):
+        self.fetch_devices()
+        cached = self.rd_manager.get_cached_device_info(MAC1)
+
+        device_data = deepcopy(self.default_ikuai_client_list_monitor_lanip)
+        for row in device_data["data"]:
+            row["timestamp"] += 60
+        self.mock_client.list_monitor_lanip.return_value = device_data
+
+        with patch.object(
+                self.rd_manager.device_store, "set_records"
+        ) as mock_set_records:
+            with self.assertNumQueries(0):
+                self.fetch_devices()
+
+        self.assertEqual(self.rd_manager._changed_device_fingerprints, {})
+        mock_set_records.assert_called_once_with({})
+        self.assertEqual(
+            self.rd_manager.get_cached_device_info(MAC1), cached)
+
+    def test_changed_device_synced(self):
+        self.fetch_devices()
+
+        device_data = deepcopy(self.default_ikuai_client_list_monitor_lanip)
+        changed = device_data["data"][0]
+        changed["comment"] = "new name"
+        self.mock_client.list_monitor_lanip.return_value = device_data
+
+        self.fetch_devices()
+        self.assertEqual(
+            list(self.rd_manager._changed_device_fingerprints), [changed["mac"]])
+        self.assertEqual(
+            Device.objects.get(mac=changed["mac"]).name, "new name")
+        self.assertEqual(
+            self.rd_manager.get_cached_device_info(changed["mac"])["comment"],
+            "new name")
+
+    @override_settings(BEHAVIORAL_CONTROL_DEVICE_FETCH_PAGE_SIZE=1)
+    def test_all_devices_fetched(self):
+        first_page, rest = (
+            deepcopy(self.default_ikuai_client_list_monitor_lanip)
+            for _ in range(2))
+        first_page["data"] = first_page["data"][:1]
+        rest["data"] = rest["data"][1:]
+        self.mock_client.list_monitor_lanip.side_effect = [first_page, rest]
+
+        self.fetch_devices()
+        self.assertEqual(
+            {device["mac"] for device in self.rd_manager.devices}, {MAC1, MAC2})
+        self.assertEqual(
+            [call.kwargs for call in
+             self.mock_client.list_monitor_lanip.call_args_list],
+            [{"limit": [0, 1]}, {"limit": [1, 2]}])
+
+    def test_online_device_last_seen_refreshed(self):
+        self.fetch_devices()
+        last_seen = "2000-01-01T00:00:00Z"
+        self.rd_manager.device_store.update_record(MAC1, last_seen=last_seen)
+        recent = self.rd_manager.get_cached_device_info(MAC2)["last_seen"]
+
+        # Unchanged devices, only the outdated last_seen is written
+        self.fetch_devices()
+        self.assertEqual(self.rd_manager._changed_device_fingerprints, {})
+        self.assertEqual(
+            list(self.rd_manager._outdated_device_fingerprints), [MAC1])
+        self.assertGreater(
+            self.rd_manager.get_cached_device_info(MAC1)["last_seen"],
+            last_seen)
+        self.assertEqual(
+            self.rd_manager.get_cached_device_info(MAC2)["last_seen"], recent)
+
+    def test_departed_device_last_seen(self):
+        self.fetch_devices()
+        departed_mac = self.default_ikuai_client_list_monitor_lanip[
+            "data"][0]["mac"]
+        last_seen = "2000-01-01T00:00:00Z"
+        self.rd_manager.device_store.update_record(
+            departed_mac, last_seen=last_seen)
+
+        device_data = deepcopy(self.default_ikuai_client_list_monitor_lanip)
+        device_data["total"] = 1
+        device_data["data"].pop(0)
+        self.mock_client.list_monitor_lanip.return_value = device_data
+
+        self.fetch_devices()
+        self.assertEqual(self.rd_manager._departed_macs, {departed_mac})
+        self.assertGreater(
+            self.rd_manager.get_cached_device_info(departed_mac)["last_seen"],
+            last_seen)
+
     def cache_instance_properties(self):
         # this will also cache the data in django cache
         self.assertIsNotNone(self.rd_manager.devices)
@@ -137,8 +326,112 @@ class DataManagerCacheTest(DataManagerTestMixin, TestCase):
         self.rd_manager.init_data_from_cache()
         self.assertTrue(self.rd_manager.is_initialized_from_cached_data)
 
+    def get_manager_initialized_from_cache(self):
+        from my_router.data_manager import RouterDataManager
+        rd_manager = RouterDataManager(router_instance=self.router)
+        rd_manager.init_data_from_cache()
+        return rd_manager
+
+    def test_init_data_from_cache_reuses_decoded_snapshot(self):
+        self.rd_manager.cache_all_data()
+
+        first = self.get_manager_initialized_from_cache()
+
+        with patch.object(
+                DEFAULT_CACHE, "get_many", wraps=DEFAULT_CACHE.get_many
+        ) as mock_get_many:
+            second = self.get_manager_initialized_from_cache()
+            mock_get_many.assert_not_called()
+
+        self.assertIs(first.devices, second.devices)
+        self.assertEqual(second.acl_l7_list, self.rd_manager.acl_l7_list)
+
+    def test_rule_id_maps(self):
+        self.rd_manager.cache_all_data()
+        rule_id_maps = self.rd_manager.rule_id_maps
+        self.assertEqual(
+            set(rule_id_maps), {"acl_l7", "domain_blacklist", "url_black",
+                                "mac_group"})
+        for kind, rules in [
+                ("acl_l7", self.rd_manager.acl_l7_list),
+                ("domain_blacklist", self.rd_manager.domain_blacklist)]:
+            self.assertEqual(
+                list(rule_id_maps[kind].values()), rules)
+
+        # Built once per decoded snapshot
+        rd_manager = RouterDataManager(router_instance=self.router)
+        rd_manager.init_data_from_cache()
+        self.assertEqual(rd_manager.rule_id_maps, rule_id_maps)
+        rd_manager2 = RouterDataManager(router_instance=self.router)
+        rd_manager2.init_data_from_cache()
+        self.assertIs(rd_manager2.rule_id_maps, rd_manager.rule_id_maps)
+
+    def test_get_rule_view_data(self):
+        acl_l7_data = self.rd_manager.get_acl_l7_list_data()
+        for acl_l7_id, item in acl_l7_data.items():
+            self.assertEqual(
+                self.rd_manager.get_rule_view_data("acl_l7", acl_l7_id), item)
+
+        domain_blacklist_data = self.rd_manager.get_domain_blacklist_data()
+        for domain_blacklist_id, item in domain_blacklist_data.items():
+            self.assertEqual(
+                self.rd_manager.get_rule_view_data(
+                    "domain_blacklist", domain_blacklist_id), item)
+
+        with self.assertRaises(KeyError):
+            self.rd_manager.get_rule_view_data("acl_l7", 1000)
+
+    def test_snapshot_version_unchanged_if_data_unchanged(self):
+        self.rd_manager.cache_all_data()
+        version = DEFAULT_CACHE.get(self.rd_manager.snapshot_version_cache_key)
+        self.assertIsNotNone(version)
+
+        self.rd_manager.reset_property_cache()
+        self.rd_manager.cache_all_data()
+        self.assertEqual(
+            DEFAULT_CACHE.get(self.rd_manager.snapshot_version_cache_key),
+            version)
+
+    def test_snapshot_encoded_once(self):
+        # Fetched first, the properties cache each list when fetched
+        self.rd_manager.cache_all_data()
+        with patch("my_router.codec.encode_value",
+                   wraps=encode_value) as mock_encode:
+            self.rd_manager.cache_all_data()
+        self.assertEqual(
+            mock_encode.call_count, len(self.rd_manager.snapshot_cache_keys))
+
+    @override_settings(BEHAVIORAL_CONTROL_CACHE_CODEC=False)
+    def test_snapshot_version_codec_disabled(self):
+        self.test_snapshot_version_unchanged_if_data_unchanged()
+
+    def test_snapshot_version_changed_invalidates_decoded_snapshot(self):
+        self.rd_manager.cache_all_data()
+        first = self.get_manager_initialized_from_cache()
+        self.assertEqual(len(first.devices), 2)
+
+        device_data = deepcopy(self.default_ikuai_client_list_monitor_lanip)
+        device_data["total"] = 1
+        device_data["data"].pop(0)
+        self.mock_client.list_monitor_lanip.return_value = device_data
+
+        self.rd_manager.reset_property_cache()
+        self.rd_manager.cache_all_data()
+
+        second = self.get_manager_initialized_from_cache()
+        self.assertEqual(len(second.devices), 1)
+
 
 class DataManagerTest(DataManagerTestMixin, TestCase):
+    def test_update_device_db_instances_renamed(self):
+        self.rd_manager.update_device_db_instances()
+        device_info = dict(self.rd_manager.devices[0], comment="new name")
+
+        # The new name is saved, not the serialized instance
+        self.rd_manager.update_device_db_instances([device_info])
+        self.assertEqual(
+            Device.objects.get(mac=device_info["mac"]).name, "new name")
+
     def test_get_device_view_data(self):
         ret = self.rd_manager.get_device_view_data()
         self.assertEqual(len(ret), 2)
@@ -171,6 +464,73 @@ class DataManagerTest(DataManagerTestMixin, TestCase):
             self.assertIsNotNone(url)
 
 
+class CatalogTest(DataManagerTestMixin, TestCase):
+    def test_protocol_catalog(self):
+        # The protocols of the router first, then those only used by rules
+        catalog = self.rd_manager.protocol_catalog
+        self.assertEqual(
+            catalog[:6],
+            ["所有协议", "视频网站", "优酷", "爱奇艺", "网络游戏", "王者荣耀"])
+        self.assertIn("淘宝视频", catalog)
+        self.assertEqual(len(catalog), len(set(catalog)))
+
+        # Cached for other managers
+        rd_manager = RouterDataManager(router_instance=self.router)
+        self.assertEqual(
+            rd_manager.protocol_catalog, self.rd_manager.protocol_catalog)
+        self.mock_client.list_protocols_json.assert_called_once()
+
+        rd_manager.invalidate_catalogs()
+        rd_manager.protocol_catalog  # noqa
+        self.assertEqual(self.mock_client.list_protocols_json.call_count, 2)
+
+    def test_domain_group_catalog(self):
+        self.assertEqual(
+            self.rd_manager.domain_group_catalog, ["游戏网站", "视频网站", "购物网站"])
+        self.assertEqual(
+            self.mock_client.exec.call_args.kwargs["func_name"], "domain_group")
+
+    @override_settings(BEHAVIORAL_CONTROL_DOMAIN_GROUP_FETCH_PAGE_SIZE=2)
+    def test_domain_group_catalog_paged(self):
+        groups = DEFAULT_IKUAI_CLIENT_LIST_DOMAIN_GROUPS["data"]
+        self.mock_client.exec.side_effect = [
+            {"Result": 30000, "Data": {"total": 3, "data": groups[:2]}},
+            {"Result": 30000, "Data": {"total": 3, "data": groups[1:]}},
+        ]
+        self.assertEqual(
+            self.rd_manager.domain_group_catalog, ["游戏网站", "视频网站", "购物网站"])
+        self.assertEqual(
+            [call.kwargs["param"]["limit"]
+             for call in self.mock_client.exec.call_args_list],
+            ["0,2", "2,3"])
+
+    def test_invalidate_catalogs_version_changed(self):
+        self.rd_manager.protocol_catalog  # noqa
+        version = DEFAULT_CACHE.get(self.rd_manager.catalog_version_cache_key)
+        self.assertIsNotNone(version)
+
+        RouterDataManager(router_instance=self.router).invalidate_catalogs()
+        self.assertNotEqual(
+            DEFAULT_CACHE.get(self.rd_manager.catalog_version_cache_key),
+            version)
+
+    def test_fetch_failed(self):
+        self.mock_client.exec.side_effect = RouterAPIError("unknown func_name")
+
+        # Domain groups of the rules only, and not cached
+        self.assertEqual(
+            self.rd_manager.domain_group_catalog, ["游戏网站", "视频网站"])
+        self.assertIsNone(
+            DEFAULT_CACHE.get(self.rd_manager.domain_group_catalog_cache_key))
+
+    def test_values_of_rules_included(self):
+        self.mock_client.list_protocols_json.return_value = []
+        self.assertEqual(
+            set(self.rd_manager.protocol_catalog),
+            {value for rule in self.default_ikuai_client_list_acl_l7["data"]
+             for value in rule["app_proto"].split(",")})
+
+
 class MacControlRuleFromAclL7Test(DataManagerTestMixin, TestCase):
 
     def setUp(self):
@@ -218,6 +578,104 @@ class MacControlRuleFromAclL7Test(DataManagerTestMixin, TestCase):
         self.assertIsNone(
             self.rd_manager.get_active_acl_mac_rule_of_device(MAC1))
 
+    def test_acl_mac_index(self):
+        self.fake_set_mac_acl()
+        self.assertEqual(
+            self.rd_manager.acl_mac_index,
+            {MAC2: self.default_list_acl_mac_data["data"]})
+        self.rd_manager.get_active_acl_mac_rule_of_device(MAC2)
+        self.rd_manager.get_active_acl_mac_rule_of_device(MAC1)
+        self.mock_client.list_acl_mac.assert_called_once()
+
+        # Managers initialized from cache use the cached index
+        self.rd_manager.cache_all_data()
+        rd_manager = RouterDataManager(router_instance=self.router)
+        rd_manager.init_data_from_cache()
+        self.assertEqual(rd_manager.acl_mac_index, self.rd_manager.acl_mac_index)
+        self.mock_client.list_acl_mac.assert_called_once()
+
+        rd_manager.invalidate_mac_indexes()
+        rd_manager.acl_mac_index  # noqa
+        self.assertEqual(self.mock_client.list_acl_mac.call_count, 2)
+
+    def test_remove_acl_macs_of_device(self):
+        data = deepcopy(self.default_list_acl_mac_data)
+        data["data"].append(dict(data["data"][0], mac=MAC1, id=2))
+        self.fake_set_mac_acl(data)
+
+        self.rd_manager.remove_acl_macs_of_device(MAC1)
+        self.mock_client.del_acl_mac.assert_called_once_with(acl_mac_id=2)
+
+    def test_remove_acl_macs_of_devices(self):
+        data = deepcopy(self.default_list_acl_mac_data)
+        data["data"].append(dict(data["data"][0], mac=MAC1, id=2))
+        data["data"].append(dict(data["data"][0], mac=MAC1, id=3, enabled="no"))
+        self.fake_set_mac_acl(data)
+
+        self.rd_manager.remove_acl_macs_of_devices([MAC1, MAC2], active_only=True)
+        self.mock_client.del_acl_mac.assert_called_once_with(acl_mac_id="2,1")
+
+    def test_add_acl_mac_rules(self):
+        self.fake_set_mac_acl()
+        self.rd_manager.add_acl_mac_rules([MAC1, MAC2])
+
+        # MAC2 is already blocked
+        self.mock_client.add_acl_mac.assert_called_once_with(mac=MAC1)
+
+    def test_edit_mac_group_members(self):
+        skipped = self.rd_manager.edit_mac_group_members(
+            [MAC1, MAC2], join_groups={MAC_GROUP_1}, leave_groups={MAC_GROUP_2})
+        self.assertEqual(skipped, [MAC_GROUP_2])
+        self.mock_client.edit_mac_group.assert_called_once_with(
+            group_id=1, group_name=MAC_GROUP_1, addr_pools=[MAC1, MAC2])
+
+    def test_refresh_rules(self):
+        self.rd_manager.cache_all_data()
+        self.mock_client.reset_mock()
+
+        acl_l7 = deepcopy(self.default_ikuai_client_list_acl_l7)
+        removed = acl_l7["data"].pop()
+        acl_l7["total"] -= 1
+        self.mock_client.list_acl_l7.return_value = acl_l7
+
+        rd_manager = RouterDataManager(router_instance=self.router)
+        rd_manager.refresh_rules("acl_l7")
+        self.mock_client.list_acl_l7.assert_called_once()
+        self.mock_client.list_monitor_lanip.assert_not_called()
+        self.mock_client.list_mac_groups.assert_not_called()
+
+        rd_manager = RouterDataManager(router_instance=self.router)
+        rd_manager.init_data_from_cache()
+        self.assertNotIn(removed["id"], rd_manager.rule_id_maps["acl_l7"])
+        self.assertEqual(
+            len(rd_manager.rule_id_maps["acl_l7"]), len(acl_l7["data"]))
+
+    def test_refresh_rules_fetched_at_unchanged(self):
+        self.rd_manager.cache_all_data()
+        fetched_at = timezone.now().timestamp() - 100
+        DEFAULT_CACHE.set(
+            self.rd_manager.snapshot_fetched_at_cache_key, fetched_at)
+
+        rd_manager = RouterDataManager(router_instance=self.router)
+        rd_manager.refresh_rules("domain_blacklist")
+        self.assertEqual(
+            DEFAULT_CACHE.get(rd_manager.snapshot_fetched_at_cache_key),
+            fetched_at)
+        self.assertGreaterEqual(rd_manager.get_snapshot_age(), 100)
+
+    def test_set_mac_comment(self):
+        self.mock_client.list_mac_comment.return_value = {
+            "total": 1, "data": [{"id": 3, "mac": MAC1, "comment": "foo"}]}
+
+        self.rd_manager.set_mac_comment(MAC1, "bar")
+        self.mock_client.edit_mac_comment.assert_called_once_with(
+            mac_comment_id=3, mac=MAC1, comment="bar")
+        self.mock_client.add_mac_comment.assert_not_called()
+
+        self.rd_manager.set_mac_comment(MAC2, "bar")
+        self.mock_client.add_mac_comment.assert_called_once_with(
+            mac=MAC2, comment="bar")
+
     def test_add_acl_mac_rule(self):
         self.rd_manager.add_acl_mac_rule({})
 
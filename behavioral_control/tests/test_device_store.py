@@ -0,0 +1,118 @@
+from datetime import timedelta
+from unittest.mock import MagicMock, patch
+
+from django.test import SimpleTestCase
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from redis.exceptions import ConnectionError
+from tests.data_for_tests import MAC1, MAC2
+from tests.mixins import CacheMixin
+
+from my_router.device_store import (RedisRouterDeviceStore, RouterDeviceStore,
+                                    dump_device_record, get_device_store)
+
+DEVICE_INFO = {
+    'comment': '', 'ip_addr': '192.168.1.2', 'client_device': '',
+    'uptime': '2024-02-25 13:32:36', 'reject': 0, 'mac': MAC1, 'id': 1,
+    'hostname': 'foo', 'timestamp': 1708839156, 'client_type': '',
+    'upload': 1000, 'download': 2000}
+
+
+class RouterDeviceStoreTest(CacheMixin, SimpleTestCase):
+    def setUp(self):
+        super().setUp()
+        self.store = get_device_store(1)
+
+    def test_fallback_store(self):
+        self.assertIs(type(self.store), RouterDeviceStore)
+
+    def test_add_macs(self):
+        self.store.add_macs([MAC1])
+        self.store.add_macs([MAC1, MAC2])
+        self.assertEqual(self.store.get_macs(), {MAC1, MAC2})
+        self.assertEqual(get_device_store(2).get_macs(), set())
+
+    def test_records(self):
+        last_seen = timezone.now()
+        self.store.set_records({
+            MAC1: dict(DEVICE_INFO, last_seen=last_seen),
+            MAC2: dict(DEVICE_INFO, mac=MAC2)})
+
+        self.assertEqual(self.store.get_macs(), {MAC1, MAC2})
+
+        record = self.store.get_record(MAC1)
+        # Fields not needed are not kept
+        self.assertNotIn("upload", record)
+        self.assertEqual(record["hostname"], "foo")
+        self.assertAlmostEqual(
+            parse_datetime(record["last_seen"]), last_seen,
+            delta=timedelta(milliseconds=1))
+
+        self.assertEqual(set(self.store.get_records()), {MAC1, MAC2})
+        self.assertEqual(
+            set(self.store.get_records([MAC2, "00:00:00:00:00:01"])), {MAC2})
+
+    def test_update_record(self):
+        self.store.set_records({MAC1: DEVICE_INFO})
+        self.store.update_record(MAC1, comment="bar")
+        self.assertEqual(self.store.get_record(MAC1)["comment"], "bar")
+
+        # Devices without records are not added
+        self.store.update_record(MAC2, comment="bar")
+        self.assertIsNone(self.store.get_record(MAC2))
+
+    def test_remove(self):
+        self.store.set_records({
+            MAC1: DEVICE_INFO, MAC2: dict(DEVICE_INFO, mac=MAC2)})
+        self.store.remove([MAC1])
+        self.assertEqual(self.store.get_macs(), {MAC2})
+        self.assertIsNone(self.store.get_record(MAC1))
+
+        self.store.clear()
+        self.assertEqual(self.store.get_macs(), set())
+        self.assertEqual(self.store.get_records(), {})
+
+
+class RedisRouterDeviceStoreTest(CacheMixin, SimpleTestCase):
+    def setUp(self):
+        super().setUp()
+        self.connection = MagicMock()
+        self.pipeline = self.connection.pipeline.return_value
+        self.store = RedisRouterDeviceStore(1, self.connection)
+
+    def test_set_records_pipelined(self):
+        self.store.set_records({MAC1: DEVICE_INFO})
+
+        self.pipeline.sadd.assert_called_once_with(self.store.known_macs_key, MAC1)
+        self.pipeline.hset.assert_called_once_with(
+            self.store.records_key, mapping={MAC1: dump_device_record(DEVICE_INFO)})
+        self.pipeline.execute.assert_called_once()
+
+    def test_get_records(self):
+        self.connection.hmget.return_value = [
+            dump_device_record(DEVICE_INFO).encode(), None]
+        records = self.store.get_records([MAC1, MAC2])
+        self.assertEqual(list(records), [MAC1])
+        self.assertEqual(records[MAC1]["hostname"], "foo")
+
+        self.connection.hgetall.return_value = {
+            MAC1.encode(): dump_device_record(DEVICE_INFO).encode()}
+        self.assertEqual(list(self.store.get_records()), [MAC1])
+
+    def test_get_macs(self):
+        self.connection.smembers.return_value = {MAC1.encode()}
+        self.assertEqual(self.store.get_macs(), {MAC1})
+
+    def test_remove(self):
+        self.store.remove([MAC1])
+        self.pipeline.srem.assert_called_once_with(self.store.known_macs_key, MAC1)
+        self.pipeline.hdel.assert_called_once_with(self.store.records_key, MAC1)
+
+    def test_connection_error(self):
+        self.connection.smembers.side_effect = ConnectionError()
+        with self.assertRaises(ConnectionError):
+            self.store.get_macs()
+
+        with patch.object(
+                self.test_cache, "_ignore_exceptions", True, create=True):
+            self.assertEqual(self.store.get_macs(), set())
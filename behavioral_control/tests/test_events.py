@@ -0,0 +1,164 @@
+import threading
+from copy import deepcopy
+from unittest.mock import MagicMock
+
+from django.test import SimpleTestCase, TestCase, override_settings
+from tests.data_for_tests import (DEFAULT_IKUAI_CLIENT_LIST_ACL_L7,
+                                  DEFAULT_IKUAI_CLIENT_LIST_MAC_GROUPS,
+                                  DEFAULT_IKUAI_CLIENT_LIST_MONITOR_LANIP,
+                                  MAC1, MAC2, MAC_GROUP_2)
+from tests.mixins import CacheMixin, ViewTestMixin
+
+from my_router.data_manager import RouterDataManager
+from my_router.events import (RedisEventStream, diff_snapshots,
+                              get_last_event_id, publish_events, read_events)
+from my_router.snapshot import snapshot_cache
+from my_router.views import fetch_new_info_save_and_set_cache
+
+
+def get_snapshot(devices=None, acl_l7=None, mac_groups=None):
+    return {
+        "_devices": (
+            devices or DEFAULT_IKUAI_CLIENT_LIST_MONITOR_LANIP)["data"],
+        "_acl_l7_list": (acl_l7 or DEFAULT_IKUAI_CLIENT_LIST_ACL_L7)["data"],
+        "_mac_groups_list": mac_groups or DEFAULT_IKUAI_CLIENT_LIST_MAC_GROUPS,
+    }
+
+
+class DiffSnapshotsTest(SimpleTestCase):
+    def test_no_change(self):
+        self.assertEqual(diff_snapshots(get_snapshot(), get_snapshot()), [])
+
+    def test_devices(self):
+        devices = deepcopy(DEFAULT_IKUAI_CLIENT_LIST_MONITOR_LANIP)
+        devices["data"] = [d for d in devices["data"] if d["mac"] != MAC1]
+
+        self.assertEqual(
+            diff_snapshots(get_snapshot(), get_snapshot(devices=devices)),
+            [{"type": "device_offline", "mac": MAC1}])
+        self.assertEqual(
+            diff_snapshots(get_snapshot(devices=devices), get_snapshot()),
+            [{"type": "device_online", "mac": MAC1}])
+
+    def test_rules(self):
+        acl_l7 = deepcopy(DEFAULT_IKUAI_CLIENT_LIST_ACL_L7)
+        removed = acl_l7["data"].pop(0)
+        acl_l7["data"][0]["comment"] = "changed"
+        acl_l7["data"].append(dict(removed, id=1000))
+
+        events = diff_snapshots(get_snapshot(), get_snapshot(acl_l7=acl_l7))
+        self.assertCountEqual(events, [
+            {"type": "rule_added", "kind": "acl_l7", "id": 1000},
+            {"type": "rule_removed", "kind": "acl_l7", "id": removed["id"]},
+            {"type": "rule_modified", "kind": "acl_l7",
+             "id": acl_l7["data"][0]["id"]},
+        ])
+
+    def test_mac_group_membership(self):
+        mac_groups = deepcopy(DEFAULT_IKUAI_CLIENT_LIST_MAC_GROUPS)
+        group = [g for g in mac_groups["data"]
+                 if g["group_name"] == MAC_GROUP_2][0]
+        group["addr_pool"] = MAC1
+
+        events = diff_snapshots(
+            get_snapshot(), get_snapshot(mac_groups=mac_groups))
+        self.assertCountEqual(events, [
+            {"type": "rule_modified", "kind": "mac_group", "id": group["id"]},
+            {"type": "mac_group_left", "group": MAC_GROUP_2, "mac": MAC2},
+        ])
+
+
+class InProcessEventStreamTest(CacheMixin, SimpleTestCase):
+    def test_publish_and_read(self):
+        publish_events(1, [{"type": "foo"}, {"type": "bar"}])
+        publish_events(2, [{"type": "baz"}])
+
+        events = read_events(1)
+        self.assertEqual([e for _, e in events], [{"type": "foo"}, {"type": "bar"}])
+
+        last_id = events[0][0]
+        self.assertEqual(
+            [e for _, e in read_events(1, last_id=last_id)], [{"type": "bar"}])
+        self.assertEqual(read_events(1, last_id=events[-1][0]), [])
+        self.assertEqual(len(read_events(1, count=1)), 1)
+
+        self.assertEqual(get_last_event_id(1), events[-1][0])
+        self.assertEqual(get_last_event_id(3), "0")
+
+    @override_settings(BEHAVIORAL_CONTROL_EVENT_STREAM_MAXLEN=2)
+    def test_maxlen(self):
+        publish_events(1, [{"type": str(i)} for i in range(5)])
+        self.assertEqual(
+            [e["type"] for _, e in read_events(1)], ["3", "4"])
+
+    def test_blocking_read(self):
+        timer = threading.Timer(0.05, publish_events, [1, [{"type": "foo"}]])
+        timer.start()
+        self.addCleanup(timer.join)
+        events = read_events(1, block=5000)
+        self.assertEqual([e for _, e in events], [{"type": "foo"}])
+
+
+class RedisEventStreamTest(CacheMixin, SimpleTestCase):
+    def test_publish_and_read(self):
+        connection = MagicMock()
+        stream = RedisEventStream(1, connection)
+
+        stream.publish([{"type": "foo"}])
+        connection.pipeline.return_value.xadd.assert_called_once_with(
+            stream.key, {"event": '{"type":"foo"}'}, maxlen=1000,
+            approximate=True)
+
+        connection.xread.return_value = [
+            [stream.key.encode(), [(b"1-0", {b"event": b'{"type":"foo"}'})]]]
+        self.assertEqual(
+            stream.read(last_id="0-0", count=10),
+            [("1-0", {"type": "foo"})])
+        connection.xread.assert_called_once_with(
+            {stream.key: "0-0"}, count=10, block=None)
+
+
+class FetchPublishEventsTest(CacheMixin, ViewTestMixin, TestCase):
+    def test_events_published(self):
+        # No change since the first fetch
+        fetch_new_info_save_and_set_cache(router=self.router)
+        self.assertEqual(read_events(self.router.id), [])
+
+        devices = deepcopy(DEFAULT_IKUAI_CLIENT_LIST_MONITOR_LANIP)
+        devices["data"] = [d for d in devices["data"] if d["mac"] != MAC2]
+        devices["total"] = len(devices["data"])
+        self.mock_client.list_monitor_lanip.return_value = devices
+
+        fetch_new_info_save_and_set_cache(router=self.router)
+        self.assertEqual(
+            [e for _, e in read_events(self.router.id)],
+            [{"type": "device_offline", "mac": MAC2}])
+
+    def test_rule_change_published(self):
+        fetch_new_info_save_and_set_cache(router=self.router)
+
+        acl_l7 = deepcopy(DEFAULT_IKUAI_CLIENT_LIST_ACL_L7)
+        removed = acl_l7["data"].pop(0)
+        acl_l7["total"] = len(acl_l7["data"])
+        self.mock_client.list_acl_l7.return_value = acl_l7
+
+        # As in a worker which never decoded the previous snapshot
+        snapshot_cache.clear()
+        fetch_new_info_save_and_set_cache(router=self.router)
+        self.assertEqual(
+            [e for _, e in read_events(self.router.id)],
+            [{"type": "rule_removed", "kind": "acl_l7", "id": removed["id"]}])
+
+    def test_refresh_rules_published(self):
+        fetch_new_info_save_and_set_cache(router=self.router)
+
+        acl_l7 = deepcopy(DEFAULT_IKUAI_CLIENT_LIST_ACL_L7)
+        acl_l7["data"][0]["comment"] = "foo"
+        self.mock_client.list_acl_l7.return_value = acl_l7
+
+        snapshot_cache.clear()
+        RouterDataManager(router_instance=self.router).refresh_rules("acl_l7")
+        self.assertEqual(
+            [e for _, e in read_events(self.router.id)],
+            [{"type": "rule_modified", "kind": "acl_l7",
+              "id": acl_l7["data"][0]["id"]}])
@@ -0,0 +1,121 @@
+import time
+
+from django.test import SimpleTestCase, TestCase
+from pyikuai import IKuaiClient
+from pyikuai.exceptions import AuthenticationError, RouterAPIError
+from tests.data_for_tests import SYNTHETIC_DOMAIN_GROUPS, SYNTHETIC_PROTOCOLS
+from tests.factories import RouterFactory
+from tests.fake_ikuai_server import FakeIKuaiServer
+from tests.mixins import CacheMixin
+
+from my_router.client_pool import client_pool
+from my_router.data_manager import RouterDataManager
+from my_router.models import Device
+from my_router.rate_limit import clear_router_limiters
+
+
+class FakeIKuaiServerMixin:
+    fake_server_kwargs = {}
+
+    def setUp(self):
+        super().setUp()
+        self.server = FakeIKuaiServer(**self.fake_server_kwargs).start()
+        self.addCleanup(self.server.stop)
+
+    def get_ikuai_client(self, password=None):
+        return IKuaiClient(
+            url=self.server.url, username=self.server.username,
+            password=password or self.server.password)
+
+
+class FakeIKuaiServerTest(FakeIKuaiServerMixin, SimpleTestCase):
+    fake_server_kwargs = {"n_devices": 150, "n_mac_groups": 3}
+
+    def test_list_with_limit(self):
+        client = self.get_ikuai_client()
+
+        result = client.list_monitor_lanip()
+        self.assertEqual(result["total"], 150)
+        self.assertEqual(len(result["data"]), 100)
+
+        result = client.list_monitor_lanip(limit=[0, 1000])
+        self.assertEqual(len(result["data"]), 150)
+
+        self.assertEqual(len(client.list_mac_groups()["data"]), 3)
+        self.assertEqual(self.server.router.call_counts["login"], 1)
+
+    def test_wrong_password(self):
+        client = self.get_ikuai_client(password="wrong")
+        with self.assertRaises(AuthenticationError):
+            client.list_acl_l7()
+
+    def test_relogin(self):
+        client = self.get_ikuai_client()
+        client.get_sysstat()
+        self.server.router.drop_sessions()
+        client.get_sysstat()
+        self.assertEqual(self.server.router.call_counts["login"], 2)
+
+    def test_crud(self):
+        client = self.get_ikuai_client()
+        result = client.add_mac_group(group_name="NEW", addr_pools=["foo"])
+        row_id = result["RowId"]
+
+        client.edit_mac_group(
+            group_id=row_id, group_name="NEW", addr_pools=["foo", "bar"])
+        rows = {row["id"]: row for row in client.list_mac_groups()["data"]}
+        self.assertEqual(rows[row_id]["addr_pool"], "foo,bar")
+
+        client.del_mac_group(row_id)
+        rows = {row["id"]: row for row in client.list_mac_groups()["data"]}
+        self.assertNotIn(row_id, rows)
+
+        with self.assertRaises(RouterAPIError):
+            client.exec("monitor_lanip", "add", {})
+
+    def test_protocols_json(self):
+        self.assertTrue(len(self.get_ikuai_client().list_protocols_json()))
+
+    def test_latency(self):
+        self.server.router.latency = 0.05
+        start = time.perf_counter()
+        self.get_ikuai_client().get_sysstat()
+        # login and the call
+        self.assertGreaterEqual(time.perf_counter() - start, 0.1)
+
+
+class FetchWithFakeIKuaiServerTest(FakeIKuaiServerMixin, CacheMixin, TestCase):
+    fake_server_kwargs = {"n_devices": 20, "n_mac_groups": 3}
+
+    def setUp(self):
+        super().setUp()
+        self.addCleanup(client_pool.clear)
+        self.addCleanup(clear_router_limiters)
+
+    def test_fetch_cycle(self):
+        # Creating a router fetches its data
+        with self.captureOnCommitCallbacks(execute=True):
+            router = RouterFactory(
+                url=self.server.url, admin_username=self.server.username,
+                admin_password=self.server.password)
+
+        self.assertEqual(Device.objects.filter(router=router).count(), 20)
+
+        rd_manager = RouterDataManager(router_instance=router)
+        rd_manager.init_data_from_cache()
+        self.assertEqual(len(rd_manager.devices), 20)
+        self.assertEqual(len(rd_manager.mac_groups), 3)
+        self.assertGreater(self.server.router.total_calls, 0)
+
+    def test_catalogs(self):
+        router = RouterFactory(
+            url=self.server.url, admin_username=self.server.username,
+            admin_password=self.server.password)
+        rd_manager = RouterDataManager(router_instance=router)
+        rd_manager.init_data_from_cache()
+        self.assertEqual(
+            rd_manager.protocol_catalog[:len(SYNTHETIC_PROTOCOLS)],
+            SYNTHETIC_PROTOCOLS)
+        self.assertEqual(
+            rd_manager.domain_group_catalog[:len(SYNTHETIC_DOMAIN_GROUPS)],
+            SYNTHETIC_DOMAIN_GROUPS)
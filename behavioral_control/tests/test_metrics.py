@@ -0,0 +1,209 @@
+from unittest.mock import MagicMock, patch
+
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.urls import reverse
+from tests.factories import UserFactory
+from tests.mixins import CacheMixin, RequestTestMixin, ViewTestMixin
+
+from my_router import metrics
+from my_router.constants import DEFAULT_CACHE
+from my_router.models import Device
+
+
+class MetricsCollectorTest(CacheMixin, SimpleTestCase):
+    def test_histogram(self):
+        labels = {"router": 1, "endpoint": "list_acl_l7"}
+        metrics.observe("router_api_call_duration_seconds", labels, 0.02)
+        metrics.observe("router_api_call_duration_seconds", labels, 0.3)
+        metrics.observe("router_api_call_duration_seconds", labels, 100)
+
+        rendered = metrics.render_metrics()
+        self.assertIn(
+            "# TYPE behavioral_control_router_api_call_duration_seconds "
+            "histogram", rendered)
+
+        prefix = "behavioral_control_router_api_call_duration_seconds"
+        label_str = 'endpoint="list_acl_l7",router="1"'
+        for line in [
+                f'{prefix}_bucket{{{label_str},le="0.01"}} 0',
+                f'{prefix}_bucket{{{label_str},le="0.025"}} 1',
+                f'{prefix}_bucket{{{label_str},le="0.5"}} 2',
+                f'{prefix}_bucket{{{label_str},le="60"}} 2',
+                f'{prefix}_bucket{{{label_str},le="+Inf"}} 3',
+                f'{prefix}_sum{{{label_str}}} 100.32',
+                f'{prefix}_count{{{label_str}}} 3']:
+            with self.subTest(line=line):
+                self.assertIn(line, rendered.splitlines())
+
+    def test_counter_and_gauge(self):
+        metrics.inc("fetch_cycles_total", {"router": 1})
+        metrics.inc("fetch_cycles_total", {"router": 1})
+        metrics.inc("fetch_cycles_total", {"router": 2})
+        metrics.set_gauge("snapshot_size_bytes", {"router": 1}, 100)
+        metrics.set_gauge("snapshot_size_bytes", {"router": 1}, 200)
+
+        lines = metrics.render_metrics().splitlines()
+        self.assertIn('behavioral_control_fetch_cycles_total{router="1"} 2', lines)
+        self.assertIn('behavioral_control_fetch_cycles_total{router="2"} 1', lines)
+        self.assertIn(
+            'behavioral_control_snapshot_size_bytes{router="1"} 200', lines)
+
+    def test_reset_metrics(self):
+        metrics.inc("fetch_cycles_total", {"router": 1})
+        metrics.reset_metrics()
+        self.assertEqual(metrics.render_metrics(), "\n")
+
+    def test_flush_nothing_recorded(self):
+        with patch("my_router.metrics.get_metrics_cache") as mock_cache:
+            metrics.MetricsCollector().flush()
+        mock_cache.assert_not_called()
+
+    def test_series_index_read_for_new_series(self):
+        metrics.inc("fetch_cycles_total", {"router": 1})
+
+        metrics_cache = metrics.get_metrics_cache()
+        with patch.object(metrics_cache, "get",
+                          wraps=metrics_cache.get) as mock_get:
+            metrics.inc("fetch_cycles_total", {"router": 1})
+            mock_get.assert_not_called()
+
+            metrics.inc("fetch_cycles_total", {"router": 2})
+            mock_get.assert_called_once_with(metrics.METRICS_SERIES_KEY, set())
+
+        lines = metrics.render_metrics().splitlines()
+        self.assertIn('behavioral_control_fetch_cycles_total{router="1"} 2', lines)
+        self.assertIn('behavioral_control_fetch_cycles_total{router="2"} 1', lines)
+
+    @override_settings(BEHAVIORAL_CONTROL_METRICS_ENABLED=False)
+    def test_disabled(self):
+        metrics.inc("fetch_cycles_total", {"router": 1})
+        self.assertEqual(metrics.render_metrics(), "\n")
+
+
+class CollectFetchTest(CacheMixin, TestCase):
+    def test_counts(self):
+        client = MagicMock()
+        client.list_acl_l7.return_value = []
+        instrumented_client = metrics.InstrumentedClient(client, 1)
+
+        with metrics.collect_fetch(1) as collector:
+            instrumented_client.list_acl_l7()
+            DEFAULT_CACHE.set("foo", "bar")
+            DEFAULT_CACHE.get("foo")
+            Device.objects.count()
+
+            # Buffered until the end of the cycle
+            self.assertEqual(metrics.render_metrics(), "\n")
+
+        self.assertEqual(collector.router_calls, 1)
+        self.assertEqual(collector.cache_ops, 2)
+        self.assertEqual(collector.db_queries, 1)
+
+        lines = metrics.render_metrics().splitlines()
+        for line in [
+                'behavioral_control_fetch_cycles_total{router="1"} 1',
+                'behavioral_control_fetch_router_calls_total{router="1"} 1',
+                'behavioral_control_fetch_cache_ops_total{router="1"} 2',
+                'behavioral_control_fetch_db_queries_total{router="1"} 1',
+                'behavioral_control_router_api_call_duration_seconds_count'
+                '{endpoint="list_acl_l7",router="1"} 1',
+                'behavioral_control_fetch_stage_duration_seconds_count'
+                '{router="1",stage="total"} 1']:
+            with self.subTest(line=line):
+                self.assertIn(line, lines)
+
+    def test_cache_ops_not_counted_outside_fetch(self):
+        with metrics.collect_fetch(1) as collector:
+            pass
+        DEFAULT_CACHE.get("foo")
+        self.assertEqual(collector.cache_ops, 0)
+
+    def test_router_call_error(self):
+        client = MagicMock()
+        client.list_acl_l7.side_effect = RuntimeError()
+        instrumented_client = metrics.InstrumentedClient(client, 1)
+
+        with self.assertRaises(RuntimeError):
+            instrumented_client.list_acl_l7()
+
+        self.assertIn(
+            'behavioral_control_router_api_call_errors_total'
+            '{endpoint="list_acl_l7",router="1"} 1',
+            metrics.render_metrics().splitlines())
+
+
+class CollectTest(CacheMixin, SimpleTestCase):
+    def test_flushed_once(self):
+        client = MagicMock()
+        instrumented_client = metrics.InstrumentedClient(client, 1)
+
+        with patch.object(
+                metrics.MetricsCollector, "flush", autospec=True,
+                side_effect=metrics.MetricsCollector.flush) as mock_flush:
+            with metrics.collect():
+                instrumented_client.list_acl_l7()
+                instrumented_client.list_mac_groups()
+                self.assertEqual(metrics.render_metrics(), "\n")
+
+        self.assertEqual(mock_flush.call_count, 1)
+        self.assertIn(
+            'behavioral_control_router_api_call_duration_seconds_count'
+            '{endpoint="list_mac_groups",router="1"} 1',
+            metrics.render_metrics().splitlines())
+
+    def test_within_fetch_cycle(self):
+        with metrics.collect_fetch(1) as collector:
+            with metrics.collect():
+                metrics.inc("snapshot_events_total", {"router": 1})
+            # Buffered by the collector of the cycle
+            self.assertIn(("snapshot_events_total", (("router", 1),)),
+                          collector._series)
+            self.assertEqual(metrics.render_metrics(), "\n")
+
+    def test_middleware(self):
+        def get_response(request):
+            metrics.inc("snapshot_events_total", {"router": 1})
+            self.assertEqual(metrics.render_metrics(), "\n")
+            return "response"
+
+        middleware = metrics.MetricsMiddleware(get_response)
+        self.assertEqual(middleware(MagicMock()), "response")
+        self.assertIn(
+            'behavioral_control_snapshot_events_total{router="1"} 1',
+            metrics.render_metrics().splitlines())
+
+
+class MetricsViewTest(ViewTestMixin, RequestTestMixin, TestCase):
+    def test_fetch_cycle_recorded(self):
+        self.client.force_login(UserFactory(is_staff=True))
+        resp = self.client.get(reverse("metrics"))
+        self.assertEqual(resp.status_code, 200)
+        self.assertTrue(resp["Content-Type"].startswith("text/plain"))
+
+        content = resp.content.decode()
+        self.assertIn(
+            f'behavioral_control_fetch_cycles_total{{router="{self.router.id}"}} 1',
+            content)
+        self.assertIn(
+            f'behavioral_control_snapshot_devices{{router="{self.router.id}"}}',
+            content)
+        for stage in ["device_fetch", "db_sync", "device_cache",
+                      "snapshot_cache", "mac_cache", "mac_index", "mac_control",
+                      "total"]:
+            with self.subTest(stage=stage):
+                self.assertIn(f'stage="{stage}"', content)
+
+    def test_not_staff(self):
+        resp = self.client.get(reverse("metrics"))
+        self.assertEqual(resp.status_code, 403)
+
+    @override_settings(BEHAVIORAL_CONTROL_METRICS_TOKEN="foo")
+    def test_token(self):
+        self.client.logout()
+        resp = self.client.get(
+            reverse("metrics"), HTTP_AUTHORIZATION="Bearer foo")
+        self.assertEqual(resp.status_code, 200)
+
+        resp = self.client.get(
+            reverse("metrics"), HTTP_AUTHORIZATION="Bearer bar")
+        self.assertEqual(resp.status_code, 403)
@@ -1,9 +1,11 @@
+import threading
 from unittest.mock import patch
 
 from django.test import TestCase
 from django_celery_beat.models import IntervalSchedule, PeriodicTask
 from tests.mixins import CacheMixin, MockRouterClientMixin
 
+from my_router.client_pool import client_pool
 from my_router.models import Router
 
 
@@ -24,6 +26,39 @@ class RouterModelTest(CacheMixin, MockRouterClientMixin, TestCase):
             password=self.router.admin_password)
         self.assertIsNotNone(client)
 
+    @patch('my_router.models.IKuaiClient')
+    def test_get_client_pooled(self, MockClient):
+        client = self.router.get_client()
+        self.assertIs(Router.objects.get(pk=self.router.pk).get_client(), client)
+        self.assertEqual(MockClient.call_count, 1)
+
+        # Changing the credentials replaces the pooled client
+        self.router.admin_password = "new_password"
+        self.router.get_client()
+        self.assertEqual(MockClient.call_count, 2)
+        MockClient.assert_called_with(
+            url=self.router.url, username=self.router.admin_username,
+            password="new_password")
+
+    @patch('my_router.models.IKuaiClient')
+    def test_get_client_pooled_per_thread(self, MockClient):
+        client = self.router.get_client()
+
+        other_clients = []
+        thread = threading.Thread(
+            target=lambda: other_clients.append(self.router.get_client()))
+        thread.start()
+        thread.join()
+        self.assertIsNot(other_clients[0], client)
+        self.assertIs(self.router.get_client(), client)
+
+    @patch('my_router.models.IKuaiClient')
+    def test_get_client_discarded(self, MockClient):
+        client = self.router.get_client()
+        client_pool.discard(self.router.pk)
+        self.assertIsNot(self.router.get_client(), client)
+        self.assertEqual(MockClient.call_count, 2)
+
     def test_interval_schedule(self):
         interval_schedule = self.router.interval_schedule
         self.assertIsInstance(interval_schedule, IntervalSchedule)
@@ -0,0 +1,260 @@
+import threading
+import time
+from unittest import mock
+
+from django.core.cache import caches
+from django.test import SimpleTestCase, override_settings
+from redis.exceptions import ConnectionError
+
+from my_router.constants import router_call_priority
+from my_router.rate_limit import (RateLimitedClient, RedisRouterCallLimiter,
+                                  RouterCallLimiter, call_priority,
+                                  clear_router_limiters, get_call_priority,
+                                  get_router_limiter)
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.
+
+    def __call__(self):
+        return self.now
+
+
+class RouterCallLimiterTest(SimpleTestCase):
+    def test_burst_admitted_without_delay(self):
+        limiter = RouterCallLimiter(rate=1, burst=3, max_concurrency=None)
+        for _ in range(3):
+            self.assertEqual(limiter.acquire(), 0)
+            limiter.release()
+
+        stats = limiter.get_stats()
+        self.assertEqual(
+            stats["priorities"][router_call_priority.interactive]["calls"], 3)
+        self.assertEqual(
+            stats["priorities"][router_call_priority.interactive]["queued"], 0)
+
+    def test_tokens_refilled_by_rate(self):
+        clock = FakeClock()
+        limiter = RouterCallLimiter(
+            rate=2, burst=1, max_concurrency=None, clock=clock)
+        limiter.acquire()
+        limiter.release()
+
+        clock.now = 0.5
+        self.assertEqual(limiter.acquire(), 0)
+        limiter.release()
+
+    def test_call_over_budget_delayed(self):
+        limiter = RouterCallLimiter(rate=20, burst=1, max_concurrency=None)
+        limiter.acquire()
+        limiter.release()
+
+        delay = limiter.acquire()
+        limiter.release()
+        self.assertGreater(delay, 0)
+
+        stats = limiter.get_stats()["priorities"][
+            router_call_priority.interactive]
+        self.assertEqual(stats["queued"], 1)
+        self.assertEqual(stats["max_delay"], delay)
+
+    def test_no_rate_limit(self):
+        limiter = RouterCallLimiter(rate=0, burst=1, max_concurrency=None)
+        for _ in range(20):
+            self.assertEqual(limiter.acquire(), 0)
+            limiter.release()
+
+    def test_interactive_admitted_before_background(self):
+        limiter = RouterCallLimiter(rate=None, burst=1, max_concurrency=1)
+        limiter.acquire()
+
+        admitted = []
+
+        def call(priority):
+            with limiter.limit(priority):
+                admitted.append(priority)
+
+        threads = [
+            threading.Thread(
+                target=call, args=(router_call_priority.background,)),
+            threading.Thread(
+                target=call, args=(router_call_priority.interactive,)),
+        ]
+        for thread in threads:
+            thread.start()
+            # Make sure the background call is queued first
+            while limiter.get_stats()["waiting"] < threads.index(thread) + 1:
+                time.sleep(0.001)
+
+        limiter.release()
+        for thread in threads:
+            thread.join(timeout=5)
+
+        self.assertEqual(
+            admitted,
+            [router_call_priority.interactive,
+             router_call_priority.background])
+
+    def test_concurrency_cap(self):
+        limiter = RouterCallLimiter(rate=None, burst=1, max_concurrency=2)
+        limiter.acquire()
+        limiter.acquire()
+        self.assertEqual(limiter.get_stats()["in_flight"], 2)
+
+        thread = threading.Thread(target=limiter.acquire)
+        thread.start()
+        while not limiter.get_stats()["waiting"]:
+            time.sleep(0.001)
+        self.assertEqual(limiter.get_stats()["in_flight"], 2)
+
+        limiter.release()
+        thread.join(timeout=5)
+        self.assertEqual(limiter.get_stats()["in_flight"], 2)
+        self.assertEqual(limiter.get_stats()["waiting"], 0)
+
+
+class CallPriorityTest(SimpleTestCase):
+    def test_call_priority_context(self):
+        self.assertEqual(
+            get_call_priority(), router_call_priority.interactive)
+        with call_priority(router_call_priority.background):
+            self.assertEqual(
+                get_call_priority(), router_call_priority.background)
+        self.assertEqual(
+            get_call_priority(), router_call_priority.interactive)
+
+
+class RateLimitedClientTest(SimpleTestCase):
+    def setUp(self):
+        self.client = mock.MagicMock()
+        self.client.list_monitor_lanip.return_value = ["foo"]
+        self.client.url = "http://192.168.1.1"
+        self.limiter = RouterCallLimiter(
+            rate=None, burst=1, max_concurrency=None)
+        self.limited_client = RateLimitedClient(self.client, self.limiter)
+
+    def test_api_call_limited(self):
+        with call_priority(router_call_priority.background):
+            self.assertEqual(
+                self.limited_client.list_monitor_lanip(limit=[0, 10]),
+                ["foo"])
+        self.client.list_monitor_lanip.assert_called_once_with(limit=[0, 10])
+
+        stats = self.limiter.get_stats()
+        self.assertEqual(
+            stats["priorities"][router_call_priority.background]["calls"], 1)
+        self.assertEqual(stats["in_flight"], 0)
+
+    def test_exception_releases_limiter(self):
+        self.client.del_acl_mac.side_effect = RuntimeError("foo")
+        with self.assertRaises(RuntimeError):
+            self.limited_client.del_acl_mac("1")
+        self.assertEqual(self.limiter.get_stats()["in_flight"], 0)
+
+    def test_validators_and_attributes_not_limited(self):
+        self.assertEqual(self.limited_client.url, "http://192.168.1.1")
+        self.limited_client.validate_weekday("1234567")
+        self.client.validate_weekday.assert_called_once_with("1234567")
+        self.assertEqual(self.limiter.get_stats()["priorities"], {})
+
+
+class RedisRouterCallLimiterTest(SimpleTestCase):
+    def setUp(self):
+        self.connection = mock.MagicMock()
+        self.script = self.connection.register_script.return_value
+        self.pipeline = self.connection.pipeline.return_value
+        self.limiter = RedisRouterCallLimiter(
+            rate=5, burst=10, max_concurrency=2, connection=self.connection,
+            router_id=1)
+
+    def test_admitted(self):
+        self.script.return_value = [1, b"0"]
+        self.assertEqual(
+            self.limiter.acquire(router_call_priority.background), 0)
+
+        kwargs = self.script.call_args.kwargs
+        self.assertEqual(
+            kwargs["keys"],
+            [self.limiter.queue_key, self.limiter.seen_key,
+             self.limiter.in_flight_key, self.limiter.bucket_key])
+        self.assertIn(":1:api_limiter:", self.limiter.queue_key)
+        ticket = kwargs["args"][0]
+        self.assertEqual(
+            kwargs["args"][1:], [router_call_priority.background, 5, 10, 2,
+                                 self.limiter.lease, self.limiter.stale_after])
+
+        self.limiter.release()
+        self.pipeline.zrem.assert_any_call(self.limiter.in_flight_key, ticket)
+        self.pipeline.execute.assert_called_once()
+
+    @mock.patch("my_router.rate_limit.time.sleep")
+    def test_polls_until_admitted(self, mock_sleep):
+        self.script.side_effect = [[0, b"-1"], [0, b"0.01"], [1, b"0"]]
+        self.limiter.acquire()
+
+        self.assertEqual(self.script.call_count, 3)
+        # The same ticket keeps its place in the queue
+        self.assertEqual(
+            len({call.kwargs["args"][0] for call in self.script.call_args_list}),
+            1)
+        self.assertEqual(
+            [call.args[0] for call in mock_sleep.call_args_list],
+            [self.limiter.poll_interval, 0.01])
+
+        self.pipeline.execute.return_value = [1, 0]
+        stats = self.limiter.get_stats()["priorities"]
+        self.assertEqual(stats[router_call_priority.interactive]["queued"], 1)
+
+    @mock.patch("my_router.rate_limit.time.sleep")
+    def test_ticket_discarded_when_interrupted(self, mock_sleep):
+        self.script.return_value = [0, b"-1"]
+        mock_sleep.side_effect = KeyboardInterrupt
+        with self.assertRaises(KeyboardInterrupt):
+            self.limiter.acquire()
+
+        ticket = self.script.call_args.kwargs["args"][0]
+        self.pipeline.zrem.assert_any_call(self.limiter.queue_key, ticket)
+
+    def test_admitted_while_redis_down(self):
+        self.script.side_effect = ConnectionError()
+        with self.assertRaises(ConnectionError):
+            self.limiter.acquire()
+
+        with mock.patch.object(
+                caches["default"], "_ignore_exceptions", True, create=True):
+            self.assertEqual(self.limiter.acquire(), 0)
+            self.limiter.release()
+
+    def test_stats(self):
+        self.pipeline.execute.return_value = [2, 3]
+        stats = self.limiter.get_stats()
+        self.assertEqual(stats["in_flight"], 2)
+        self.assertEqual(stats["waiting"], 3)
+
+
+class GetRouterLimiterTest(SimpleTestCase):
+    def setUp(self):
+        self.addCleanup(clear_router_limiters)
+
+    @override_settings(
+        BEHAVIORAL_CONTROL_ROUTER_API_RATE=3,
+        BEHAVIORAL_CONTROL_ROUTER_API_BURST=4,
+        BEHAVIORAL_CONTROL_ROUTER_API_CONCURRENCY=1)
+    def test_limiter_per_router(self):
+        limiter = get_router_limiter(1)
+        self.assertIs(get_router_limiter(1), limiter)
+        self.assertIsNot(get_router_limiter(2), limiter)
+
+        self.assertEqual(limiter.rate, 3)
+        self.assertEqual(limiter.burst, 4)
+        self.assertEqual(limiter.max_concurrency, 1)
+
+    def test_shared_through_redis(self):
+        connection = mock.MagicMock()
+        with mock.patch("my_router.rate_limit.get_default_redis_connection",
+                        return_value=connection):
+            limiter = get_router_limiter(1)
+
+        self.assertIsInstance(limiter, RedisRouterCallLimiter)
+        self.assertIs(limiter.connection, connection)
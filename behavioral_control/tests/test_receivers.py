@@ -1,31 +1,106 @@
 from unittest.mock import patch
+from weakref import WeakValueDictionary
 
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
 from django.test import TestCase
 from tests.data_for_tests import MAC2
 from tests.mixins import CacheMixin, ViewTestMixin
 
 from my_router.constants import DEFAULT_CACHE
+from my_router.data_manager import RouterDataManager
+from my_router.device_store import get_device_store
 from my_router.models import Device
-from my_router.utils import (get_device_db_cache_key,
-                             get_router_device_cache_key)
+from my_router.receivers import (_pending_router_refreshes,
+                                 schedule_router_refresh)
+from my_router.utils import get_device_db_cache_key
 
 
 class RouterModelTest(CacheMixin, ViewTestMixin, TestCase):
     def test_delete_device_cache_removed(self):
         db_cache_key = get_device_db_cache_key(self.first_device.mac)
-        device_cache_key = get_router_device_cache_key(
-            self.router.id, self.first_device.mac)
+        device_store = get_device_store(self.router.id)
 
         self.assertIsNotNone(self.test_cache.get(db_cache_key))
-        self.assertIsNotNone(self.test_cache.get(device_cache_key))
+        self.assertIsNotNone(device_store.get_record(self.first_device.mac))
 
         with patch("my_router.receivers.fetch_new_info_save_and_set_cache"
                    ) as mock_fetch_and_set_cache:
-            Device.objects.first().delete()
+            with self.captureOnCommitCallbacks(execute=True):
+                Device.objects.first().delete()
             self.assertIsNone(DEFAULT_CACHE.get(db_cache_key))
-            self.assertIsNone(DEFAULT_CACHE.get(device_cache_key))
+            self.assertIsNone(device_store.get_record(self.first_device.mac))
+            self.assertNotIn(self.first_device.mac, device_store.get_macs())
+            mock_fetch_and_set_cache.assert_called_once_with(
+                router_id=self.router.id)
+
+    def test_bulk_delete_refreshes_once(self):
+        with patch("my_router.receivers.fetch_new_info_save_and_set_cache"
+                   ) as mock_fetch_and_set_cache:
+            with self.captureOnCommitCallbacks(execute=True):
+                with transaction.atomic():
+                    for device in Device.objects.filter(router=self.router):
+                        device.delete()
+            mock_fetch_and_set_cache.assert_called_once_with(
+                router_id=self.router.id)
+
+    def test_rolled_back_refresh_discarded(self):
+        with patch("my_router.receivers.fetch_new_info_save_and_set_cache"
+                   ) as mock_fetch_and_set_cache:
+            with self.captureOnCommitCallbacks(execute=True):
+                try:
+                    with transaction.atomic():
+                        Device.objects.first().delete()
+                        raise RuntimeError()
+                except RuntimeError:
+                    pass
+                Device.objects.first().delete()
             mock_fetch_and_set_cache.assert_called_once()
 
+    def test_rolled_back_refresh_not_pending(self):
+        pending = _pending_router_refreshes.setdefault(
+            connections[DEFAULT_DB_ALIAS], WeakValueDictionary())
+        n_pending = len(pending)
+        with patch("my_router.receivers.fetch_new_info_save_and_set_cache"
+                   ) as mock_fetch_and_set_cache:
+            with self.captureOnCommitCallbacks(execute=True):
+                with transaction.atomic():
+                    schedule_router_refresh(self.router.id)
+                    schedule_router_refresh(self.router.id)
+                self.assertEqual(len(pending), n_pending + 1)
+
+                try:
+                    with transaction.atomic():
+                        schedule_router_refresh(self.router.id)
+                        self.assertEqual(len(pending), n_pending + 2)
+                        raise RuntimeError()
+                except RuntimeError:
+                    pass
+                self.assertEqual(len(pending), n_pending + 1)
+
+            mock_fetch_and_set_cache.assert_called_once_with(
+                router_id=self.router.id)
+            self.assertEqual(len(pending), n_pending)
+
+    def test_refresh_error_logged(self):
+        with patch("my_router.receivers.fetch_new_info_save_and_set_cache",
+                   side_effect=RuntimeError("foo")), \
+                patch("my_router.receivers.logger") as mock_logger:
+            with self.captureOnCommitCallbacks(execute=True):
+                Device.objects.first().delete()
+        mock_logger.error.assert_called_once()
+
+    def test_catalogs_kept_unless_connection_changed(self):
+        with patch.object(
+                RouterDataManager, "invalidate_catalogs") as mock_invalidate:
+            self.router.name = "new name"
+            self.router.fetch_interval += 1
+            self.router.save()
+            mock_invalidate.assert_not_called()
+
+            self.router.url = "http://192.168.1.2"
+            self.router.save()
+            mock_invalidate.assert_called_once()
+
     def test_update_device_with_block_mac_by_proto_ctrl_to_False(self):
         self.first_device.block_mac_by_proto_ctrl = True
         self.first_device.save()
@@ -0,0 +1,90 @@
+import gzip
+import json
+from datetime import datetime, timezone
+from unittest.mock import patch
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import StreamingHttpResponse
+from django.test import RequestFactory, SimpleTestCase, override_settings
+
+from my_router import responses
+from my_router.responses import (dumps_json, get_accepted_encoding,
+                                 json_response)
+
+ROWS = [
+    {"id": i, "name": f"device {i}", "apply_to": ["kids"],
+     "last_seen": datetime(2024, 2, 25, 13, 32, 36, 123456, tzinfo=timezone.utc)}
+    for i in range(20)]
+
+
+class DumpsJsonTest(SimpleTestCase):
+    def test_same_as_django_encoder(self):
+        expected = json.loads(json.dumps(ROWS, cls=DjangoJSONEncoder))
+        self.assertEqual(json.loads(dumps_json(ROWS)), expected)
+
+        with patch.object(responses, "orjson", None):
+            self.assertEqual(json.loads(dumps_json(ROWS)), expected)
+
+    @override_settings(
+        BEHAVIORAL_CONTROL_JSON_DUMPS="my_router.responses._stdlib_dumps")
+    def test_configured(self):
+        self.assertIs(responses.get_json_dumps(), responses._stdlib_dumps)
+
+
+class JsonResponseTest(SimpleTestCase):
+    def setUp(self):
+        self.factory = RequestFactory()
+
+    def get_request(self, accept_encoding=None):
+        headers = {}
+        if accept_encoding is not None:
+            headers["Accept-Encoding"] = accept_encoding
+        return self.factory.get("/", headers=headers)
+
+    def test_accepted_encoding(self):
+        with patch.object(responses, "brotli", None):
+            for accept_encoding, expected in [
+                    ("", None),
+                    ("identity", None),
+                    ("gzip, deflate", "gzip"),
+                    ("gzip;q=0, br", None)]:
+                with self.subTest(accept_encoding=accept_encoding):
+                    self.assertEqual(
+                        get_accepted_encoding(
+                            self.get_request(accept_encoding)), expected)
+
+        with patch.object(responses, "brotli", object()):
+            self.assertEqual(
+                get_accepted_encoding(self.get_request("gzip, br")), "br")
+            self.assertEqual(
+                get_accepted_encoding(self.get_request("gzip, br;q=0.5")), "gzip")
+
+    def test_not_compressed(self):
+        resp = json_response(self.get_request(), ROWS)
+        self.assertNotIn("Content-Encoding", resp)
+        self.assertEqual(len(json.loads(resp.content)), len(ROWS))
+
+        # Too small to be compressed
+        resp = json_response(self.get_request("gzip"), [])
+        self.assertNotIn("Content-Encoding", resp)
+        self.assertEqual(json.loads(resp.content), [])
+
+    def test_gzip(self):
+        resp = json_response(self.get_request("gzip"), ROWS)
+        self.assertEqual(resp["Content-Encoding"], "gzip")
+        self.assertEqual(resp["Vary"], "Accept-Encoding")
+        self.assertEqual(len(json.loads(gzip.decompress(resp.content))), len(ROWS))
+
+    @override_settings(BEHAVIORAL_CONTROL_JSON_STREAM_MIN_ROWS=10)
+    def test_streamed(self):
+        resp = json_response(self.get_request(), ROWS)
+        self.assertIsInstance(resp, StreamingHttpResponse)
+        self.assertEqual(
+            json.loads(b"".join(resp.streaming_content)),
+            json.loads(dumps_json(ROWS)))
+
+        resp = json_response(self.get_request("gzip"), ROWS)
+        self.assertEqual(resp["Content-Encoding"], "gzip")
+        self.assertEqual(
+            json.loads(gzip.decompress(b"".join(resp.streaming_content))),
+            json.loads(dumps_json(ROWS)))
@@ -0,0 +1,104 @@
+from datetime import timedelta
+from unittest.mock import patch
+
+from django.test import TestCase, override_settings
+from django.utils import timezone
+from tests.data_for_tests import MAC1, MAC2, generate_mac
+from tests.factories import DeviceFactory, RouterFactory
+from tests.mixins import CacheMixin, ViewTestMixin
+
+from my_router.admin import RouterForm
+from my_router.device_store import get_device_store
+from my_router.models import DEFAULT_DEVICE_RETENTION_DAYS, Device, Router
+from my_router.retention import (acquire_compaction_lock,
+                                 compact_router_devices, get_stale_devices)
+from my_router.tasks import fetch_devices_and_set_cache
+
+
+class DeviceCompactionTest(CacheMixin, ViewTestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.router.device_retention_days = 30
+        self.router.save()
+        self.device_store = get_device_store(self.router.id)
+        self.long_ago = timezone.now() - timedelta(days=31)
+
+    def create_offline_device(self, index, last_seen=None, **kwargs):
+        device = DeviceFactory(
+            router=self.router, mac=generate_mac(index),
+            added_datetime=self.long_ago, **kwargs)
+        if last_seen is not None:
+            self.device_store.set_records({device.mac: {"last_seen": last_seen}})
+        return device
+
+    def test_stale_devices_removed(self):
+        stale = self.create_offline_device(1, last_seen=self.long_ago)
+        stale_no_record = self.create_offline_device(2)
+        recent = self.create_offline_device(3, last_seen=timezone.now())
+
+        self.assertEqual(
+            sorted(mac for _, mac in get_stale_devices(self.router)),
+            sorted([stale.mac, stale_no_record.mac]))
+
+        with patch("my_router.receivers.fetch_new_info_save_and_set_cache"
+                   ) as mock_fetch_and_set_cache:
+            self.assertEqual(compact_router_devices(self.router, batch_size=1), 2)
+            mock_fetch_and_set_cache.assert_not_called()
+
+        self.assertEqual(
+            set(Device.objects.filter(router=self.router).values_list(
+                "mac", flat=True)),
+            {MAC1, MAC2, recent.mac})
+        self.assertIsNone(self.device_store.get_record(stale.mac))
+        self.assertNotIn(stale.mac, self.device_store.get_macs())
+        self.assertIn(recent.mac, self.device_store.get_macs())
+
+    def test_protected_devices(self):
+        self.create_offline_device(1, known=True)
+        self.create_offline_device(2, block_mac_by_proto_ctrl=True)
+
+        # Online devices, which are also in MAC groups
+        Device.objects.filter(mac__in=[MAC1, MAC2]).update(
+            added_datetime=self.long_ago)
+
+        self.assertEqual(get_stale_devices(self.router), [])
+
+    def test_keep_forever(self):
+        self.create_offline_device(1)
+        self.router.device_retention_days = 0
+        self.router.save()
+        self.assertEqual(compact_router_devices(self.router), 0)
+
+    def test_no_snapshot(self):
+        self.create_offline_device(1)
+        self.test_cache.clear()
+        self.assertEqual(get_stale_devices(self.router), [])
+
+    @patch("my_router.tasks.fetch_new_info_save_and_set_cache")
+    def test_task_router_deleted(self, mock_fetch_and_set_cache):
+        router_id = self.router.id
+        self.router.delete()
+        self.assertEqual(
+            fetch_devices_and_set_cache(router_id), {"message": "Done"})
+
+    def test_compaction_lock(self):
+        self.assertTrue(acquire_compaction_lock(self.router.id))
+        self.assertFalse(acquire_compaction_lock(self.router.id))
+
+
+class DeviceRetentionDaysDefaultTest(TestCase):
+    @override_settings(BEHAVIORAL_CONTROL_DEVICE_RETENTION_DAYS=7)
+    def test_setting_applied_to_new_routers(self):
+        self.assertEqual(
+            RouterForm().fields["device_retention_days"].initial, 7)
+
+        router = RouterFactory(device_retention_days=30)
+        self.assertEqual(
+            RouterForm(instance=router)["device_retention_days"].value(), 30)
+
+    def test_model_default_is_constant(self):
+        # Migrations don't change with the setting
+        with override_settings(BEHAVIORAL_CONTROL_DEVICE_RETENTION_DAYS=7):
+            self.assertEqual(
+                Router._meta.get_field("device_retention_days").default,
+                DEFAULT_DEVICE_RETENTION_DAYS)
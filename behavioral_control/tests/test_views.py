@@ -1,21 +1,33 @@
+import json
 from copy import deepcopy
-from unittest.mock import MagicMock, patch
+from unittest.mock import MagicMock, call, patch
 
+import requests
+from asgiref.sync import async_to_sync
 from django.db.models.signals import post_save
-from django.test import TestCase
+from django.test import (AsyncRequestFactory, RequestFactory, TestCase,
+                         override_settings)
 from django.urls import reverse
 from factories import RouterFactory
 from tests.data_for_tests import (DEFAULT_ACL_L7_EDIT_POST_DATA,
                                   DEFAULT_DOMAIN_BLACKLIST_EDIT_POST_DATA,
+                                  DEFAULT_IKUAI_CLIENT_LIST_MAC_GROUPS,
                                   DEFAULT_IKUAI_CLIENT_LIST_MONITOR_LANIP,
-                                  DEFAULT_MAC_GROUPS_EDIT_POST_DATA)
-from tests.mixins import (MockRouterClientMixin,
+                                  DEFAULT_MAC_GROUPS_EDIT_POST_DATA, FAKE_MAC,
+                                  MAC1, MAC2, MAC_GROUP_1, MAC_GROUP_2)
+from tests.mixins import (CacheMixin, MockRouterClientMixin,
                           MockRouterDataManagerViewMixin, RequestTestMixin,
                           ViewTestMixin)
 
+from my_router.circuit_breaker import RouterCircuitBreaker
 from my_router.models import Device, Router
 from my_router.receivers import create_or_update_router_fetch_task
-from my_router.views import fetch_new_info_save_and_set_cache
+from my_router.utils import (get_snapshot_fetched_at_cache_key,
+                             get_snapshot_version_cache_key)
+from my_router.views import (can_stream_live_updates,
+                             fetch_new_info_save_and_set_cache,
+                             get_view_data_rows, iter_view_data_deltas,
+                             stream_cached_info)
 
 
 class HomeViewTest(MockRouterClientMixin, RequestTestMixin, TestCase):
@@ -106,6 +118,41 @@ class FetchNewInfoSaveAndSetCacheTest(MockRouterDataManagerViewMixin, TestCase):
         self.mock_rd_manager.update_mac_control_rule_from_acl_l7.assert_not_called()
 
 
+class FetchNewInfoCircuitBreakerTest(
+        CacheMixin, MockRouterDataManagerViewMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        mock_rd_manager = patch('my_router.views.RouterDataManager')
+
+        self.mock_rd_manager_klass = mock_rd_manager.start()
+        self.mock_rd_manager = self.mock_rd_manager_klass.return_value
+        self.addCleanup(mock_rd_manager.stop)
+
+        self.breaker = RouterCircuitBreaker(self.router.id)
+        for _ in range(self.breaker.failure_threshold):
+            self.breaker.record_failure()
+
+    def test_skipped_when_open(self):
+        fetch_new_info_save_and_set_cache(router=self.router)
+        self.mock_rd_manager.ikuai_client.probe.assert_not_called()
+        self.mock_rd_manager.cache_all_data.assert_not_called()
+
+    def test_probe_after_cool_down(self):
+        self.test_cache.delete(self.breaker.cool_down_cache_key)
+
+        fetch_new_info_save_and_set_cache(router=self.router)
+        self.mock_rd_manager.ikuai_client.probe.assert_called_once()
+        self.mock_rd_manager.cache_all_data.assert_called_once()
+
+    def test_failed_probe(self):
+        self.test_cache.delete(self.breaker.cool_down_cache_key)
+        self.mock_rd_manager.ikuai_client.probe.side_effect = (
+            requests.ConnectionError())
+
+        fetch_new_info_save_and_set_cache(router=self.router)
+        self.mock_rd_manager.cache_all_data.assert_not_called()
+
+
 class FetchCachedInfoTest(
         MockRouterDataManagerViewMixin, RequestTestMixin, TestCase):
 
@@ -170,6 +217,170 @@ class FetchCachedInfoTest(
                              {"mocked_data": "some_value"})
 
 
+class FetchCachedInfoStalenessTest(ViewTestMixin, RequestTestMixin, TestCase):
+    def get_device_info(self):
+        return self.client.get(
+            reverse("fetch-cached-info", args=(self.router.id, "device")))
+
+    def test_fresh(self):
+        resp = self.get_device_info()
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn("X-Router-Snapshot-Age", resp.headers)
+        self.assertNotIn("X-Router-Snapshot-Stale", resp.headers)
+        self.assertEqual(
+            resp["X-Router-Snapshot-Version"],
+            self.test_cache.get(get_snapshot_version_cache_key(self.router.id)))
+
+    def test_stale_when_router_unreachable(self):
+        breaker = RouterCircuitBreaker(self.router.id)
+        for _ in range(breaker.failure_threshold):
+            breaker.record_failure()
+
+        resp = self.get_device_info()
+        self.assertEqual(resp.status_code, 200)
+        self.assertTrue(len(resp.json()))
+        self.assertEqual(resp.headers["X-Router-Snapshot-Stale"], "1")
+
+    def test_stale_when_not_fetched_recently(self):
+        fetched_at_cache_key = get_snapshot_fetched_at_cache_key(self.router.id)
+        self.test_cache.set(
+            fetched_at_cache_key,
+            self.test_cache.get(fetched_at_cache_key)
+            - self.router.fetch_interval * 10)
+
+        resp = self.get_device_info()
+        self.assertEqual(resp.headers["X-Router-Snapshot-Stale"], "1")
+
+
+@override_settings(
+    BEHAVIORAL_CONTROL_LIVE_UPDATE_TIMEOUT=5,
+    BEHAVIORAL_CONTROL_LIVE_UPDATE_HEARTBEAT=0.01)
+class StreamCachedInfoTest(ViewTestMixin, RequestTestMixin, TestCase):
+    def set_device_offline(self, mac):
+        devices = deepcopy(DEFAULT_IKUAI_CLIENT_LIST_MONITOR_LANIP)
+        devices["data"] = [d for d in devices["data"] if d["mac"] != mac]
+        devices["total"] = len(devices["data"])
+        self.mock_client.list_monitor_lanip.return_value = devices
+        fetch_new_info_save_and_set_cache(router=self.router)
+
+    def get_stream_url(self, info_name="device"):
+        return reverse("stream-cached-info", args=(self.router.id, info_name))
+
+    @override_settings(BEHAVIORAL_CONTROL_LIVE_UPDATE_STREAMING=True)
+    def test_stream(self):
+        resp = self.client.get(self.get_stream_url())
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp["Content-Type"], "text/event-stream")
+        self.assertEqual(next(resp.streaming_content), b"retry: 3000\n\n")
+        resp.close()
+
+    @override_settings(BEHAVIORAL_CONTROL_LIVE_UPDATE_STREAMING=True)
+    def test_stream_asgi(self):
+        request = AsyncRequestFactory().get(self.get_stream_url())
+        request.user = self.user
+        resp = stream_cached_info(request, self.router.id, "device")
+        self.assertTrue(resp.is_async)
+
+        # Sent as it goes, not once the stream ended
+        async def get_first_chunk():
+            chunks = aiter(resp.streaming_content)
+            try:
+                return await anext(chunks)
+            finally:
+                await chunks.aclose()
+
+        self.assertEqual(async_to_sync(get_first_chunk)(), b"retry: 3000\n\n")
+
+    def test_polled_version_changed_since_page_load(self):
+        resp = self.client.get(self.get_stream_url(), data={"version": "foo"})
+        self.assertIn("event: reload", resp.content.decode().splitlines())
+
+        version = self.test_cache.get(get_snapshot_version_cache_key(
+            self.router.id))
+        resp = self.client.get(self.get_stream_url(), data={"version": version})
+        self.assertNotIn("event: reload", resp.content.decode().splitlines())
+
+    def test_polled_without_shared_events(self):
+        # The events of the celery polls are not seen by the web workers
+        resp = self.client.get(self.get_stream_url())
+        self.assertEqual(resp.status_code, 200)
+        self.assertFalse(resp.streaming)
+        self.assertEqual(resp["Content-Type"], "text/event-stream")
+
+        lines = resp.content.decode().splitlines()
+        self.assertEqual(
+            lines[0], f"retry: {self.router.fetch_interval * 1000}")
+        self.assertTrue(lines[2].startswith("id: v:"))
+        self.assertNotIn("event: reload", lines)
+
+        # Unchanged since the last poll
+        resp = self.client.get(
+            self.get_stream_url(), HTTP_LAST_EVENT_ID=lines[2][len("id: "):])
+        self.assertNotIn("event: reload", resp.content.decode())
+
+        self.set_device_offline(MAC2)
+        resp = self.client.get(
+            self.get_stream_url(), HTTP_LAST_EVENT_ID=lines[2][len("id: "):])
+        self.assertIn("event: reload", resp.content.decode().splitlines())
+
+    def test_can_stream_live_updates(self):
+        wsgi_request = RequestFactory().get("/")
+        asgi_request = AsyncRequestFactory().get("/")
+        self.assertFalse(can_stream_live_updates(asgi_request))
+
+        with patch("my_router.views.is_event_stream_shared", return_value=True):
+            # A sync worker would be held by each open stream
+            self.assertFalse(can_stream_live_updates(wsgi_request))
+            self.assertTrue(can_stream_live_updates(asgi_request))
+
+    def test_stream_not_found(self):
+        resp = self.client.get(
+            reverse("stream-cached-info", args=(self.router.id, "foo")))
+        self.assertEqual(resp.status_code, 404)
+
+    def test_row_delta(self):
+        stream = iter_view_data_deltas(self.router, "device", {})
+        self.assertEqual(next(stream), "retry: 3000\n\n")
+        self.assertEqual(next(stream), ": keep-alive\n\n")
+
+        self.set_device_offline(MAC2)
+
+        lines = next(stream).splitlines()
+        self.assertEqual(lines[1], "event: delta")
+        delta = json.loads(lines[2][len("data: "):])
+        self.assertEqual(delta["remove"], [])
+        self.assertEqual([row["mac"] for row in delta["upsert"]], [MAC2])
+        self.assertFalse(delta["upsert"][0]["online"])
+
+    def test_url_black_rows(self):
+        # Grouped by "enabled" and "disabled" in the view data
+        rows = get_view_data_rows(self.router, "url_black", {})
+        self.assertTrue(rows)
+        self.assertTrue(all(isinstance(key, int) for key in rows))
+
+    def test_reload_if_changed_since_page_load(self):
+        version = self.test_cache.get(get_snapshot_version_cache_key(
+            self.router.id))
+        stream = iter_view_data_deltas(self.router, "device", {}, version=version)
+        next(stream)
+        self.assertEqual(next(stream), ": keep-alive\n\n")
+
+        stream = iter_view_data_deltas(self.router, "device", {}, version="foo")
+        next(stream)
+        self.assertIn("event: reload", next(stream))
+
+    def test_reload_after_reconnect(self):
+        stream = iter_view_data_deltas(self.router, "device", {}, last_id="0")
+        next(stream)
+        # Nothing published since
+        self.assertEqual(next(stream), ": keep-alive\n\n")
+
+        self.set_device_offline(MAC2)
+        stream = iter_view_data_deltas(self.router, "device", {}, last_id="0")
+        next(stream)
+        self.assertIn("event: reload", next(stream))
+
+
 class DeviceUpdateViewTest(ViewTestMixin, RequestTestMixin, TestCase):
     def get_update_device_url(self, pk=None):
         pk = pk or self.first_device.pk
@@ -188,6 +399,17 @@ class DeviceUpdateViewTest(ViewTestMixin, RequestTestMixin, TestCase):
         resp = self.client.get(self.get_update_device_url())
         self.assertEqual(resp.status_code, 200)
 
+    def test_get_from_snapshot(self):
+        self.mock_client.reset_mock()
+        resp = self.client.get(self.get_update_device_url())
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(
+            resp.context["form"].fields["mac_group"].initial,
+            self.init_mac_groups)
+
+        # The router is not called
+        self.assertEqual(self.mock_client.method_calls, [])
+
     def test_get_not_authenticated(self):
         self.client.logout()
         resp = self.client.get(self.get_update_device_url())
@@ -212,6 +434,44 @@ class DeviceUpdateViewTest(ViewTestMixin, RequestTestMixin, TestCase):
         resp = self.client.post(url, data=post_data)
         self.assertEqual(resp.status_code, 302)
 
+    def post_mac_groups(self, mac, mac_groups):
+        device = Device.objects.get(mac=mac)
+        post_data = self.get_device_post_data(pk=device.pk)
+        post_data["mac_group"] = mac_groups
+        self.mock_client.reset_mock()
+        resp = self.client.post(
+            self.get_update_device_url(pk=device.pk), data=post_data)
+        self.assertEqual(resp.status_code, 302)
+        return self.mock_client.edit_mac_group.call_args_list
+
+    def test_post_mac_group_join(self):
+        calls = self.post_mac_groups(MAC2, [MAC_GROUP_1, MAC_GROUP_2])
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(calls[0].kwargs, {
+            "group_id": 1, "group_name": MAC_GROUP_1,
+            "addr_pools": [MAC1, MAC2]})
+
+    def test_post_mac_group_leave(self):
+        calls = self.post_mac_groups(MAC2, [])
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(calls[0].kwargs, {
+            "group_id": 8, "group_name": MAC_GROUP_2, "addr_pools": [MAC1]})
+
+    def test_post_mac_group_edited_since_snapshot(self):
+        # A member was added on the router after the snapshot
+        mac_groups = deepcopy(DEFAULT_IKUAI_CLIENT_LIST_MAC_GROUPS)
+        mac_groups["data"][0]["addr_pool"] = f"{MAC1},{FAKE_MAC}"
+        self.mock_client.list_mac_groups.return_value = mac_groups
+
+        calls = self.post_mac_groups(MAC2, [MAC_GROUP_1, MAC_GROUP_2])
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(
+            calls[0].kwargs["addr_pools"], [MAC1, FAKE_MAC, MAC2])
+
+    def test_post_mac_group_leave_only_element(self):
+        calls = self.post_mac_groups(MAC1, [MAC_GROUP_2])
+        self.assertEqual(calls, [])
+
     def test_post_name_not_changed(self):
         url = self.get_update_device_url()
 
@@ -254,6 +514,100 @@ class DeviceUpdateViewTest(ViewTestMixin, RequestTestMixin, TestCase):
         # todo: assert acl_mac changed
 
 
+class BulkUpdateDeviceListTest(ViewTestMixin, RequestTestMixin, TestCase):
+    def post_bulk_action(self, data, router_id=None):
+        router_id = router_id or self.router.id
+        return self.client.post(
+            reverse("device-bulk-update", args=(router_id,)), data=data)
+
+    @patch("my_router.receivers.fetch_new_info_save_and_set_cache")
+    def test_mark_known(self, mock_fetch_and_set_cache):
+        with self.captureOnCommitCallbacks(execute=True):
+            resp = self.post_bulk_action(
+                {"action": "mark_known", "mac": [MAC1, MAC2]})
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(
+            Device.objects.filter(router=self.router, known=True).count(), 2)
+
+        # Database only changes don't refresh the router
+        mock_fetch_and_set_cache.assert_not_called()
+
+    @patch("my_router.receivers.fetch_new_info_save_and_set_cache")
+    def test_join_mac_groups(self, mock_fetch_and_set_cache):
+        self.mock_client.reset_mock()
+        with self.captureOnCommitCallbacks(execute=True):
+            resp = self.post_bulk_action({
+                "action": "join_mac_groups", "mac": [MAC1, MAC2],
+                "mac_group": [MAC_GROUP_1]})
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.json()["skipped_mac_groups"], [])
+        self.mock_client.edit_mac_group.assert_called_once_with(
+            group_id=1, group_name=MAC_GROUP_1, addr_pools=[MAC1, MAC2])
+        mock_fetch_and_set_cache.assert_called_once()
+
+    @patch("my_router.receivers.fetch_new_info_save_and_set_cache")
+    def test_join_mac_groups_failed(self, mock_fetch_and_set_cache):
+        self.mock_client.edit_mac_group.side_effect = RuntimeError("foo")
+        with self.captureOnCommitCallbacks(execute=True):
+            resp = self.post_bulk_action({
+                "action": "join_mac_groups", "mac": [MAC1, MAC2],
+                "mac_group": [MAC_GROUP_1]})
+        self.assertEqual(resp.status_code, 400)
+        self.assertIn("RuntimeError: foo", resp.json()["error"])
+        self.assertEqual(resp.json()["applied"], [])
+        self.assertEqual(resp.json()["not_applied"], ["Editing the mac groups"])
+        mock_fetch_and_set_cache.assert_called_once()
+
+    def test_unknown_action(self):
+        resp = self.post_bulk_action({"action": "foo", "mac": [MAC1]})
+        self.assertEqual(resp.status_code, 400)
+
+    def test_get_not_allowed(self):
+        resp = self.client.get(
+            reverse("device-bulk-update", args=(self.router.id,)))
+        self.assertEqual(resp.status_code, 403)
+
+    def test_router_not_exists(self):
+        resp = self.post_bulk_action({"action": "ignore"}, router_id=10)
+        self.assertEqual(resp.status_code, 404)
+
+
+class AutocompleteViewTest(ViewTestMixin, RequestTestMixin, TestCase):
+    def get_autocomplete_url(self, kind="device", router_id=None):
+        return reverse("autocomplete", args=(router_id or self.router.id, kind))
+
+    def test_get_ok(self):
+        resp = self.client.get(
+            self.get_autocomplete_url(), data={"term": MAC2[:5]})
+        self.assertEqual(resp.status_code, 200)
+        data = resp.json()
+        self.assertEqual([item["id"] for item in data["results"]], [MAC2])
+        self.assertFalse(data["pagination"]["more"])
+
+    @override_settings(BEHAVIORAL_CONTROL_AUTOCOMPLETE_PAGE_SIZE=1)
+    def test_page(self):
+        resp = self.client.get(
+            self.get_autocomplete_url("mac_group"), data={"page": "2"})
+        self.assertEqual(len(resp.json()["results"]), 1)
+
+        resp = self.client.get(
+            self.get_autocomplete_url("mac_group"), data={"page": "foo"})
+        self.assertTrue(resp.json()["pagination"]["more"])
+
+    def test_unknown_kind(self):
+        resp = self.client.get(self.get_autocomplete_url("foo"))
+        self.assertEqual(resp.status_code, 404)
+
+    def test_router_not_exists(self):
+        resp = self.client.get(self.get_autocomplete_url(router_id=10))
+        self.assertEqual(resp.status_code, 404)
+
+    def test_not_authenticated(self):
+        self.client.logout()
+        resp = self.client.get(self.get_autocomplete_url())
+        self.assertEqual(resp.status_code, 302)
+
+
 class DomainBlacklistEditView(
         ViewTestMixin, RequestTestMixin, TestCase):
 
@@ -290,6 +644,33 @@ class DomainBlacklistEditView(
 
         self.assertEqual(resp.status_code, 302)
 
+    def test_post_domain_group_of_router(self):
+        # Not used by any domain blacklist yet
+        resp = self.client.post(
+            self.get_update_domain_blacklist_url(),
+            data=self.get_post_data(domain_group="购物网站"))
+
+        self.assertEqual(resp.status_code, 302)
+        self.assertEqual(
+            self.mock_client.edit_domain_blacklist.call_args.kwargs[
+                "domain_groups"],
+            ["购物网站"])
+
+    def test_post_unchanged(self):
+        # The rule is saved with the initial values of its form
+        resp = self.client.get(self.get_update_domain_blacklist_url())
+        form = resp.context["form"]
+        self.assertEqual(form["domain_group"].value(), "游戏网站")
+
+        resp = self.client.post(
+            self.get_update_domain_blacklist_url(),
+            data=self.get_post_data(domain_group=form["domain_group"].value()))
+        self.assertEqual(resp.status_code, 302)
+        self.assertEqual(
+            self.mock_client.edit_domain_blacklist.call_args.kwargs[
+                "domain_groups"],
+            ["游戏网站"])
+
 
 class AclL7EditView(
         ViewTestMixin, RequestTestMixin, TestCase):
@@ -305,6 +686,81 @@ class AclL7EditView(
         resp = self.client.get(self.get_update_acl_l7_url())
         self.assertEqual(resp.status_code, 200)
 
+    def test_get_from_snapshot(self):
+        self.mock_client.reset_mock()
+        resp = self.client.get(self.get_update_acl_l7_url())
+        self.assertEqual(resp.status_code, 200)
+
+        # Only the protocol catalog is fetched, once
+        self.assertEqual(
+            self.mock_client.method_calls, [call.list_protocols_json()])
+
+        self.mock_client.reset_mock()
+        resp = self.client.get(self.get_update_acl_l7_url())
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(self.mock_client.method_calls, [])
+
+    def test_get_protocols_of_router(self):
+        resp = self.client.get(self.get_update_acl_l7_url())
+
+        # Only the selected protocols are rendered, the others are searched
+        self.assertContains(
+            resp, reverse("autocomplete", args=(self.router.id, "protocol")))
+        self.assertContains(resp, '<option value="所有协议" selected>')
+        self.assertNotContains(resp, "爱奇艺")
+        self.assertIn(
+            ("爱奇艺", "爱奇艺"), resp.context["form"].fields["app_proto"].choices)
+
+    def test_post_protocol_of_router(self):
+        resp = self.client.post(
+            self.get_update_acl_l7_url(),
+            data=self.get_post_data(app_proto="优酷"))
+
+        self.assertEqual(resp.status_code, 302)
+        self.assertEqual(
+            self.mock_client.edit_acl_l7.call_args.kwargs["app_protos"],
+            ["优酷"])
+
+    def test_post_unchanged(self):
+        # The rule is saved with the initial values of its form
+        resp = self.client.get(self.get_update_acl_l7_url())
+        form = resp.context["form"]
+        self.assertEqual(form["app_proto"].value(), "所有协议")
+
+        resp = self.client.post(
+            self.get_update_acl_l7_url(),
+            data=self.get_post_data(app_proto=form["app_proto"].value()))
+        self.assertEqual(resp.status_code, 302)
+        self.assertEqual(
+            self.mock_client.edit_acl_l7.call_args.kwargs["app_protos"],
+            ["所有协议"])
+
+    def test_post_several_protocols_unchanged(self):
+        # The protocols of a rule are kept together as one choice
+        app_proto = "淘宝视频,淘宝通用账号,淘宝"
+        resp = self.client.get(self.get_update_acl_l7_url(8))
+        self.assertContains(
+            resp, f'<option value="{app_proto}" selected>')
+
+        resp = self.client.post(
+            self.get_update_acl_l7_url(8),
+            data=self.get_post_data(app_proto=app_proto))
+        self.assertEqual(resp.status_code, 302)
+        self.assertEqual(
+            self.mock_client.edit_acl_l7.call_args.kwargs["app_protos"],
+            ["淘宝视频", "淘宝通用账号", "淘宝"])
+
+    def test_post_unknown_protocol(self):
+        resp = self.client.post(
+            self.get_update_acl_l7_url(),
+            data=self.get_post_data(app_proto="foo"))
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn("app_proto", resp.context["form"].errors)
+
+    def test_get_not_found(self):
+        resp = self.client.get(self.get_update_acl_l7_url(1000))
+        self.assertEqual(resp.status_code, 404)
+
     def test_get_add_ok(self):
         resp = self.client.get(self.get_update_acl_l7_url(-1))
         self.assertEqual(resp.status_code, 200)
@@ -342,10 +798,21 @@ class MacGroupEditView(
         resp = self.client.get(self.get_update_mac_group_url())
         self.assertEqual(resp.status_code, 200)
 
+    def test_get_not_found(self):
+        resp = self.client.get(self.get_update_mac_group_url(1000))
+        self.assertEqual(resp.status_code, 404)
+
     def test_get_add_ok(self):
         resp = self.client.get(self.get_update_mac_group_url(-1))
         self.assertEqual(resp.status_code, 200)
 
+    def test_get_renders_selected_devices_only(self):
+        Device.objects.filter(mac=MAC2).update(name="foo")
+        resp = self.client.get(self.get_update_mac_group_url(-1))
+        self.assertContains(
+            resp, reverse("autocomplete", args=(self.router.id, "device")))
+        self.assertNotContains(resp, "foo")
+
     def test_get_not_authenticated(self):
         self.client.logout()
         resp = self.client.get(self.get_update_mac_group_url())
@@ -367,6 +834,14 @@ class MacGroupEditView(
 
         self.assertEqual(resp.status_code, 302)
 
+    def test_post_unknown_device(self):
+        resp = self.client.post(
+            self.get_update_mac_group_url(),
+            data=self.get_post_data(apply_to=["foo"]))
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn("apply_to", resp.context["form"].errors)
+        self.mock_client.edit_mac_group.assert_not_called()
+
 
 class ListViewTest(ViewTestMixin, RequestTestMixin, TestCase):
     def get_list_view_url(self, view_name, query_string=None):
@@ -442,6 +917,28 @@ class DeleteViewTest(ViewTestMixin, RequestTestMixin, TestCase):
                 self.assertEqual(resp.status_code, 302)
                 self.assertTrue(resp.url.startswith(reverse("login")))
 
+    def test_bulk_delete(self):
+        for name, method in [
+                ("domain_blacklist-bulk-delete", "del_domain_blacklist"),
+                ("acl_l7-bulk-delete", "del_acl_l7"),
+                ("mac_group-bulk-delete", "del_mac_group")]:
+            with self.subTest(name=name):
+                self.mock_client.reset_mock()
+                resp = self.client.post(
+                    reverse(name, args=(self.router.id,)), data={"id": [1, 3]})
+                self.assertEqual(resp.status_code, 200)
+                getattr(self.mock_client, method).assert_called_once_with("1,3")
+
+                # Only the affected rules are fetched again
+                self.mock_client.list_monitor_lanip.assert_not_called()
+
+    def test_bulk_delete_invalid_id(self):
+        resp = self.client.post(
+            reverse("acl_l7-bulk-delete", args=(self.router.id,)),
+            data={"id": ["foo"]})
+        self.assertEqual(resp.status_code, 400)
+        self.mock_client.del_acl_l7.assert_not_called()
+
     def test_router_not_exists(self):
         for name in ["domain_blacklist-delete", "acl_l7-delete", "mac_group-delete"]:
             with self.subTest(name=name):